@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""
+Module with benchmarks of the central registry and service providers.
+
+The workers benchmark starts a central registry with a growing number
+of worker processes and floods it with certificate signing requests,
+which are bound by the CPU cost of signatures but also change the
+state shared through the manager process, and with signed stats
+requests, which only read the cached certificates. Workers can only
+speed up either kind on a machine with several cores. The schemes
+benchmark measures the sign and verify operations per second of each
+available signature scheme.
+
+Usage:
+    python3 benchmark.py workers [max_workers] [clients] [seconds]
+    python3 benchmark.py schemes [seconds]
+
+Args:
+    max_workers: the largest number of worker processes, defaults to 4
+    clients: number of client processes sending requests, defaults to 8
+    seconds: duration of each round in seconds, defaults to 5
+"""
+__author__ = 'Luka Sterbic'
+
+import os
+import sys
+import time
+import pickle
+import socket
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+
+from communication import com_structs
+from communication.keystore import KeyStore
+from communication.admission import AdmissionController, DEFAULT_BUDGETS
+from central_registry import CentralRegistry
+
+UNLIMITED = (1e9, 1e9, 1e9)
+
+
+def send_request(address, message):
+    """Sends a request to a CR and returns the content of the reply."""
+    with socket.create_connection(address) as soc:
+        com_structs.send_message(soc, message)
+        return com_structs.receive_message(soc).content
+
+
+def client_certificate():
+    """Returns a new key and an unsigned certificate of a client."""
+    key = com_structs.get_key()
+    certificate = com_structs.Certificate(
+        "client",
+        ("127.0.0.1", 0),
+        key.publickey().exportKey("PEM"),
+        scheme=key.scheme.name
+    )
+
+    return key, certificate
+
+
+def sign_requests(address, seconds):
+    """
+    Sends certificate signing requests to a CR for the given time.
+
+    Args:
+        address: the address of the central registry
+        seconds: the duration of the benchmark round
+
+    Returns:
+        the number of completed requests
+    """
+    certificate = client_certificate()[1]
+
+    completed = 0
+    end = time.time() + seconds
+
+    while time.time() < end:
+        send_request(address, com_structs.Message(com_structs.Message.SIGN,
+                                                  certificate))
+        completed += 1
+
+    return completed
+
+
+def stats_requests(address, seconds):
+    """
+    Sends signed stats requests to a CR for the given time.
+
+    The certificate of the client is signed by the CR first, so that
+    the requests can be authenticated.
+
+    Args:
+        address: the address of the central registry
+        seconds: the duration of the benchmark round
+
+    Returns:
+        the number of completed requests
+    """
+    key, certificate = client_certificate()
+    certificate = send_request(
+        address, com_structs.Message(com_structs.Message.SIGN, certificate))
+
+    completed = 0
+    end = time.time() + seconds
+
+    while time.time() < end:
+        message = com_structs.SignedRequest(com_structs.Message.STATS, None,
+                                            certificate.com_id)
+        message.sign(key)
+
+        send_request(address, message)
+        completed += 1
+
+    return completed
+
+
+def benchmark_workers(max_workers=4, clients=8, seconds=5):
+    """
+    Measures the CR request throughput for growing numbers of workers.
+
+    Each round measures the throughput of certificate signing requests
+    and then of signed stats requests.
+
+    Args:
+        max_workers: the largest number of worker processes
+        clients: number of client processes sending requests
+        seconds: duration of each round in seconds
+    """
+    keystore = KeyStore(tempfile.mkdtemp())
+    pool = multiprocessing.Pool(clients)
+    baselines = None
+    workers = 1
+
+    print("%8s %12s %8s %12s %8s" % ("Workers", "Signs/s", "Speedup",
+                                     "Stats/s", "Speedup"))
+    print("-" * 52)
+
+    while workers <= max_workers:
+        with open(os.devnull, "w") as devnull, \
+                contextlib.redirect_stdout(devnull):
+            # The port is chosen by the system, a random one can clash
+            # with the client ports of the previous rounds
+            cr = CentralRegistry("CR", ("127.0.0.1", 0), keystore, workers)
+            address = cr.server_address
+            cr.admission = AdmissionController(
+                dict((msg_type, UNLIMITED) for msg_type in DEFAULT_BUDGETS)
+            )
+
+            try:
+                cr.start_workers()
+                threading.Thread(target=cr.serve_forever,
+                                 daemon=True).start()
+
+                throughputs = [
+                    sum(pool.starmap(requests,
+                                     [(address, seconds)] * clients)) /
+                    seconds
+                    for requests in (sign_requests, stats_requests)
+                ]
+            finally:
+                cr.shutdown()
+                cr.server_close()
+
+        if baselines is None:
+            baselines = throughputs
+
+        print("%8d %12.1f %7.2fx %12.1f %7.2fx" % (
+            workers,
+            throughputs[0], throughputs[0] / baselines[0],
+            throughputs[1], throughputs[1] / baselines[1]))
+        workers *= 2
+
+    pool.close()
+    pool.join()
+
+
+def operations_per_second(operation, seconds):
+    """Returns how many times the operation completes per second."""
+    completed = 0
+    start = time.time()
+    end = start + seconds
+
+    while time.time() < end:
+        operation()
+        completed += 1
+
+    return completed / (time.time() - start)
+
+
+def benchmark_schemes(seconds=5):
+    """
+    Measures sign and verify operations per second of each scheme.
+
+    Args:
+        seconds: duration of each measurement in seconds
+    """
+    digest = com_structs.content_digest(["benchmark"])
+
+    print("%12s %10s %10s %12s" % ("Scheme", "Sign/s", "Verify/s",
+                                   "Signature"))
+    print("-" * 47)
+
+    for name in com_structs.SCHEME_PREFERENCE:
+        if name not in com_structs.SCHEMES:
+            print("%12s %s" % (name, "not available"))
+            continue
+
+        key = com_structs.get_key(scheme=name)
+        public_key = key.publickey()
+        signature = key.sign(digest)
+
+        signs = operations_per_second(lambda: key.sign(digest), seconds)
+        verifies = operations_per_second(
+            lambda: public_key.verify(digest, signature), seconds)
+
+        print("%12s %10.1f %10.1f %10d B" % (
+            name, signs, verifies, len(pickle.dumps(signature))))
+
+
+def main(benchmark, *args):
+    """
+    Main function of this script.
+
+    Runs the given benchmark with the given arguments.
+
+    Args:
+        benchmark: the name of the benchmark
+        args: the arguments of the benchmark
+    """
+    benchmarks = {
+        "workers": benchmark_workers,
+        "schemes": benchmark_schemes
+    }
+
+    if benchmark not in benchmarks:
+        print(__doc__)
+        exit(1)
+
+    benchmarks[benchmark](*[int(arg) for arg in args])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+
+    main(*sys.argv[1:])
@@ -7,24 +7,33 @@ The script expects two arguments, the IP address and port to be used
 for incoming connections.
 
 Usage:
-    python3 central_registry.py name port
+    python3 central_registry.py name port [workers]
 
 Args:
     name: the name of the central registry
     ip: the ip address of the central registry
     port: the port on which te central registry listens
+    workers: number of processes serving requests, defaults to 1
 """
 from communication import com_structs
 
 __author__ = 'Luka Sterbic'
 
 import sys
+import time
 import signal
 import pickle
 import threading
 import socketserver
 
 from descriptors import SPDescriptor
+import profiler
+from profiler import Profiler
+from communication.keystore import KeyStore
+from communication.admission import AdmissionController, BOOTSTRAP
+from communication.prefork import PreforkMixIn, SharedStore
+from communication import tracing
+from communication.tracing import tracer
 
 
 class RequestHandler(socketserver.BaseRequestHandler):
@@ -34,14 +43,48 @@ class RequestHandler(socketserver.BaseRequestHandler):
     This class handles communicator requests. A communicator can query
     for the certificate of the central registry, it can ask the CR to
     sign its certificate and it can ask the CR to publish its files so
-    that other communicators become aware of them.
+    that other communicators become aware of them, getting back the
+    signed catalog of its files. Communicators also report their load
+    and the files they hold verified replicas of.
+
+    Apart from the certificate queries and signatures, requests have to
+    be signed by the communicator they claim to come from. Requests
+    pass through the admission control of the CR first, with the budget
+    of the authenticated com id or, for requests which are not
+    authenticated, of the IP address of the peer. A request over the
+    budget is answered with a REJECT message carrying the number of
+    seconds after which to retry.
     """
 
     def handle(self):
-        request = self.request.recv(com_structs.BUFFER_SIZE)
-        message = pickle.loads(request)
+        message = com_structs.receive_message(self.request)
         message.request = False
 
+        authenticated = message.type not in BOOTSTRAP and \
+            self.server.authenticate(message)
+        peer = message.src_com_id if authenticated else \
+            self.client_address[0]
+
+        with tracer.span("handle %s" % message.type, message, peer=peer):
+            retry_after = self.server.admission.admit(peer, message.type)
+
+            if retry_after is not None:
+                self.print_log(
+                    self.client_address,
+                    "Rejected %s request of %s" % (message.type, peer)
+                )
+                message = com_structs.Message(com_structs.Message.REJECT,
+                                              retry_after, False)
+            else:
+                try:
+                    self.dispatch(message, authenticated)
+                finally:
+                    self.server.admission.release(peer, message.type)
+
+            com_structs.send_message(self.request, message)
+
+    def dispatch(self, message, authenticated):
+        """Handles an admitted message and sets the reply content."""
         if message.type == com_structs.Message.CERTIFICATE:
             self.print_log(self.client_address, "Sending certificate")
             message.content = self.server.certificate
@@ -50,101 +93,184 @@ class RequestHandler(socketserver.BaseRequestHandler):
 
             self.print_log(
                 self.client_address,
-                "Signing certificate for %s" % certificate.name
+                "Registering certificate for %s" % certificate.name
             )
 
-            self.server.register_certificate(message.content)
+            if not self.server.register_certificate(certificate):
+                self.print_log(
+                    self.client_address,
+                    "Reused valid certificate of %s" % certificate.name
+                )
 
             self.print_log(
                 self.client_address,
                 "Assigned com_id %d to %s" % (certificate.com_id,
                                               certificate.name)
             )
-        elif message.type == com_structs.Message.PUBLISH:
-            files = message.content
-
+        elif not authenticated:
             self.print_log(
                 self.client_address,
-                "Publishing %d files for com_id %d" % (
-                    len(files), files[0].com_id)
+                "Refused unauthenticated %s request" % message.type
             )
-
-            self.server.publish(files)
+            message.content = None
+        elif message.type == com_structs.Message.PUBLISH:
+            files = message.content
+            com_id = message.src_com_id
+
+            if any(file.com_id != com_id for file in files):
+                self.print_log(
+                    self.client_address,
+                    "Refused to publish files for com_id %d" % com_id
+                )
+                message.content = None
+            else:
+                self.print_log(
+                    self.client_address,
+                    "Publishing %d files for com_id %d" % (len(files), com_id)
+                )
+
+                message.content = (files,
+                                   self.server.publish(com_id, files))
         elif message.type == com_structs.Message.FETCH_SP:
             self.print_log(
                 self.client_address,
-                "Sending service provider data"
+                "Sending service provider data and certificates"
             )
-            message.content = self.server.service_providers
+
+            with self.server.lock:
+                message.content = self.server.service_providers.copy()
         elif message.type == com_structs.Message.FETCH_FILE:
             self.print_log(
                 self.client_address,
                 "Sending files data"
             )
-            message.content = self.server.public_files
+
+            with self.server.lock:
+                message.content = self.server.public_files.copy()
+        elif message.type == com_structs.Message.REPLICA:
+            com_id = message.src_com_id
+            file_ids, load = message.content
+
+            self.print_log(
+                self.client_address,
+                "Registering %d replicas for com_id %d" % (
+                    len(file_ids), com_id)
+            )
+
+            self.server.register_replicas(com_id, file_ids, load)
+        elif message.type == com_structs.Message.STATS:
+            self.print_log(self.client_address, "Sending stats")
+            message.content = self.server.admission.stats()
+        elif message.type == com_structs.Message.PROFILE:
+            if not profiler.is_duration(message.content):
+                self.print_log(
+                    self.client_address,
+                    "Refused to profile for com_id %d" % message.src_com_id
+                )
+                message.content = None
+            else:
+                message.content = self.server.profiler.start(message.content)
+
+                self.print_log(
+                    self.client_address,
+                    "Profiling into %s" % message.content
+                )
         else:
             message.request = True
 
-        self.request.sendall(pickle.dumps(message))
-
     @staticmethod
     def print_log(address, string):
         """Prints log for given address and string."""
         print("%15s : %-5d - %s" % (address[0], address[1], string))
 
 
-class CentralRegistry(socketserver.TCPServer):
+class CentralRegistry(PreforkMixIn, socketserver.ThreadingMixIn,
+                      socketserver.TCPServer):
     """
     Class modelling a central registry.
 
     Implementation of a central registry as a subclass of a TCPServer.
-    The central registry serves communicator requests and on SIGINT
-    stops all of its threads.
+    The central registry serves communicator requests, each in its own
+    thread, and on SIGINT stops all of its threads. Requests can be
+    served by several worker processes sharing the registry state.
 
     Attributes:
         name: the name of this central registry
         address: tuple containing the IP address and port for this CR
-        key: RSA key object
-        certificate: shareable certificate for this CR
+        key: key object, loaded from the keystore so that certificates
+            signed before a restart stay valid, private to each process
+        certificate: shareable certificate for this CR, advertising the
+            signature schemes accepted by this CR
         binary_certificate: binary format of the certificate
         handler_thread: thread for serving communicator requests
-        com_id_counter: global communicator id counter
+        workers: number of processes serving requests
+        store: factory of the containers shared by the processes
+        counters: dictionary with the global communicator and file id
+            counters
         service_providers: a dictionary of all service providers
             indexed by com_id
-        file_id_counter: global file id counter
+        certificates: com_id indexed dictionary of signed certificates,
+            read from a cache of each process
+        keys: com_id indexed public keys imported by this process,
+            together with the signature of their certificate
         public_files: file id indexed dictionary with all publicly
             available files
+        catalogs: com_id indexed dictionary of the signed catalogs of
+            the published files
+        admission: per-peer admission control of requests, each worker
+            process enforces the budgets on its own
+        lock: lock guarding the registry state shared by the handlers
+        profiler: sampling profiler started by SIGUSR1 or PROFILE
+            requests
     """
+    daemon_threads = True
 
-    def __init__(self, name, address):
-        """Inits the object with name and address."""
+    def __init__(self, name, address, keystore, workers=1):
+        """Inits the object with name, address and keystore."""
         print("Initializing central registry %s..." % name)
         print("\t%-15s: %s:%d\n" % ("Address", address[0], address[1]))
 
         self.name = name
         self.address = address
-        self.key = com_structs.get_rsa_key()
+        self.key = keystore.load_key()
 
         self.certificate = com_structs.Certificate(
             name,
             address,
-            self.key.publickey().exportKey("PEM")
+            self.key.publickey().exportKey("PEM"),
+            scheme=self.key.scheme.name
         )
+        self.certificate.schemes = sorted(com_structs.SCHEMES)
         self.binary_certificate = pickle.dumps(self.certificate)
 
         self.handler_thread = threading.Thread(target=self.serve_forever)
 
-        self.com_id_counter = 1
-        self.service_providers = {}
+        self.workers = workers
+        self.store = store = SharedStore(workers)
+
+        self.counters = store.dict({"com_id": 1, "file_id": 1})
+        self.service_providers = store.dict()
+        self.certificates = store.cached_dict()
+        self.public_files = store.dict()
+        self.catalogs = store.dict()
+        self.keys = {}
 
-        self.file_id_counter = 1
-        self.public_files = {}
+        self.admission = AdmissionController()
+        self.lock = store.lock()
+        self.profiler = Profiler(name)
 
         socketserver.TCPServer.__init__(self, address, RequestHandler)
 
     def start(self):
         """Start handling requests."""
         print("Starting %s server..." % self.name)
+
+        self.profiler.install()
+
+        if self.workers > 1:
+            print("Forking %d worker processes..." % (self.workers - 1))
+            self.start_workers()
+
         self.handler_thread.start()
 
         print("Server thread started\n\nServing requests...")
@@ -158,6 +284,8 @@ class CentralRegistry(socketserver.TCPServer):
         """Shutdown the server."""
         print("Shutting down %s communicator handler thread..." % self.name)
         socketserver.TCPServer.shutdown(self)
+        self.stop_workers()
+        self.store.shutdown()
         print("Shutdown of %s server completed" % self.name)
 
     def signal_handler(self, signal_n, _):
@@ -174,29 +302,154 @@ class CentralRegistry(socketserver.TCPServer):
         self.shutdown()
 
     def register_certificate(self, certificate):
-        """Registers the given communicator certificate."""
-        certificate.com_id = self.com_id_counter
-        self.com_id_counter += 1
+        """
+        Registers the given communicator certificate.
+
+        A certificate which is still valid and already carries the
+        signature of this CR is registered again as it is. A certificate
+        endorsed by the previous key of a registered communicator keeps
+        its com_id. Any other certificate gets a new com_id.
+
+        Args:
+            certificate: the certificate to register
 
-        certificate.sign(self.key)
+        Returns:
+            True if the certificate was signed, False if it was reused
+        """
+        signed = not self.is_reusable(certificate)
+
+        if signed:
+            previous = self.certificates.get(certificate.com_id)
+
+            if previous is None or not certificate.verify_endorsement(
+                    com_structs.get_key(previous.public_key,
+                                        scheme=previous.scheme)):
+                with self.lock:
+                    certificate.com_id = self.counters["com_id"]
+                    self.counters["com_id"] += 1
+
+            certificate.valid_until = \
+                time.time() + com_structs.CERTIFICATE_LIFETIME
+
+            with tracer.span("sign certificate"):
+                certificate.sign(self.key)
 
         descriptor = SPDescriptor(
             certificate.com_id,
             certificate.name,
-            certificate.address
+            certificate.address,
+            certificate
         )
 
-        self.service_providers[descriptor.com_id] = descriptor
+        with self.lock:
+            self.counters["com_id"] = max(self.counters["com_id"],
+                                          certificate.com_id + 1)
+            self.certificates[certificate.com_id] = certificate
+            self.service_providers[descriptor.com_id] = descriptor
+
+        return signed
+
+    def is_reusable(self, certificate):
+        """Checks if the certificate was signed by this CR and is valid."""
+        if certificate.signature is None or not certificate.is_valid():
+            return False
 
-    def publish(self, files):
-        """Adds the given files to the publicly available files."""
-        for file_descriptor in files:
-            file_descriptor.file_id = self.file_id_counter
-            self.file_id_counter += 1
-            self.public_files[file_descriptor.file_id] = file_descriptor
+        registered = self.certificates.get(certificate.com_id)
 
+        if registered is not None and \
+                registered.public_key != certificate.public_key:
+            return False
 
-def main(name, ip_address, port):
+        return certificate.verify(self.key)
+
+    def authenticate(self, message):
+        """
+        Checks that a request was signed by the communicator it claims.
+
+        Args:
+            message: the received request
+
+        Returns:
+            True if the request is signed with the key of the valid
+            certificate registered for its src_com_id, False otherwise
+        """
+        if not isinstance(message, com_structs.SignedRequest):
+            return False
+
+        certificate = self.certificates.get(message.src_com_id)
+
+        if certificate is None or not certificate.is_valid():
+            return False
+
+        cached = self.keys.get(message.src_com_id)
+
+        if cached is None or cached[0] != certificate.signature:
+            cached = (certificate.signature,
+                      com_structs.get_key(certificate.public_key,
+                                          scheme=certificate.scheme))
+            self.keys[message.src_com_id] = cached
+
+        with tracer.span("verify request"):
+            return message.verify(cached[1])
+
+    def publish(self, com_id, files):
+        """
+        Adds the given files to the publicly available files.
+
+        Args:
+            com_id: authenticated com id of the service provider
+            files: file descriptors of the service provider
+
+        Returns:
+            the signed catalog of all the files published by the
+            service provider, None if no files were given
+        """
+        if not files:
+            return None
+
+        with self.lock:
+            for file_descriptor in files:
+                file_descriptor.file_id = self.counters["file_id"]
+                self.counters["file_id"] += 1
+                self.public_files[file_descriptor.file_id] = file_descriptor
+
+            previous = self.catalogs.get(com_id)
+            catalog = com_structs.Catalog(
+                com_id,
+                (previous.files if previous is not None else []) + files
+            )
+
+            with tracer.span("sign catalog"):
+                catalog.sign(self.key)
+
+            self.catalogs[com_id] = catalog
+
+        return catalog
+
+    def register_replicas(self, com_id, file_ids, load):
+        """Records the load of a SP and the replicas it holds."""
+        with self.lock:
+            descriptor = self.service_providers.get(com_id)
+
+            if descriptor is None:
+                return
+
+            descriptor.load = load
+            self.service_providers[com_id] = descriptor
+
+            for file_id in file_ids:
+                file_descriptor = self.public_files.get(file_id)
+
+                if file_descriptor is None or \
+                        file_descriptor.com_id == com_id:
+                    continue
+
+                if com_id not in file_descriptor.replicas:
+                    file_descriptor.replicas.append(com_id)
+                    self.public_files[file_id] = file_descriptor
+
+
+def main(name, ip_address, port, workers=1):
     """
     Main function of this script.
 
@@ -207,9 +460,14 @@ def main(name, ip_address, port):
         name: the name of the central registry
         ip: the ip address of the central registry
         port: the port of the central registry
+        workers: number of processes serving requests
     """
     address = (ip_address, int(port))
-    central_registry = CentralRegistry(name, address)
+    tracing.configure(name)
+
+    central_registry = CentralRegistry(name, address,
+                                       KeyStore.for_entity(name),
+                                       int(workers))
 
     signal_blocker = lambda s, f: print("Blocking the signal")
     signal.signal(signal.SIGINT, signal_blocker)
@@ -218,7 +476,7 @@ def main(name, ip_address, port):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
+    if len(sys.argv) not in (4, 5):
         print(__doc__)
         exit(1)
 
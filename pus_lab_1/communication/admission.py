@@ -0,0 +1,183 @@
+"""Module containing per-peer admission control for CR and SP servers."""
+__author__ = 'Luka Sterbic'
+
+import time
+import threading
+from collections import Counter, defaultdict
+
+from communication.com_structs import Message
+
+CONCURRENCY_RETRY = 0.1
+SWEEP_INTERVAL = 60.0
+USAGE_LIFETIME = 600.0
+
+# Message types handled for peers which cannot authenticate yet
+BOOTSTRAP = {Message.CERTIFICATE, Message.SIGN}
+
+# Budgets per message type: requests per second, burst size and maximum
+# number of requests of that type a single peer may have in progress
+DEFAULT_BUDGETS = {
+    Message.CERTIFICATE: (5.0, 10, 2),
+    Message.SIGN: (0.5, 3, 1),
+    Message.PUBLISH: (1.0, 5, 1),
+    Message.FETCH_SP: (5.0, 10, 2),
+    Message.FETCH_FILE: (10.0, 20, 4),
+    Message.REPLICA: (5.0, 20, 2),
+    Message.STATS: (1.0, 5, 1),
+    Message.GOSSIP: (2.0, 10, 2),
+    Message.PROFILE: (0.1, 1, 1)
+}
+DEFAULT_BUDGET = (5.0, 10, 2)
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    The bucket holds up to burst tokens and is refilled with rate tokens
+    per second. Each admitted request takes one token.
+
+    Attributes:
+        rate: the number of tokens added per second
+        burst: the capacity of the bucket
+        tokens: the number of tokens currently in the bucket
+        updated: timestamp of the last refill
+    """
+    def __init__(self, rate, burst):
+        """Inits a full bucket with the given rate and capacity."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self):
+        """
+        Attempts to take a token from the bucket.
+
+        Returns:
+            None if a token was taken, otherwise the number of seconds
+            after which the next token will be available
+        """
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+
+        return (1 - self.tokens) / self.rate
+
+    def is_idle(self, now):
+        """Returns True if the bucket has been refilled to its capacity."""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class AdmissionController(object):
+    """
+    Per-peer admission control for server request handlers.
+
+    Each peer gets a token bucket and a concurrency quota for each
+    message type. Peers are identified by the com id of signed requests
+    once the signature has been verified, so communicators sharing a
+    host get separate budgets. Only requests which cannot be
+    authenticated, such as the bootstrap messages, are accounted to the
+    IP address of the peer. Requests over budget are rejected with a
+    hint of when they may be retried. Buckets which have refilled and
+    have no request in progress are evicted periodically, since a full
+    bucket is the same as a new one, as are the usage counters of peers
+    not seen for USAGE_LIFETIME seconds.
+
+    Attributes:
+        budgets: message type indexed dictionary of budgets
+        buckets: token buckets indexed by peer and message type
+        in_flight: requests in progress indexed by peer and message type
+        usage: peer indexed dictionary of admitted and rejected request
+            counters
+        seen: peer indexed timestamps of the last request
+        swept: timestamp of the last eviction of idle buckets
+        lock: lock guarding the state of the controller
+    """
+    def __init__(self, budgets=None):
+        """Inits the controller with the given budgets."""
+        self.budgets = budgets if budgets is not None else DEFAULT_BUDGETS
+        self.buckets = {}
+        self.in_flight = Counter()
+        self.usage = defaultdict(Counter)
+        self.seen = {}
+        self.swept = time.time()
+        self.lock = threading.Lock()
+
+    def admit(self, peer, msg_type):
+        """
+        Decides if a request of the given peer can be handled.
+
+        Admitted requests must be released with the release() method
+        once they are handled.
+
+        Args:
+            peer: the authenticated com id of the requesting peer or
+                its IP address
+            msg_type: the type of the request
+
+        Returns:
+            None if the request is admitted, otherwise the number of
+            seconds after which it should be retried
+        """
+        rate, burst, concurrency = self.budgets.get(msg_type, DEFAULT_BUDGET)
+        key = (peer, msg_type)
+
+        with self.lock:
+            self.__sweep()
+            self.seen[peer] = time.time()
+
+            if self.in_flight[key] >= concurrency:
+                retry_after = CONCURRENCY_RETRY
+            else:
+                if key not in self.buckets:
+                    self.buckets[key] = TokenBucket(rate, burst)
+
+                retry_after = self.buckets[key].take()
+
+            if retry_after is None:
+                self.in_flight[key] += 1
+                self.usage[peer][msg_type + " admitted"] += 1
+            else:
+                self.usage[peer][msg_type + " rejected"] += 1
+
+        return retry_after
+
+    def release(self, peer, msg_type):
+        """Marks an admitted request of the given peer as handled."""
+        key = (peer, msg_type)
+
+        with self.lock:
+            self.in_flight[key] -= 1
+
+            if not self.in_flight[key]:
+                del self.in_flight[key]
+
+    def __sweep(self):
+        """Evicts idle buckets and usage, called with the lock held."""
+        now = time.time()
+
+        if now - self.swept < SWEEP_INTERVAL:
+            return
+
+        self.swept = now
+
+        for key in [key for key, bucket in self.buckets.items()
+                    if key not in self.in_flight and bucket.is_idle(now)]:
+            del self.buckets[key]
+
+        for peer in [peer for peer, seen in self.seen.items()
+                     if now - seen > USAGE_LIFETIME]:
+            del self.seen[peer]
+            self.usage.pop(peer, None)
+
+    def stats(self):
+        """Returns a copy of the usage counters of all peers."""
+        with self.lock:
+            return dict((peer, dict(usage))
+                        for peer, usage in self.usage.items())
@@ -1,11 +1,27 @@
 """Module containing classes and methods for SP/CR communication."""
 __author__ = 'Luka Sterbic'
 
+import os
+import abc
+import time
+import pickle
+import struct
+
 from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 
-RSA_KEY_BITS = 1024
+try:
+    from Crypto.PublicKey import ECC
+    from Crypto.Signature import DSS, eddsa
+except ImportError:
+    ECC = None
+
 BUFFER_SIZE = 4096
+LENGTH_FORMAT = "!I"
+NONCE_SIZE = 16
+CERTIFICATE_LIFETIME = 7 * 24 * 3600
+REQUEST_LIFETIME = 60
 
 
 class Certificate(object):
@@ -22,27 +38,56 @@ class Certificate(object):
         address: tuple containing ip address and port of the holder
         public_key: pem formatted public key of the holder
         com_id: central registry issued id if available
+        valid_until: expiration timestamp set by the central registry
+        endorsement: signature made with the previous key of the
+            holder when the certificate replaces a rotated key
+        scheme: name of the signature scheme of the public key
+        schemes: names of the schemes accepted by the holder, advertised
+            by the central registry
     """
-    def __init__(self, name, address, public_key, com_id=0):
+    def __init__(self, name, address, public_key, com_id=0,
+                 scheme=None):
         """Inits the object with name and public key."""
         self.name = name
         self.address = address
         self.public_key = public_key
         self.signature = None
         self.com_id = com_id
+        self.valid_until = None
+        self.endorsement = None
+        self.scheme = scheme or DEFAULT_SCHEME
+        self.schemes = None
 
     def sign(self, key):
         """Signs this certificate with the given private key."""
-        self.signature = key.sign(self.hash(), b"")
+        self.signature = key.sign(self.hash())
 
     def verify(self, key):
         """Verify this certificate with the given public key."""
         return key.verify(self.hash(), self.signature)
 
+    def endorse(self, key):
+        """Endorses this certificate with the previous private key."""
+        self.endorsement = key.sign(self.hash())
+
+    def verify_endorsement(self, key):
+        """Verify the endorsement with the previous public key."""
+        if self.endorsement is None:
+            return False
+
+        return key.verify(self.hash(), self.endorsement)
+
+    def is_valid(self):
+        """Checks if the certificate has not expired yet."""
+        return self.valid_until is None or self.valid_until > time.time()
+
     def hash(self):
         """Computes the hash of this certificate."""
         sha = SHA256.new(self.name.encode("ascii"))
         sha.update(self.public_key)
+        sha.update(("%d %r %s %s %d" % (
+            self.com_id, self.valid_until, self.scheme,
+            self.address[0], self.address[1])).encode("ascii"))
         return sha.digest()
 
 
@@ -57,21 +102,47 @@ class Message(object):
         msg_type: the type of the message, should be in TYPES
         content: the content of the message
         request: true if the message is a request, false otherwise
+        src_com_id: com id of the sender, 0 if not registered yet
+        trace_id: id of the trace the message belongs to, if traced
+        span_id: id of the span which sent the message, if traced
     """
     CERTIFICATE = "CERTIFICATE"
     SIGN = "SIGN"
     PUBLISH = "PUBLISH"
     FETCH_SP = "FETCH_SP"
     FETCH_FILE = "FETCH_FILE"
-    TYPES = {CERTIFICATE, SIGN, PUBLISH, FETCH_SP, FETCH_FILE}
+    REPLICA = "REPLICA"
+    STATS = "STATS"
+    REJECT = "REJECT"
+    GOSSIP = "GOSSIP"
+    PROFILE = "PROFILE"
+    TYPES = {CERTIFICATE, SIGN, PUBLISH, FETCH_SP, FETCH_FILE, REPLICA,
+             STATS, REJECT, GOSSIP, PROFILE}
 
-    def __init__(self, msg_type, content=None, request=True):
+    def __init__(self, msg_type, content=None, request=True, src_com_id=0):
         if msg_type not in Message.TYPES:
             raise ValueError("Unknown message type.")
 
         self.type = msg_type
         self.content = content
         self.request = request
+        self.src_com_id = src_com_id
+        self.trace_id = None
+        self.span_id = None
+
+
+class RejectedError(ConnectionError):
+    """
+    Error raised when a server rejects a request over its budget.
+
+    Attributes:
+        retry_after: seconds after which the request may be retried
+    """
+    def __init__(self, retry_after):
+        """Inits the error with the retry hint of the server."""
+        ConnectionError.__init__(
+            self, "Request rejected, retry after %.2f s" % retry_after)
+        self.retry_after = retry_after
 
 
 class FileRequest(Message):
@@ -81,23 +152,37 @@ class FileRequest(Message):
     This class is used in the file transfer protocol between two
     communicators. It extends the basic communication class Message
     and ads functionality for hashing, signing and verifying the
-    content of the request.
+    request.
+
+    The file content is not hashed per request. The reply carries the
+    signed manifest of the owner of the file and the digest of the
+    content from the manifest, while the signature of the request only
+    binds a fresh nonce to that digest.
 
     Attributes:
         buffer: the file buffer used in the request
         src_com_id: com id of the entity that made the request
         username: name of the user that made the request
+        certificate: certificate of the requesting entity, attached on
+            the first request to a communicator that does not know it
+        nonce: random bytes chosen by the requesting entity
+        digest: content digest of the file, set in the reply
+        manifest: signed manifest of the owner, set in the reply
     """
-    def __init__(self, buffer, src_com_id, username):
+    def __init__(self, buffer, src_com_id, username, certificate=None):
         """Inits the object with content and username."""
         self.username = username
-        self.src_com_id = src_com_id
+        self.certificate = certificate
         self.signature = None
-        Message.__init__(self, Message.FETCH_FILE, buffer)
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.digest = None
+        self.manifest = None
+        Message.__init__(self, Message.FETCH_FILE, buffer,
+                         src_com_id=src_com_id)
 
     def sign(self, key):
         """Signs this certificate with the given private key."""
-        self.signature = key.sign(self.hash(), b"")
+        self.signature = key.sign(self.hash())
 
     def verify(self, key):
         """Verify this certificate with the given public key."""
@@ -107,10 +192,10 @@ class FileRequest(Message):
         """Computes the hash of this file request."""
         sha = SHA256.new(self.username.encode("ascii"))
         sha.update(self.type.encode("ascii"))
+        sha.update(self.nonce)
 
-        if self.content.lines:
-            for line in self.content.lines:
-                sha.update(line.encode("ascii"))
+        if self.digest is not None:
+            sha.update(self.digest)
 
         descriptor = self.content.descriptor
 
@@ -125,20 +210,526 @@ class FileRequest(Message):
         return sha.digest()
 
 
-def get_rsa_key(pem=None):
+class SignedRequest(Message):
+    """
+    Class implementing a request signed by a registered communicator.
+
+    Requests which change the state of the receiver, or use up its
+    resources, are signed with the key of the sender. The receiver can
+    then check the com id declared by the sender against the
+    certificate registered for it. The signature covers a fresh nonce
+    and the time at which the request was issued, requests older than
+    REQUEST_LIFETIME seconds are refused.
+
+    Attributes:
+        certificate: certificate of the requesting entity, attached
+            when the receiver may not know it yet
+        nonce: random bytes chosen by the requesting entity
+        issued: timestamp at which the request was signed
+        signature: signature of the requesting entity
+    """
+    def __init__(self, msg_type, content, src_com_id, certificate=None):
+        """Inits the request with type, content and sender."""
+        self.certificate = certificate
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.issued = time.time()
+        self.signature = None
+        Message.__init__(self, msg_type, content, src_com_id=src_com_id)
+
+    def sign(self, key):
+        """Signs this request with the given private key."""
+        self.signature = key.sign(self.hash())
+
+    def verify(self, key):
+        """Verify this request with the given public key."""
+        if self.signature is None or \
+                abs(time.time() - self.issued) > REQUEST_LIFETIME:
+            return False
+
+        return key.verify(self.hash(), self.signature)
+
+    def hash(self):
+        """Computes the hash of this request."""
+        sha = SHA256.new(("%s %d %r" % (self.type, self.src_com_id,
+                                        self.issued)).encode("ascii"))
+        sha.update(self.nonce)
+
+        if self.type == Message.PUBLISH:
+            for file in self.content:
+                sha.update(("%d\n%s\n%s\n%s\n" % (
+                    file.com_id, file.name, file.author,
+                    file.description)).encode("utf-8"))
+        elif self.type != Message.GOSSIP:
+            # Gossiped entries are signed by the CR and their providers
+            sha.update(repr(self.content).encode("utf-8"))
+
+        return sha.digest()
+
+
+class Manifest(object):
+    """
+    Signed manifest of the files published by a service provider.
+
+    The manifest maps the id of each published file to the SHA-256
+    digest of its content. Entries are updated only when a file
+    changes and the manifest is signed once per version, so serving a
+    file does not require hashing or signing its content.
+
+    Attributes:
+        com_id: com id of the owner of the files
+        version: counter incremented on every change of an entry
+        entries: file id indexed dictionary of content digests
+        signature: signature of the owner over the current version
+    """
+    def __init__(self, com_id):
+        """Inits an empty manifest for the given owner."""
+        self.com_id = com_id
+        self.version = 0
+        self.entries = {}
+        self.signature = None
+
+    def update(self, file_id, digest):
+        """Sets the digest of a file, invalidating the signature."""
+        if self.entries.get(file_id) == digest:
+            return False
+
+        self.entries[file_id] = digest
+        self.version += 1
+        self.signature = None
+
+        return True
+
+    def sign(self, key):
+        """Signs this manifest with the given private key."""
+        self.signature = key.sign(self.hash())
+
+    def verify(self, key):
+        """Verify this manifest with the given public key."""
+        if self.signature is None:
+            return False
+
+        return key.verify(self.hash(), self.signature)
+
+    def hash(self):
+        """Computes the hash of this manifest."""
+        sha = SHA256.new(("%d %d" % (self.com_id, self.version))
+                         .encode("ascii"))
+
+        for file_id in sorted(self.entries):
+            sha.update(("%d" % file_id).encode("ascii"))
+            sha.update(self.entries[file_id])
+
+        return sha.digest()
+
+
+class Catalog(object):
+    """
+    Catalog of the files published by a service provider.
+
+    The catalog is signed by the central registry when the files are
+    published, so it can be passed between service providers without
+    contacting the central registry again. A catalog replaces all the
+    catalogs of the same provider issued before it.
+
+    Attributes:
+        com_id: com id of the owner of the files
+        files: the published file descriptors
+        issued: timestamp at which the central registry issued it
+        signature: signature of the central registry
+    """
+    def __init__(self, com_id, files):
+        """Inits the catalog with the given owner and files."""
+        self.com_id = com_id
+        self.files = files
+        self.issued = time.time()
+        self.signature = None
+
+    def sign(self, key):
+        """Signs this catalog with the given private key."""
+        self.signature = key.sign(self.hash())
+
+    def verify(self, key):
+        """Verify this catalog with the given public key."""
+        return key.verify(self.hash(), self.signature)
+
+    def hash(self):
+        """Computes the hash of this catalog."""
+        sha = SHA256.new(("%d %r" % (self.com_id, self.issued))
+                         .encode("ascii"))
+
+        for file in self.files:
+            sha.update(("%d %d\n%s\n%s\n%s\n" % (
+                file.file_id, file.com_id, file.name, file.author,
+                file.description)).encode("utf-8"))
+
+        return sha.digest()
+
+
+def content_digest(lines):
+    """Computes the SHA-256 digest of the given lines of a file."""
+    sha = SHA256.new()
+
+    for line in lines:
+        sha.update(line.encode("ascii"))
+
+    return sha.digest()
+
+
+class SignatureScheme(object, metaclass=abc.ABCMeta):
+    """
+    Base class of the signature schemes used by CR and SP entities.
+
+    A scheme generates, imports and exports keys and signs and verifies
+    digests computed by the hash() methods of the signed structures.
+    Keys are the objects of the underlying library, they are wrapped in
+    Key objects by the get_key() function.
+
+    Attributes:
+        name: the identifier of the scheme carried in certificates
+    """
+    name = None
+
+    @abc.abstractmethod
+    def generate(self):
+        """
+        Generates a new private key.
+
+        Returns:
+            the private key object of the scheme
+        """
+
+    @abc.abstractmethod
+    def import_key(self, pem, passphrase=None):
+        """
+        Constructs a key from its PEM representation.
+
+        Args:
+            pem: the PEM representation of a private or public key
+            passphrase: passphrase of an encrypted private key, if any
+
+        Returns:
+            the key object of the scheme
+        """
+
+    @abc.abstractmethod
+    def export_key(self, key, passphrase=None):
+        """
+        Exports a key in PEM format.
+
+        Args:
+            key: the private or public key object of the scheme
+            passphrase: passphrase used to encrypt a private key, if any
+
+        Returns:
+            the PEM representation of the key as bytes
+        """
+
+    @abc.abstractmethod
+    def public_key(self, key):
+        """
+        Returns the public part of the given private key.
+
+        Args:
+            key: the private key object of the scheme
+
+        Returns:
+            the public key object of the scheme
+        """
+
+    @abc.abstractmethod
+    def sign(self, key, digest):
+        """
+        Signs a digest.
+
+        Args:
+            key: the private key object of the scheme
+            digest: the digest to sign as bytes
+
+        Returns:
+            the signature as bytes
+        """
+
+    @abc.abstractmethod
+    def verify(self, key, digest, signature):
+        """
+        Verifies the signature of a digest.
+
+        Args:
+            key: the public key object of the scheme
+            digest: the signed digest as bytes
+            signature: the signature to verify
+
+        Returns:
+            True if the signature is valid, False otherwise, malformed
+            signatures are reported as invalid instead of raising
+        """
+
+
+class RSAScheme(SignatureScheme):
+    """
+    PKCS#1 v1.5 RSA signatures with SHA-256.
+
+    Private keys keep their prime factors, so signing uses the Chinese
+    remainder theorem and costs about a quarter of a plain modular
+    exponentiation.
+
+    Attributes:
+        bits: the size of the modulus
+    """
+    def __init__(self, bits):
+        """Inits the scheme for the given modulus size."""
+        self.name = "rsa-%d" % bits
+        self.bits = bits
+
+    def generate(self):
+        """Generates a new private key."""
+        return RSA.generate(self.bits)
+
+    def import_key(self, pem, passphrase=None):
+        """Constructs a key from its PEM representation."""
+        return RSA.importKey(pem, passphrase)
+
+    def export_key(self, key, passphrase=None):
+        """Returns the PEM representation of the key as bytes."""
+        return key.exportKey("PEM", passphrase)
+
+    def public_key(self, key):
+        """Returns the public part of the key."""
+        return key.publickey()
+
+    def sign(self, key, digest):
+        """Signs the digest with the private key."""
+        return PKCS1_v1_5.new(key).sign(SHA256.new(digest))
+
+    def verify(self, key, digest, signature):
+        """Verifies the signature of the digest with the public key."""
+        try:
+            return bool(PKCS1_v1_5.new(key).verify(SHA256.new(digest),
+                                                   signature))
+        except (ValueError, TypeError):
+            return False
+
+
+class ECCScheme(SignatureScheme):
+    """
+    Elliptic curve signatures, available with PyCryptodome only.
+
+    ECDSA signatures are deterministic as in RFC 6979, EdDSA signatures
+    are deterministic by construction.
+
+    Attributes:
+        curve: the name of the curve
+    """
+    PROTECTION = "PBKDF2WithHMAC-SHA1AndAES128-CBC"
+
+    def __init__(self, name, curve):
+        """Inits the scheme with its name and curve."""
+        self.name = name
+        self.curve = curve
+
+    def generate(self):
+        """Generates a new private key."""
+        return ECC.generate(curve=self.curve)
+
+    def import_key(self, pem, passphrase=None):
+        """Constructs a key from its PEM representation."""
+        return ECC.import_key(pem, passphrase)
+
+    def export_key(self, key, passphrase=None):
+        """Returns the PEM representation of the key as bytes."""
+        if passphrase is None or not key.has_private():
+            pem = key.export_key(format="PEM")
+        else:
+            pem = key.export_key(format="PEM", passphrase=passphrase,
+                                 protection=ECCScheme.PROTECTION)
+
+        return pem.encode("ascii")
+
+    def public_key(self, key):
+        """Returns the public part of the key."""
+        return key.public_key()
+
+    def sign(self, key, digest):
+        """Signs the digest with the private key."""
+        return self.__signer(key).sign(self.__message(digest))
+
+    def verify(self, key, digest, signature):
+        """Verifies the signature of the digest with the public key."""
+        try:
+            self.__signer(key).verify(self.__message(digest), signature)
+            return True
+        except (ValueError, TypeError):
+            return False
+
+    def __signer(self, key):
+        """Creates the signer or verifier object for the key."""
+        if self.curve == "Ed25519":
+            return eddsa.new(key, "rfc8032")
+
+        return DSS.new(key, "deterministic-rfc6979")
+
+    def __message(self, digest):
+        """Wraps the digest as expected by the signer."""
+        if self.curve == "Ed25519":
+            return digest
+
+        return SHA256.new(digest)
+
+
+class Key(object):
     """
-    Generate a RSA key object.
+    A private or public key bound to its signature scheme.
 
-    Generate a new RSA key object or construct it from the given PEM
+    The structures signed by CR and SP entities only call the sign()
+    and verify() methods of the key, so the scheme can be changed
+    without changes at the call sites.
+
+    Attributes:
+        scheme: the signature scheme of the key
+        key: the underlying key object of the scheme
+    """
+    def __init__(self, scheme, key):
+        """Inits the object with scheme and key."""
+        self.scheme = scheme
+        self.key = key
+
+    def sign(self, digest):
+        """Signs the given digest, the key must be private."""
+        return self.scheme.sign(self.key, digest)
+
+    def verify(self, digest, signature):
+        """Verifies the signature of the given digest."""
+        if signature is None:
+            return False
+
+        return self.scheme.verify(self.key, digest, signature)
+
+    def publickey(self):
+        """Returns the public part of this key."""
+        return Key(self.scheme, self.scheme.public_key(self.key))
+
+    def exportKey(self, format="PEM", passphrase=None):
+        """Returns the PEM representation of this key as bytes."""
+        if format != "PEM":
+            raise ValueError("Unsupported key format %s." % format)
+
+        return self.scheme.export_key(self.key, passphrase)
+
+
+SCHEMES = dict((scheme.name, scheme) for scheme in (
+    RSAScheme(1024),
+    RSAScheme(2048),
+    RSAScheme(3072)
+))
+
+if ECC is not None:
+    SCHEMES.update((scheme.name, scheme) for scheme in (
+        ECCScheme("ecdsa-p256", "P-256"),
+        ECCScheme("ed25519", "Ed25519")
+    ))
+
+# Schemes from the fastest to the slowest, the first one available is
+# used unless another one is configured
+SCHEME_PREFERENCE = ["ed25519", "ecdsa-p256", "rsa-2048", "rsa-3072",
+                     "rsa-1024"]
+DEFAULT_SCHEME = [name for name in SCHEME_PREFERENCE if name in SCHEMES][0]
+
+
+def get_scheme(name):
+    """
+    Returns the signature scheme with the given name.
+
+    Raises:
+        ValueError: if the scheme is unknown or not available
+    """
+    if name not in SCHEMES:
+        raise ValueError("Unsupported signature scheme %s." % name)
+
+    return SCHEMES[name]
+
+
+def negotiate_scheme(preferred, accepted, cr_scheme=None):
+    """
+    Chooses the signature scheme of an entity.
+
+    Args:
+        preferred: name of the scheme the entity would like to use
+        accepted: names of the schemes accepted by the central
+            registry, None if it does not advertise them
+        cr_scheme: name of the scheme of the central registry key,
+            which has to be available locally to verify certificates
+
+    Returns:
+        the preferred scheme if it is accepted, otherwise the first
+        accepted scheme in the order of preference available locally
+
+    Raises:
+        ValueError: if the scheme of the central registry is not
+            available or there is no common scheme
+    """
+    if cr_scheme is not None and cr_scheme not in SCHEMES:
+        raise ValueError(
+            "The central registry signs with the %s scheme, which is not "
+            "available here. Install PyCryptodome or run the central "
+            "registry with an RSA scheme." % cr_scheme)
+
+    if accepted is None or preferred in accepted:
+        return preferred
+
+    for name in SCHEME_PREFERENCE:
+        if name in accepted and name in SCHEMES:
+            return name
+
+    raise ValueError("No common signature scheme with %s." % accepted)
+
+
+def get_key(pem=None, passphrase=None, scheme=None):
+    """
+    Generate a key object.
+
+    Generate a new key object or construct it from the given PEM
     format if the pem argument is defined.
 
     Args:
         pem: pem representation of the key
+        passphrase: passphrase of an encrypted pem representation
+        scheme: name of the signature scheme, defaults to DEFAULT_SCHEME
 
     Returns:
-        RSA key object
+        Key object
     """
+    scheme = get_scheme(scheme or DEFAULT_SCHEME)
+
     if pem is None:
-        return RSA.generate(RSA_KEY_BITS)
+        return Key(scheme, scheme.generate())
     else:
-        return RSA.importKey(pem)
+        return Key(scheme, scheme.import_key(pem, passphrase))
+
+
+def send_message(soc, message):
+    """Sends the pickled message prefixed with its length."""
+    data = pickle.dumps(message)
+    soc.sendall(struct.pack(LENGTH_FORMAT, len(data)) + data)
+
+
+def receive_message(soc):
+    """Receives a message sent with the send_message() function."""
+    header = _receive(soc, struct.calcsize(LENGTH_FORMAT))
+    length = struct.unpack(LENGTH_FORMAT, header)[0]
+    return pickle.loads(_receive(soc, length))
+
+
+def _receive(soc, length):
+    """Receives exactly the given number of bytes."""
+    chunks = []
+
+    while length:
+        chunk = soc.recv(min(length, BUFFER_SIZE))
+
+        if not chunk:
+            raise ConnectionError("Connection closed while receiving.")
+
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return b"".join(chunks)
@@ -1,13 +1,37 @@
 """Module containing the Communicator server class."""
 __author__ = 'Luka Sterbic'
 
-import pickle
+import copy
+import queue
 import threading
 import socket
 import socketserver
+import time
+from collections import deque, Counter
 
 import communication.com_structs as com
-from communication.com_structs import Message, Certificate, FileRequest
+from communication.com_structs import Message, Certificate, FileRequest, \
+    Manifest
+from communication.deadline import Deadline
+from communication.admission import AdmissionController, BOOTSTRAP
+from communication.prefork import PreforkMixIn, SharedStore
+from communication.gossip import Directory, Gossiper, PeerEntry, PeerStatus
+from communication.tracing import tracer
+from profiler import is_duration
+
+LOAD_WINDOW = 10.0
+LATENCY_WEIGHT = 0.3
+DEFAULT_LATENCY = 0.1
+
+DEFAULT_TIMEOUT = 5.0
+ADVERTISE_TIMEOUT = 1.0
+MAX_ATTEMPTS = 3
+RETRYABLE = {Message.CERTIFICATE, Message.FETCH_SP, Message.FETCH_FILE,
+             Message.REPLICA}
+
+LATENCY_SAMPLES = 100
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
 
 
 class CommunicatorHandler(socketserver.BaseRequestHandler):
@@ -15,13 +39,38 @@ class CommunicatorHandler(socketserver.BaseRequestHandler):
     Handler for requests received by the Communicator class.
 
     This class implements a handler for the exchange of certificates
-    verified by the central registry.
+    verified by the central registry, for file requests, which are
+    served from local files or from verified replicas, for gossip
+    messages and for requests to profile the process. Apart from the
+    certificate exchange, requests have to be signed by the communicator
+    they claim to come from. Requests over the budget of their peer,
+    the authenticated com id or the IP address for requests which are
+    not authenticated, are rejected with a REJECT message.
     """
     def handle(self):
-        request = self.request.recv(com.BUFFER_SIZE)
-        message = pickle.loads(request)
+        message = com.receive_message(self.request)
         message.request = False
 
+        authenticated = message.type not in BOOTSTRAP and \
+            self.server.authenticate(message)
+        peer = message.src_com_id if authenticated else \
+            self.client_address[0]
+
+        with tracer.span("handle %s" % message.type, message, peer=peer):
+            retry_after = self.server.admission.admit(peer, message.type)
+
+            if retry_after is not None:
+                message = Message(Message.REJECT, retry_after, False)
+            else:
+                try:
+                    self.dispatch(message, authenticated)
+                finally:
+                    self.server.admission.release(peer, message.type)
+
+            com.send_message(self.request, message)
+
+    def dispatch(self, message, authenticated):
+        """Handles an admitted message and sets the reply content."""
         if message.type == Message.CERTIFICATE:
             certificate = message.content
 
@@ -29,183 +78,958 @@ class CommunicatorHandler(socketserver.BaseRequestHandler):
                 message.content = self.server.certificate
             else:
                 message.content = None
+        elif not authenticated:
+            message.content = None
+            message.request = True
         elif message.type == Message.FETCH_FILE:
-            key = self.server.com_keys[message.src_com_id]
-
-            if message.verify(key):
-                self.server.loader(message.content)
-                message.sign(self.server.key)
+            if self.server.serve(message):
+                with tracer.span("sign reply"):
+                    message.sign(self.server.current_key())
             else:
                 message.request = True
+        elif message.type == Message.STATS:
+            message.content = self.server.admission.stats()
+        elif message.type == Message.GOSSIP and \
+                self.server.gossiper is not None:
+            message.content = self.server.gossiper.receive(message.content)
+        elif message.type == Message.PROFILE:
+            profiler = self.server.profiler
 
-        self.request.sendall(pickle.dumps(message))
+            if profiler is None or not is_duration(message.content):
+                message.content = None
+            else:
+                message.content = profiler.start(message.content)
+        else:
+            message.request = True
 
 
-class Communicator(socketserver.TCPServer):
+class Communicator(PreforkMixIn, socketserver.ThreadingMixIn,
+                   socketserver.TCPServer):
     """
     Communication middleware for service providers.
 
     This class handles the communication in the public key
     infrastructure backed by a central registry. Each instance creates
-    its pair of RSA key and its certificate which is validates by the
+    its key pair and its certificate which is validates by the
     central registry. Validated certificates can be exchanged between
     communicators without the need to contact the central registry.
 
+    Requests of other communicators can be served by several worker
+    processes. Certificates, replicas and the manifest are then kept in
+    a shared store, while imported keys are cached by each process.
+
+    With gossip enabled, communicators spread the certificates and file
+    catalogs signed by the central registry and their own load and
+    replicas among themselves. The central registry is then contacted
+    only to publish files, to sign certificates and to find the first
+    peers.
+
     Attributes:
         name: the name of the entity using this communicator
         address: tuple containing the IP address and port of the
             entity using this communicator
         cr_address: tuple containing the CRs IP address and port
         loader: loader function for filling file buffer content
-        key: RSA key object
+        keystore: on-disk store of the key and certificate
+        key: key object of the signature scheme negotiated with the CR
         certificate: the certificate of this communicator
         com_certificates: com id indexed dictionary with certificates of
-            the other communicators
+            the other communicators, read from a cache of each process
         com_keys: com id indexed dictionary of all other communicators
-            public keys
+            public keys, together with the signature of the certificate
+            they were imported from
         communicators: com id indexed dictionary of all other known
             communicators
+        introduced: com ids of the communicators known to hold the
+            certificate of this communicator
         cr_certificate: certificate of the CR
         cr_key: public key of the CR
+        catalog: dictionary with the manifest of the files of this
+            communicator, its copy taken when last signed, which is
+            attached to the replies to file requests, and the current
+            certificate of this communicator
+        manifest_lock: lock guarding the updates of the catalog
+        manifests: com id indexed dictionary of verified manifests of
+            the other communicators
+        replicas: file id indexed dictionary of verified buffers of
+            remote files served on behalf of their owners, together
+            with the manifest of the owner
+        latencies: com id indexed dictionary with a moving average of
+            the file request latency of other communicators
+        served: timestamps of recently served file requests
+        timeout: default deadline in seconds of every network call
+        hedge: if True a slow file request is hedged with a request to
+            the next best source
+        samples: latencies of recent file requests
+        stats: counters of timeouts, retries, rejections, failed
+            verifications and hedged requests
+        admission: per-peer admission control of received requests,
+            each worker process enforces the budgets on its own
+        workers: number of processes serving requests
+        store: factory of the containers shared by the processes
+        directory: gossip directory of the known communicators, None
+            if gossip is disabled
+        gossiper: spreads the gossip directory, None if gossip is
+            disabled
+        profiler: sampling profiler started by PROFILE requests, if any
         handler_thread: handles requests from other communicators
     """
+    daemon_threads = True
 
-    def __init__(self, name, address, cr_address, loader):
+    def __init__(self, name, address, cr_address, loader, keystore,
+                 timeout=DEFAULT_TIMEOUT, hedge=False, workers=1,
+                 gossip=False, profiler=None):
         """Inits the object with name, address and CR address."""
         self.name = name
         self.address = address
         self.cr_address = cr_address
         self.loader = loader
+        self.keystore = keystore
 
-        self.key = com.get_rsa_key()
-        self.certificate = Certificate(
-            name,
-            address,
-            self.key.publickey().exportKey('PEM')
-        )
-        self.com_certificates = {}
+        self.timeout = timeout
+        self.hedge = hedge
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.admission = AdmissionController()
+
+        self.workers = workers
+        self.store = store = SharedStore(workers)
+
+        self.certificate = None
+        self.com_certificates = store.cached_dict()
         self.com_keys = {}
         self.communicators = {}
+        self.introduced = set()
+
+        self.replicas = store.dict()
+        self.latencies = {}
+        self.served = deque()
 
         print("\nQuerying CR for its certificate...")
         self.cr_certificate = self.__get_certificate(cr_address)
         print("Received certificate for central registry %s\n"
               % self.cr_certificate.name)
 
-        self.cr_key = com.get_rsa_key(self.cr_certificate.public_key)
+        keystore.scheme = com.negotiate_scheme(keystore.scheme,
+                                               self.cr_certificate.schemes,
+                                               self.cr_certificate.scheme)
+
+        self.cr_key = com.get_key(self.cr_certificate.public_key,
+                                  scheme=self.cr_certificate.scheme)
+        print("Using signature scheme %s" % keystore.scheme)
+
+        self.key = keystore.load_key()
+        self.certificate = Certificate(
+            name,
+            address,
+            self.key.publickey().exportKey('PEM'),
+            scheme=self.key.scheme.name
+        )
+
+        stored = keystore.load_certificate(self.certificate, self.cr_key)
+
+        if stored is not None:
+            print("Found stored certificate with global id %d"
+                  % stored.com_id)
+            self.certificate = stored
 
         print("Requesting certificate signature for %s..." % name)
         self.certificate = self.__sign_certificate()
+        keystore.save_certificate(self.certificate)
         print("Received certificate signed by %s" % self.cr_certificate.name)
         print("Received global id %d\n" % self.certificate.com_id)
 
+        self.catalog = store.dict({
+            "manifest": Manifest(self.certificate.com_id),
+            "snapshot": None,
+            "certificate": self.certificate
+        })
+        self.manifest_lock = store.lock()
+        self.manifests = {}
+
+        self.directory = None
+        self.gossiper = None
+        self.profiler = profiler
+
+        if gossip:
+            self.directory = Directory(store, self.cr_key,
+                                       self.certificate.com_id)
+            self.directory.update_own(certificate=self.certificate)
+            self.gossiper = Gossiper(self.directory, self.__gossip,
+                                     self.__bootstrap)
+
         self.handler_thread = threading.Thread(target=self.serve_forever)
 
         socketserver.TCPServer.__init__(self, address, CommunicatorHandler)
 
-    def __sign_certificate(self):
-        """Signs the certificate of this communicator."""
-        message = Message(Message.SIGN, self.certificate)
+    def __sign_certificate(self, certificate=None):
+        """Signs the given certificate, by default of this communicator."""
+        message = Message(Message.SIGN, certificate or self.certificate)
         return self.__send_and_get_reply(message, self.cr_address)
 
-    def __exchange_certificate(self, com_address):
+    def rotate_key(self):
+        """
+        Replaces the key of this communicator keeping its com id.
+
+        The new certificate is signed by the CR before anything is
+        replaced, so a failed rotation leaves the current key and
+        certificate in use.
+
+        Returns:
+            True if the key was rotated, False if the CR did not sign
+            the new certificate
+        """
+        key = self.keystore.new_key()
+
+        certificate = Certificate(
+            self.name,
+            self.address,
+            key.publickey().exportKey('PEM'),
+            self.certificate.com_id,
+            key.scheme.name
+        )
+        certificate.endorse(self.key)
+
+        try:
+            signed = self.__sign_certificate(certificate)
+        except OSError as error:
+            print("Certificate signature failed: %s" % error)
+            return False
+
+        if signed is None or signed.signature is None or \
+                signed.public_key != certificate.public_key or \
+                not signed.verify(self.cr_key):
+            print("The CR did not sign the new certificate")
+            return False
+
+        self.keystore.save_key(key)
+        self.keystore.save_certificate(signed)
+
+        self.key, self.certificate = key, signed
+        self.introduced.clear()
+
+        with self.manifest_lock:
+            manifest = self.catalog["manifest"]
+            manifest.signature = None
+
+            self.catalog["manifest"] = manifest
+            self.catalog["certificate"] = self.certificate
+
+        if self.directory is not None:
+            self.directory.update_own(certificate=self.certificate)
+            self.__report(list(self.replicas.keys()))
+
+        return True
+
+    def current_key(self):
+        """Returns the key, reloading it if rotated by another process."""
+        certificate = self.catalog["certificate"]
+
+        if certificate.signature != self.certificate.signature:
+            self.key = self.keystore.load_key()
+            self.certificate = certificate
+
+        return self.key
+
+    def __exchange_certificate(self, com_address, deadline):
         """Attempts to exchange certificates with another entity."""
-        com_certificate = self.__get_certificate(com_address, self.certificate)
-        return self.register_certificate(com_certificate)
+        with tracer.span("exchange certificate"):
+            com_certificate = self.__get_certificate(
+                com_address,
+                self.certificate,
+                deadline
+            )
+
+            if not self.register_certificate(com_certificate):
+                return False
+
+            self.introduced.add(com_certificate.com_id)
+            return True
 
     def register_certificate(self, certificate):
         """Attempts to register the given certificate."""
         if certificate is not None:
+            known = self.com_certificates.get(certificate.com_id)
+
+            if known is not None and known.signature == certificate.signature:
+                return True
+
             if certificate.verify(self.cr_key):
                 self.com_certificates[certificate.com_id] = certificate
-                self.com_keys[certificate.com_id] = com.get_rsa_key(
-                    certificate.public_key)
                 return True
 
         return False
 
+    def authenticate(self, message):
+        """
+        Checks that a request was signed by the communicator it claims.
+
+        A certificate attached to the request is registered first, so
+        the first request of a communicator which was not known yet can
+        be verified as well.
+
+        Args:
+            message: the received request
+
+        Returns:
+            True if the request is signed with the key of the certificate
+            registered for its src_com_id, False otherwise
+        """
+        if not isinstance(message, (FileRequest, com.SignedRequest)):
+            return False
+
+        if message.certificate is not None:
+            self.register_certificate(message.certificate)
+            message.certificate = None
+
+        key = self.peer_key(message.src_com_id)
+
+        if key is None:
+            return False
+
+        with tracer.span("verify request"):
+            return message.verify(key)
+
+    def peer_key(self, com_id):
+        """Returns the public key of the given communicator if known."""
+        certificate = self.com_certificates.get(com_id)
+
+        if certificate is None:
+            return None
+
+        cached = self.com_keys.get(com_id)
+
+        if cached is None or cached[0] != certificate.signature:
+            cached = (certificate.signature,
+                      com.get_key(certificate.public_key,
+                                  scheme=certificate.scheme))
+            self.com_keys[com_id] = cached
+
+        return cached[1]
+
+    def update_manifest(self, file_id, lines):
+        """Updates the manifest entry of a file after it changed."""
+        digest = com.content_digest(lines)
+
+        with self.manifest_lock:
+            manifest = self.catalog["manifest"]
+
+            if manifest.update(file_id, digest):
+                self.catalog["manifest"] = manifest
+
+    def signed_manifest(self):
+        """Returns a signed snapshot of the manifest of this communicator."""
+        with self.manifest_lock:
+            manifest = self.catalog["manifest"]
+
+            if manifest.signature is None:
+                manifest.sign(self.current_key())
+
+                self.catalog["manifest"] = manifest
+                self.catalog["snapshot"] = copy.deepcopy(manifest)
+
+            return self.catalog["snapshot"]
+
+    def serve(self, message):
+        """Fills the requested buffer from local files or a replica."""
+        self.served.append(time.time())
+        buffer = message.content
+        descriptor = buffer.descriptor
+
+        replica = self.replicas.get(descriptor.file_id)
+
+        if descriptor.com_id == self.certificate.com_id:
+            with tracer.span("load", file_id=descriptor.file_id):
+                self.loader(buffer)
+
+            message.manifest = self.signed_manifest()
+        elif replica is not None:
+            buffer.lines, message.manifest = replica
+        else:
+            return False
+
+        message.digest = message.manifest.entries.get(descriptor.file_id)
+        return message.digest is not None
+
+    @property
+    def load(self):
+        """
+        Served file requests per second over the last load window.
+
+        Each process only counts the requests it served itself. The
+        kernel spreads connections evenly across the processes
+        accepting on the socket, so the local rate is scaled by the
+        number of processes.
+        """
+        now = time.time()
+
+        while self.served and now - self.served[0] > LOAD_WINDOW:
+            self.served.popleft()
+
+        return len(self.served) * self.workers / LOAD_WINDOW
+
     def start(self):
         """Starts the communicator."""
+        if self.workers > 1:
+            print("Forking %d communicator worker processes..." % (
+                self.workers - 1))
+            self.start_workers()
+
         print("Starting communicator handler thread...")
         self.handler_thread.start()
         print("Communicator handler thread started")
 
+        if self.gossiper is not None:
+            self.gossiper.start()
+            print("Gossip with other communicators started")
+
+    def shutdown(self):
+        """Stops serving requests in all processes."""
+        socketserver.TCPServer.shutdown(self)
+        self.stop_workers()
+        self.store.shutdown()
+
     def publish(self, files):
-        """Publish all the given files on the central registry."""
+        """
+        Publish all the given files on the central registry.
+
+        The request is signed, so the central registry publishes the
+        files only under the com id of this communicator.
+
+        Raises:
+            PermissionError: if the central registry refused the files
+        """
         for file_descriptor in files:
             file_descriptor.com_id = self.certificate.com_id
 
-        message = Message(Message.PUBLISH, files)
-        return self.__send_and_get_reply(message, self.cr_address)
+        message = self.__signed_request(Message.PUBLISH, files)
+        reply = self.__send_and_get_reply(message, self.cr_address)
 
-    def fetch_remote(self):
-        """Contacts the CR for sp and file descriptor data."""
-        self.communicators = self.__send_and_get_reply(
-            Message(Message.FETCH_SP),
-            self.cr_address
-        )
-        files = self.__send_and_get_reply(
-            Message(Message.FETCH_FILE),
-            self.cr_address
-        )
+        if reply is None:
+            raise PermissionError("The central registry refused to publish "
+                                  "the files")
+
+        files, catalog = reply
+
+        if self.directory is not None and catalog is not None:
+            self.directory.update_own(catalog=catalog)
+
+        return files
+
+    def fetch_remote(self, timeout=None):
+        """
+        Gets the sp and file descriptor data.
+
+        With gossip enabled the data comes from the gossip directory,
+        the CR is contacted only while no other communicator is known.
+        """
+        with tracer.span("fetch_remote"):
+            deadline = Deadline(timeout or self.timeout)
+            self.__report([], deadline)
+
+            if self.directory is not None and self.directory.peers():
+                self.communicators = self.directory.service_providers()
+                files = self.directory.public_files()
+            else:
+                self.communicators = self.__send_and_get_reply(
+                    self.__signed_request(Message.FETCH_SP),
+                    self.cr_address,
+                    deadline
+                )
+
+                if self.directory is not None:
+                    self.__seed(self.communicators)
+
+                files = self.__send_and_get_reply(
+                    self.__signed_request(Message.FETCH_FILE),
+                    self.cr_address,
+                    deadline
+                )
+
+            for com_id, descriptor in self.communicators.items():
+                if com_id != self.certificate.com_id:
+                    self.register_certificate(descriptor.certificate)
+
+            return dict((file_id, file) for file_id, file in files.items()
+                        if file.com_id != self.certificate.com_id)
 
-        return dict((file_id, file) for file_id, file in files.items()
-                    if file.com_id != self.certificate.com_id)
+    def advertise_replica(self, buffer, manifest):
+        """
+        Holds a verified buffer and advertises it as a replica.
 
-    def fetch_file(self, buffer, username):
+        The advertisement is best effort, it is sent from a background
+        thread with its own deadline and a failure is only logged.
+        """
+        file_id = buffer.descriptor.file_id
+        self.replicas[file_id] = (buffer.lines, manifest)
+
+        def advertise():
+            try:
+                self.__report([file_id], Deadline(ADVERTISE_TIMEOUT))
+            except OSError as error:
+                print("Replica of file %d was not advertised: %s"
+                      % (file_id, error))
+
+        thread = threading.Thread(target=advertise)
+        thread.daemon = True
+        thread.start()
+
+    def rank_sources(self, descriptor):
+        """Orders the owner and replicas of a file by expected cost."""
+        sources = [descriptor.com_id]
+
+        for com_id in descriptor.replicas:
+            if com_id in self.communicators and com_id not in sources and \
+                    com_id != self.certificate.com_id:
+                sources.append(com_id)
+
+        return sorted(sources, key=self.__cost)
+
+    def fetch_file(self, buffer, username, timeout=None):
         """Fetches the content of a remote file."""
-        print("Fetching remote file %s..." % buffer.descriptor.name)
+        with tracer.span("fetch_file", file_id=buffer.descriptor.file_id):
+            print("Fetching remote file %s..." % buffer.descriptor.name)
 
-        com_id = buffer.descriptor.com_id
-        address = self.communicators[com_id].address
+            deadline = Deadline(timeout or self.timeout)
+            owner_id = buffer.descriptor.com_id
 
-        if com_id in self.com_certificates:
-            print("File is on trusted service provider %d" % com_id)
-        else:
-            print("File is on unknown service provider %d" % com_id)
-            print("Attempting certificate exchange...")
+            if not self.__trust(owner_id, deadline):
+                return None
+
+            sources = [com_id
+                       for com_id in self.rank_sources(buffer.descriptor)
+                       if com_id in self.com_certificates]
 
-            if not self.__exchange_certificate(address):
+            com_id, message = self.__request_file(sources, buffer,
+                                                  username, deadline)
+
+            if message is None:
                 return None
-            else:
-                print("Certificate exchange completed successfully")
 
+            self.advertise_replica(message.content, message.manifest)
+
+            return message.content
+
+    def __request_file(self, sources, buffer, username, deadline):
+        """
+        Requests the buffer content from the given sources.
+
+        Sources are tried in the given order, moving to the next one
+        when a source refuses the request, fails or sends a reply which
+        does not pass verification. A source which refuses a request
+        sent without the certificate of this communicator, for example
+        because it restarted, is asked once more with the certificate
+        attached. If hedging is
+        enabled and a request is slower than the configured percentile
+        of recent latencies, a second request is sent to the next source
+        and the first reply wins. The losing request is cancelled by
+        shutting down its connection.
+
+        Args:
+            sources: ranked com ids of the SPs holding the file
+            buffer: the buffer to fill
+            username: name of the user that made the request
+            deadline: deadline of the whole fetch
+
+        Returns:
+            tuple with the com id of the source and its verified reply,
+            or a tuple of None values if no source served the request
+        """
+        sources = list(sources)
+        replies = queue.Queue()
+        connections = []
+        running = 0
+        hedge_delay = self.__hedge_delay()
+        hedged_to = None
+
+        try:
+            while not deadline.expired():
+                if not running:
+                    if not sources:
+                        return None, None
+
+                    self.__launch(sources.pop(0), buffer, username,
+                                  deadline, replies, connections)
+                    running += 1
+
+                wait = deadline.remaining()
+
+                if hedge_delay is not None and sources:
+                    wait = min(wait, hedge_delay)
+
+                try:
+                    com_id, reply, latency = replies.get(timeout=wait)
+                except queue.Empty:
+                    if hedge_delay is not None and sources and \
+                            not deadline.expired():
+                        hedged_to = sources.pop(0)
+                        hedge_delay = None
+
+                        print("Hedging request to service provider %d"
+                              % hedged_to)
+                        self.count("hedges")
+
+                        self.__launch(hedged_to, buffer, username,
+                                      deadline, replies, connections)
+                        running += 1
+
+                    continue
+
+                running -= 1
+
+                if isinstance(reply, socket.timeout):
+                    print("Service provider %d timed out" % com_id)
+                    self.count("timeouts")
+                    continue
+                elif isinstance(reply, OSError):
+                    print("Service provider %d is unreachable" % com_id)
+                    continue
+
+                self.__record_latency(com_id, latency)
+
+                if reply.type == Message.REJECT:
+                    print("Service provider %d is overloaded" % com_id)
+                    self.count("rejections")
+                    continue
+
+                if reply.request:
+                    print("Service provider %d refused request" % com_id)
+
+                    if com_id in self.introduced:
+                        print("Resending request with the certificate")
+                        self.introduced.discard(com_id)
+                        sources.insert(0, com_id)
+
+                    continue
+
+                print("Verifying received message...")
+
+                if not self.__verify_reply(com_id, reply,
+                                           buffer.descriptor.com_id):
+                    print("Message verification failed")
+                    self.count("verification_failures")
+                    continue
+
+                print("Message verified successfully")
+
+                if com_id == hedged_to:
+                    self.count("hedge_wins")
+
+                self.introduced.add(com_id)
+                return com_id, reply
+
+            print("Deadline exceeded while fetching the file")
+            self.count("timeouts")
+            return None, None
+        finally:
+            for connection in connections:
+                if connection:
+                    self.__cancel(connection[0])
+
+    def __launch(self, com_id, buffer, username, deadline, replies,
+                 connections):
+        """Starts a file request to the given SP in a new thread."""
         message = FileRequest(buffer, self.certificate.com_id, username)
         message.sign(self.key)
 
-        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        soc.connect(address)
+        if com_id not in self.introduced:
+            message.certificate = self.certificate
 
-        soc.sendall(pickle.dumps(message))
-        reply = soc.recv(com.BUFFER_SIZE)
+        connection = []
+        connections.append(connection)
+        parent = tracer.current()
 
-        message = pickle.loads(reply)
+        def request():
+            start = time.time()
 
-        if message.request:
-            print("Service provider %d refused request" % com_id)
-        else:
-            print("Verifying received message...")
+            with tracer.span("request file", parent, com_id=com_id) as span:
+                tracer.inject(message, span)
 
-            if message.verify(self.com_keys[com_id]):
-                print("Message verified successfully")
-            else:
-                print("Message verification failed")
+                try:
+                    soc = deadline.connect(
+                        self.communicators[com_id].address)
+                    connection.append(soc)
 
-        return message.content
+                    com.send_message(soc, message)
+                    reply = com.receive_message(soc)
+                except OSError as error:
+                    reply = error
+
+            replies.put((com_id, reply, time.time() - start))
+
+        thread = threading.Thread(target=request)
+        thread.daemon = True
+        thread.start()
 
     @staticmethod
-    def __get_certificate(address, content=None):
+    def __cancel(soc):
+        """Cancels a request by shutting down its connection."""
+        try:
+            soc.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        soc.close()
+
+    def __verify_reply(self, com_id, message, owner_id):
+        """Verifies the signature and the content of a reply."""
+        with tracer.span("verify reply", com_id=com_id):
+            return message.verify(self.peer_key(com_id)) and \
+                self.__verify_content(message, owner_id)
+
+    def __verify_content(self, message, owner_id):
+        """
+        Verifies the content of a reply against the owner's manifest.
+
+        The signature of a manifest is verified once per version, later
+        replies carrying the same manifest only compare digests.
+
+        Args:
+            message: the reply to a file request
+            owner_id: com id of the owner of the file
+
+        Returns:
+            True if the content matches the digest in the manifest
+        """
+        manifest = message.manifest
+
+        if manifest is None or manifest.com_id != owner_id:
+            return False
+
+        known = self.manifests.get(owner_id)
+
+        if known is None or known.version != manifest.version or \
+                known.signature != manifest.signature:
+            if not manifest.verify(self.peer_key(owner_id)):
+                return False
+
+            if known is None or known.version <= manifest.version:
+                self.manifests[owner_id] = manifest
+
+        digest = manifest.entries.get(message.content.descriptor.file_id)
+
+        return digest is not None and digest == message.digest and \
+            digest == com.content_digest(message.content.lines)
+
+    def __hedge_delay(self):
+        """Returns the latency after which a request gets hedged."""
+        if not self.hedge or len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+
+        samples = sorted(self.samples)
+        index = min(len(samples) - 1,
+                    len(samples) * HEDGE_PERCENTILE // 100)
+
+        return samples[index]
+
+    def __trust(self, com_id, deadline):
+        """Makes sure the certificate of the given SP is known."""
+        if com_id in self.com_certificates:
+            print("Service provider %d is trusted" % com_id)
+            return True
+
+        print("Service provider %d is unknown" % com_id)
+        print("Attempting certificate exchange...")
+
+        if not self.__exchange_certificate(
+                self.communicators[com_id].address, deadline):
+            return False
+
+        print("Certificate exchange completed successfully")
+        return True
+
+    def __report(self, file_ids, deadline=None):
+        """
+        Reports the current load and the given replicas.
+
+        With gossip enabled a new signed status with the load and all
+        the replicas of this communicator is spread to other
+        communicators, otherwise a signed report is sent to the CR.
+        """
+        if self.directory is not None:
+            status = PeerStatus(self.certificate.com_id, self.load,
+                                list(self.replicas.keys()))
+            status.sign(self.current_key())
+
+            entry = self.directory.update_own(status=status)
+            self.gossiper.spread({self.certificate.com_id: entry})
+            return
+
+        message = self.__signed_request(Message.REPLICA,
+                                        (file_ids, self.load))
+        return self.__send_and_get_reply(message, self.cr_address, deadline)
+
+    def __bootstrap(self):
+        """Seeds the gossip directory with the communicators of the CR."""
+        try:
+            communicators = self.__send_and_get_reply(
+                self.__signed_request(Message.FETCH_SP),
+                self.cr_address
+            )
+        except OSError:
+            return
+
+        self.__seed(communicators)
+
+    def __seed(self, communicators):
+        """Adds the given communicators to the gossip directory."""
+        self.directory.merge(dict(
+            (com_id, PeerEntry(descriptor.certificate))
+            for com_id, descriptor in communicators.items()
+        ))
+
+        own = self.directory.entries.get(self.certificate.com_id)
+        self.gossiper.spread({self.certificate.com_id: own})
+
+    def __cost(self, com_id):
+        """Estimates the cost of fetching a file from the given SP."""
+        latency = self.latencies.get(com_id, DEFAULT_LATENCY)
+        return latency * (1 + self.communicators[com_id].load)
+
+    def __record_latency(self, com_id, latency):
+        """Updates the moving average latency of the given SP."""
+        if com_id in self.latencies:
+            latency = LATENCY_WEIGHT * latency + \
+                (1 - LATENCY_WEIGHT) * self.latencies[com_id]
+
+        self.latencies[com_id] = latency
+        self.samples.append(latency)
+
+    def count(self, name):
+        """Increments the named counter in the stats."""
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def __signed_request(self, msg_type, content=None):
+        """Creates a request of the given type signed by this communicator."""
+        key = self.current_key()
+        message = com.SignedRequest(msg_type, content,
+                                    self.certificate.com_id)
+        message.sign(key)
+        return message
+
+    def __gossip(self, message, address):
+        """
+        Sends a gossip message signed by this communicator.
+
+        The certificate of this communicator is attached, since the
+        receiving communicator may not have learned about it yet.
+        """
+        request = self.__signed_request(message.type, message.content)
+        request.certificate = self.certificate
+        return self.__send_and_get_reply(request, address)
+
+    def __get_certificate(self, address, content=None, deadline=None):
         """Gets the certificate of the entity at the given address."""
         message = Message(Message.CERTIFICATE, content)
-        return Communicator.__send_and_get_reply(message, address)
+        return self.__send_and_get_reply(message, address, deadline)
 
-    @staticmethod
-    def __send_and_get_reply(message, address):
-        """Sends the given message and return the server reply."""
-        soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        soc.connect(address)
+    def __send_and_get_reply(self, message, address, deadline=None):
+        """
+        Sends the given message and return the server reply.
+
+        Requests which are safe to repeat are retried with a jittered
+        backoff until they succeed, run out of attempts or reach the
+        deadline. Rejected requests were not handled, so they are
+        retried after the hint given by the server whatever their type.
+
+        Args:
+            message: the message to send
+            address: tuple containing the IP address and port of the
+                receiving entity
+            deadline: deadline of the call, a new one with the default
+                timeout is used if not given
+
+        Returns:
+            the content of the reply
+
+        Raises:
+            OSError: if the last attempt failed or timed out
+            RejectedError: if the server rejected the last attempt
+        """
+        if deadline is None:
+            deadline = Deadline(self.timeout)
+
+        if self.certificate is not None:
+            message.src_com_id = self.certificate.com_id
+
+        retryable = message.type in RETRYABLE
+        attempt = 0
+
+        while True:
+            try:
+                with tracer.span("send %s" % message.type,
+                                 attempt=attempt) as span:
+                    tracer.inject(message, span)
+                    soc = deadline.connect(address)
+
+                    try:
+                        com.send_message(soc, message)
+                        reply = com.receive_message(soc)
+                    finally:
+                        soc.close()
+
+                if reply.type != Message.REJECT:
+                    return reply.content
+
+                self.count("rejections")
+                raise com.RejectedError(reply.content)
+            except com.RejectedError as error:
+                if attempt + 1 >= MAX_ATTEMPTS or \
+                        error.retry_after >= deadline.remaining():
+                    raise
+
+                time.sleep(error.retry_after)
+            except OSError as error:
+                if isinstance(error, socket.timeout):
+                    self.count("timeouts")
+
+                if not retryable or attempt + 1 >= MAX_ATTEMPTS or \
+                        not deadline.backoff(attempt):
+                    raise
+
+            attempt += 1
+            self.count("retries")
+
+    def fetch_stats(self, address=None):
+        """
+        Fetches the per-peer usage stats of the CR or another SP.
+
+        The request is signed, another SP is first sent the certificate
+        of this communicator so that it can verify the request.
+
+        Returns:
+            the usage stats, None if the request was refused
+        """
+        deadline = Deadline(self.timeout)
+
+        if address is not None and address != self.cr_address and \
+                not self.__exchange_certificate(address, deadline):
+            return None
+
+        message = self.__signed_request(Message.STATS)
+        return self.__send_and_get_reply(message, address or self.cr_address,
+                                         deadline)
+
+    def request_profile(self, seconds=None, address=None):
+        """
+        Asks the CR or another SP to profile itself.
+
+        The request is signed, another SP is first sent the certificate
+        of this communicator so that it can verify the request.
+
+        Returns:
+            the path of the profile on the profiled host, None if the
+            profiler is busy or disabled or the request was refused
+        """
+        deadline = Deadline(self.timeout)
+
+        if address is not None and address != self.cr_address and \
+                not self.__exchange_certificate(address, deadline):
+            return None
 
-        soc.sendall(pickle.dumps(message))
+        message = self.__signed_request(Message.PROFILE, seconds)
 
-        reply = soc.recv(com.BUFFER_SIZE)
-        return pickle.loads(reply).content
+        return self.__send_and_get_reply(message, address or self.cr_address,
+                                         deadline)
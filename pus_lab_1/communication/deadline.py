@@ -0,0 +1,61 @@
+"""Module containing deadline and retry helpers for network calls."""
+__author__ = 'Luka Sterbic'
+
+import time
+import random
+import socket
+
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 1.0
+
+
+class Deadline(object):
+    """
+    Class modelling the deadline of a network call.
+
+    A deadline is created once per call and passed down to all the
+    requests the call makes, so sub-requests never outlive the call.
+
+    Attributes:
+        expires: timestamp at which the deadline expires
+    """
+    def __init__(self, timeout):
+        """Inits the deadline to expire after timeout seconds."""
+        self.expires = time.time() + timeout
+
+    def remaining(self):
+        """Returns the number of seconds left until the deadline."""
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        """Checks if the deadline has expired."""
+        return self.remaining() == 0.0
+
+    def connect(self, address):
+        """Opens a connection which times out at the deadline."""
+        if self.expired():
+            raise socket.timeout("Deadline exceeded.")
+
+        soc = socket.create_connection(address, self.remaining())
+        soc.settimeout(max(self.remaining(), 0.001))
+
+        return soc
+
+    def backoff(self, attempt):
+        """
+        Sleeps before retrying a failed request.
+
+        The delay is drawn uniformly up to an exponentially growing cap
+        so that clients retrying at the same time spread out, and it
+        never extends past the deadline.
+
+        Args:
+            attempt: the number of the failed attempt, starting at 0
+
+        Returns:
+            True if there is time left for another attempt
+        """
+        cap = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+        time.sleep(min(random.uniform(0, cap), self.remaining()))
+
+        return not self.expired()
@@ -0,0 +1,388 @@
+"""Module containing the gossip directory of service providers."""
+__author__ = 'Luka Sterbic'
+
+import os
+import copy
+import time
+import random
+import threading
+
+from Crypto.Hash import SHA256
+
+import communication.com_structs as com
+from communication.com_structs import Message
+from descriptors import SPDescriptor
+
+FANOUT = 3
+GOSSIP_INTERVAL = 5.0
+GOSSIP_VARIABLE = "PUS_GOSSIP"
+ENABLED_VALUES = ("1", "true", "yes", "on")
+
+
+def is_enabled():
+    """Returns True if the PUS_GOSSIP variable is set to a true value."""
+    return os.environ.get(GOSSIP_VARIABLE, "").strip().lower() in \
+        ENABLED_VALUES
+
+
+class PeerStatus(object):
+    """
+    Status of a service provider, signed by the provider itself.
+
+    Attributes:
+        com_id: com id of the service provider
+        load: served file requests per second
+        replicas: ids of the files the provider holds verified
+            replicas of
+        issued: timestamp at which the status was issued
+        signature: signature of the service provider
+    """
+    def __init__(self, com_id, load, replicas):
+        """Inits the status with the given load and replicas."""
+        self.com_id = com_id
+        self.load = load
+        self.replicas = replicas
+        self.issued = time.time()
+        self.signature = None
+
+    def sign(self, key):
+        """Signs this status with the given private key."""
+        self.signature = key.sign(self.hash())
+
+    def verify(self, key):
+        """Verify this status with the given public key."""
+        return key.verify(self.hash(), self.signature)
+
+    def hash(self):
+        """Computes the hash of this status."""
+        return SHA256.new(("%d %r %r %r" % (
+            self.com_id, self.issued, self.load, sorted(self.replicas))
+        ).encode("ascii")).digest()
+
+
+class PeerEntry(object):
+    """
+    Entry of the gossip directory for a single service provider.
+
+    Each part of the entry is replaced independently by a newer one.
+    Entries sent to other providers only carry the parts they miss.
+
+    Attributes:
+        certificate: certificate of the provider signed by the CR
+        catalog: catalog of the files of the provider signed by the CR
+        status: status of the provider signed by the provider
+    """
+    def __init__(self, certificate=None, catalog=None, status=None):
+        """Inits the entry with the given parts."""
+        self.certificate = certificate
+        self.catalog = catalog
+        self.status = status
+
+    def versions(self):
+        """Returns the versions of the parts of this entry."""
+        return (
+            self.certificate.valid_until if self.certificate else 0,
+            self.catalog.issued if self.catalog else 0,
+            self.status.issued if self.status else 0
+        )
+
+
+class Directory(object):
+    """
+    Directory of service providers spread by gossip.
+
+    The directory holds the certificates, catalogs and statuses of the
+    known service providers. Parts received from other providers are
+    accepted only if they carry a valid signature, of the central
+    registry for certificates and catalogs and of the certified key of
+    the provider for statuses.
+
+    Attributes:
+        cr_key: public key of the central registry
+        own_id: com id of the owner of the directory
+        entries: com id indexed dictionary of directory entries
+        lock: lock guarding the updates of the entries
+    """
+    def __init__(self, store, cr_key, own_id):
+        """Inits an empty directory in the given shared store."""
+        self.cr_key = cr_key
+        self.own_id = own_id
+        self.entries = store.dict()
+        self.lock = store.lock()
+
+    def update_own(self, certificate=None, catalog=None, status=None):
+        """
+        Replaces parts of the entry of the owner of the directory.
+
+        Returns:
+            the updated entry
+        """
+        with self.lock:
+            entry = self.entries.get(self.own_id, PeerEntry())
+
+            entry.certificate = certificate or entry.certificate
+            entry.catalog = catalog or entry.catalog
+            entry.status = status or entry.status
+
+            self.entries[self.own_id] = entry
+
+        return entry
+
+    def digest(self):
+        """Returns the com id indexed versions of all the entries."""
+        return dict((com_id, entry.versions())
+                    for com_id, entry in self.entries.items())
+
+    def newer_than(self, digest):
+        """
+        Selects the parts of the entries newer than the given digest.
+
+        Args:
+            digest: directory digest of another service provider
+
+        Returns:
+            com id indexed dictionary of entries holding only the parts
+            missing from the digest
+        """
+        newer = {}
+
+        for com_id, entry in self.entries.items():
+            known = digest.get(com_id, (0, 0, 0))
+            versions = entry.versions()
+
+            parts = [part if version > seen else None
+                     for part, version, seen in zip(
+                         (entry.certificate, entry.catalog, entry.status),
+                         versions, known)]
+
+            if any(parts):
+                newer[com_id] = PeerEntry(*parts)
+
+        return newer
+
+    def merge(self, entries):
+        """
+        Merges the entries received from another service provider.
+
+        Args:
+            entries: com id indexed dictionary of entries
+
+        Returns:
+            com id indexed dictionary of the accepted parts
+        """
+        accepted = {}
+
+        for com_id, received in entries.items():
+            if com_id == self.own_id:
+                continue
+
+            with self.lock:
+                entry = self.entries.get(com_id, PeerEntry())
+                update = self.__merge_entry(com_id, entry, received)
+
+                if update is not None:
+                    self.entries[com_id] = entry
+                    accepted[com_id] = update
+
+        return accepted
+
+    def __merge_entry(self, com_id, entry, received):
+        """Merges the valid and newer parts of an entry in place."""
+        update = PeerEntry()
+        current = entry.versions()
+        versions = received.versions()
+
+        certificate = received.certificate
+
+        if certificate is not None and versions[0] > current[0] and \
+                certificate.com_id == com_id and certificate.is_valid() and \
+                certificate.verify(self.cr_key):
+            entry.certificate = update.certificate = certificate
+
+        catalog = received.catalog
+
+        if catalog is not None and versions[1] > current[1] and \
+                catalog.com_id == com_id and catalog.verify(self.cr_key):
+            entry.catalog = update.catalog = catalog
+
+        status = received.status
+
+        if status is not None and versions[2] > current[2] and \
+                status.com_id == com_id and entry.certificate is not None:
+            key = com.get_key(entry.certificate.public_key,
+                              scheme=entry.certificate.scheme)
+
+            if status.verify(key):
+                entry.status = update.status = status
+
+        if any(update.versions()):
+            return update
+
+        return None
+
+    def service_providers(self):
+        """Returns the com id indexed descriptors of the known providers."""
+        providers = {}
+
+        for com_id, entry in self.entries.items():
+            certificate = entry.certificate
+
+            if certificate is None or not certificate.is_valid():
+                continue
+
+            descriptor = SPDescriptor(com_id, certificate.name,
+                                      certificate.address, certificate)
+
+            if entry.status is not None:
+                descriptor.load = entry.status.load
+
+            providers[com_id] = descriptor
+
+        return providers
+
+    def public_files(self):
+        """Returns the file id indexed descriptors of all known files."""
+        entries = self.entries.copy()
+        files = {}
+
+        for entry in entries.values():
+            if entry.catalog is None:
+                continue
+
+            for file in entry.catalog.files:
+                file = copy.copy(file)
+                file.replicas = []
+                files[file.file_id] = file
+
+        for com_id, entry in entries.items():
+            if entry.status is None:
+                continue
+
+            for file_id in entry.status.replicas:
+                file = files.get(file_id)
+
+                if file is not None and file.com_id != com_id:
+                    file.replicas.append(com_id)
+
+        return files
+
+    def peers(self):
+        """Returns the addresses of the other known providers."""
+        return dict((com_id, entry.certificate.address)
+                    for com_id, entry in self.entries.items()
+                    if com_id != self.own_id and
+                    entry.certificate is not None)
+
+
+class Gossiper(object):
+    """
+    Spreads the gossip directory between service providers.
+
+    New parts of the directory are pushed as rumours to a bounded
+    number of random peers, which push the parts new to them further.
+    Every interval the gossiper also exchanges digests with a random
+    peer and both sides send each other the parts the other misses,
+    so lost rumours are eventually repaired. With no known peers the
+    gossiper asks the bootstrap function to seed the directory.
+
+    Attributes:
+        directory: the gossip directory
+        send: function sending a message to an address and returning
+            the content of the reply, None if the request was refused
+        bootstrap: function seeding the directory with known peers
+        fanout: number of peers a rumour is pushed to
+        interval: seconds between two anti-entropy exchanges
+        thread: thread running the anti-entropy exchanges
+    """
+    def __init__(self, directory, send, bootstrap, fanout=FANOUT,
+                 interval=GOSSIP_INTERVAL):
+        """Inits the gossiper for the given directory."""
+        self.directory = directory
+        self.send = send
+        self.bootstrap = bootstrap
+        self.fanout = fanout
+        self.interval = interval
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Starts the periodic anti-entropy exchanges."""
+        self.thread.start()
+
+    def receive(self, content):
+        """
+        Handles a gossip message received from another provider.
+
+        Args:
+            content: tuple with the digest of the sender, None for
+                rumours, and the entries pushed by the sender
+
+        Returns:
+            the content of the reply, the digest of this directory and
+            the parts the sender misses if it sent its digest
+        """
+        digest, entries = content
+        accepted = self.directory.merge(entries)
+
+        if accepted:
+            self.spread(accepted)
+
+        missing = {} if digest is None else self.directory.newer_than(digest)
+
+        return self.directory.digest(), missing
+
+    def spread(self, entries):
+        """Pushes the given entries to random peers in the background."""
+        thread = threading.Thread(target=self.__push, args=(entries,))
+        thread.daemon = True
+        thread.start()
+
+    def exchange(self):
+        """Exchanges digests and missing parts with a random peer."""
+        peers = self.directory.peers()
+
+        if not peers:
+            self.bootstrap()
+            return
+
+        address = random.choice(list(peers.values()))
+        message = Message(Message.GOSSIP, (self.directory.digest(), {}))
+
+        try:
+            reply = self.send(message, address)
+        except OSError:
+            return
+
+        if reply is None:
+            return
+
+        digest, entries = reply
+
+        accepted = self.directory.merge(entries)
+        missing = self.directory.newer_than(digest)
+
+        if missing:
+            self.__send_entries(address, missing)
+
+        if accepted:
+            self.spread(accepted)
+
+    def __push(self, entries):
+        """Pushes the given entries to fanout random peers."""
+        peers = list(self.directory.peers().values())
+
+        for address in random.sample(peers, min(self.fanout, len(peers))):
+            self.__send_entries(address, entries)
+
+    def __send_entries(self, address, entries):
+        """Sends entries to a peer, ignoring unreachable peers."""
+        try:
+            self.send(Message(Message.GOSSIP, (None, entries)), address)
+        except OSError:
+            pass
+
+    def __run(self):
+        """Runs the anti-entropy exchanges."""
+        while True:
+            time.sleep(self.interval)
+            self.exchange()
@@ -0,0 +1,182 @@
+"""Module containing the persistent key store for CR and SP entities."""
+__author__ = 'Luka Sterbic'
+
+import os
+import stat
+import pickle
+import queue
+import threading
+
+import communication.com_structs as com
+
+KEYSTORE_DIR = "keys"
+KEY_FILE = "key-%s.pem"
+CERTIFICATE_FILE = "certificate.pickle"
+PASSPHRASE_VARIABLE = "PUS_PASSPHRASE"
+SCHEME_VARIABLE = "PUS_SCHEME"
+
+
+class KeyPool(object):
+    """
+    Pool of pre-generated keys.
+
+    A daemon thread keeps the pool filled so that a key rotation can
+    take a key immediately instead of waiting for its generation.
+
+    Attributes:
+        scheme: name of the signature scheme of the keys
+        keys: queue of generated keys
+        thread: the thread generating the keys
+    """
+    def __init__(self, size, scheme):
+        """Inits the pool and starts the generator thread."""
+        self.scheme = scheme
+        self.keys = queue.Queue(size)
+        self.thread = threading.Thread(target=self.__generate)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        """Takes a key from the pool, blocks only if it is empty."""
+        return self.keys.get()
+
+    def __generate(self):
+        """Generates keys while the pool is not full."""
+        while True:
+            self.keys.put(com.get_key(scheme=self.scheme))
+
+
+class KeyStore(object):
+    """
+    On-disk store for the key and certificate of an entity.
+
+    The key is saved in PEM format, optionally encrypted with a
+    passphrase, together with the last certificate signed by the
+    central registry. Keys of different signature schemes are kept in
+    separate files. All files are readable only by their owner and are
+    refused if their permissions allow access to anyone else.
+
+    Attributes:
+        directory: directory holding the files of the store
+        passphrase: passphrase used to encrypt the key, if any
+        scheme: name of the signature scheme of the key
+        pool: pool of pre-generated keys, if any
+    """
+    def __init__(self, directory, passphrase=None, pool_size=0,
+                 scheme=None):
+        """Inits the store in the given directory."""
+        self.directory = directory
+        self.passphrase = passphrase
+        self.scheme = com.get_scheme(scheme or com.DEFAULT_SCHEME).name
+        self.pool = KeyPool(pool_size, self.scheme) if pool_size else None
+
+        os.makedirs(directory, 0o700, exist_ok=True)
+
+    @staticmethod
+    def for_entity(name, pool_size=0):
+        """Creates the store of the named entity in the default location."""
+        return KeyStore(
+            os.path.join(KEYSTORE_DIR, name),
+            os.environ.get(PASSPHRASE_VARIABLE),
+            pool_size,
+            os.environ.get(SCHEME_VARIABLE)
+        )
+
+    def load_key(self):
+        """Loads the stored key or creates and stores a new one."""
+        data = self.__read(KEY_FILE % self.scheme)
+
+        if data is not None:
+            return com.get_key(data, self.passphrase, self.scheme)
+
+        key = self.new_key()
+        self.save_key(key)
+
+        return key
+
+    def new_key(self):
+        """Returns a fresh key, taken from the pool if there is one."""
+        if self.pool is not None and self.pool.scheme == self.scheme:
+            return self.pool.get()
+
+        return com.get_key(scheme=self.scheme)
+
+    def save_key(self, key):
+        """Stores the given key."""
+        self.__write(KEY_FILE % key.scheme.name,
+                     key.exportKey("PEM", self.passphrase))
+
+    def load_certificate(self, certificate, cr_key):
+        """
+        Loads the stored certificate if it can replace the given one.
+
+        Args:
+            certificate: the unsigned certificate of the entity
+            cr_key: public key of the central registry
+
+        Returns:
+            the stored certificate if it has the same holder and public
+            key as the given one, it is still valid and it is signed by
+            the central registry, None otherwise
+        """
+        data = self.__read(CERTIFICATE_FILE)
+
+        if data is None:
+            return None
+
+        stored = pickle.loads(data)
+
+        if stored.name != certificate.name or \
+                tuple(stored.address) != tuple(certificate.address) or \
+                stored.public_key != certificate.public_key or \
+                getattr(stored, "scheme", None) != certificate.scheme:
+            return None
+
+        if stored.signature is None or not stored.is_valid():
+            return None
+
+        return stored if stored.verify(cr_key) else None
+
+    def save_certificate(self, certificate):
+        """Stores the given certificate."""
+        self.__write(CERTIFICATE_FILE, pickle.dumps(certificate))
+
+    def __read(self, name):
+        """Reads a file of the store after checking its permissions."""
+        path = os.path.join(self.directory, name)
+
+        if not os.path.isfile(path):
+            return None
+
+        if os.stat(path).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            raise PermissionError(
+                "Keystore file %s is accessible by other users." % path)
+
+        with open(path, "rb") as file:
+            return file.read()
+
+    def __write(self, name, data):
+        """
+        Writes a file of the store readable only by its owner.
+
+        The data is written to a temporary file which then replaces the
+        old file, so a crash never leaves a truncated key or certificate.
+        """
+        path = os.path.join(self.directory, name)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        descriptor = os.open(temporary,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(temporary, 0o600)
+
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(temporary, path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+            raise
@@ -0,0 +1,158 @@
+"""Module containing the multi-process server mode for CR and SP servers."""
+__author__ = 'Luka Sterbic'
+
+import signal
+import threading
+import multiprocessing
+
+# Workers inherit the bound socket, locks and state of the server, which
+# cannot be pickled, so they are always forked whatever the default
+# start method of the platform is
+CONTEXT = multiprocessing.get_context("fork")
+
+
+class CachedDict(object):
+    """
+    Dictionary shared by all processes with reads cached in each process.
+
+    Every access to a manager proxy is a round trip to the single
+    manager process. Values read by a process are therefore kept in a
+    local cache, tagged with the number of changes of the dictionary
+    at the time they were read. The counter lives in shared memory and
+    is incremented by every change, so a cached value is used only
+    while the dictionary has not changed, and reads of read-mostly
+    state, such as certificates, do not leave the process. Changes
+    always go through the manager.
+
+    Attributes:
+        shared: proxy to the dictionary in the manager process
+        changes: shared memory counter of the changes of the dictionary
+        cache: key indexed tuples with the number of changes and the
+            value read by this process, missing keys are not cached, so
+            None cannot be stored as a value
+    """
+    def __init__(self, shared, changes):
+        """Inits the cache of the given shared dictionary."""
+        self.shared = shared
+        self.changes = changes
+        self.cache = {}
+
+    def get(self, key, default=None):
+        """Returns the value of the key, reading it from the cache."""
+        changes = self.changes.value
+        cached = self.cache.get(key)
+
+        if cached is not None and cached[0] == changes:
+            return cached[1]
+
+        value = self.shared.get(key)
+
+        if value is None:
+            return default
+
+        self.cache[key] = (changes, value)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        self.shared[key] = value
+
+        with self.changes.get_lock():
+            self.changes.value += 1
+
+    def copy(self):
+        """Returns a copy of the shared dictionary."""
+        return self.shared.copy()
+
+
+class SharedStore(object):
+    """
+    Factory of containers for the state of a server.
+
+    With a single process the containers are plain dictionaries and
+    locks. With several worker processes they are proxies to a manager
+    process, so every worker sees the same certificates, catalog and
+    counters. Values read from a proxy are copies, hence modified values
+    have to be stored again.
+
+    Every access to a proxy is a round trip to the manager process,
+    which serves them one at a time. Read-mostly dictionaries are
+    created with cached_dict() so that their reads stay in the process,
+    but changes of the shared state still serialise the workers on the
+    manager. Workers isolate requests and spread the CPU bound signing
+    and verification work, they do not make state changes faster.
+
+    Attributes:
+        manager: the manager process, None with a single process
+    """
+    def __init__(self, workers):
+        """Inits the store for the given number of processes."""
+        self.manager = CONTEXT.Manager() if workers > 1 else None
+
+    def dict(self, *args):
+        """Creates a dictionary shared by all processes."""
+        if self.manager is None:
+            return dict(*args)
+
+        return self.manager.dict(*args)
+
+    def cached_dict(self, *args):
+        """Creates a read-mostly dictionary shared by all processes."""
+        if self.manager is None:
+            return dict(*args)
+
+        return CachedDict(self.manager.dict(*args), CONTEXT.Value("Q", 0))
+
+    def lock(self):
+        """Creates a lock shared by all processes."""
+        if self.manager is None:
+            return threading.Lock()
+
+        return self.manager.Lock()
+
+    def shutdown(self):
+        """Stops the manager process, if any."""
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+
+class PreforkMixIn(object):
+    """
+    Mix-in class serving a socket server from several processes.
+
+    The listening socket is bound once and inherited by worker processes
+    forked from the server, each of them accepting connections and
+    handling requests, so the CPU bound signing and verification work
+    is spread across cores. The process that forked the workers serves
+    requests as well.
+
+    Attributes:
+        workers: total number of processes serving requests
+        worker_processes: the forked worker processes
+    """
+    workers = 1
+
+    def start_workers(self):
+        """Forks the worker processes, must be called before serving."""
+        self.worker_processes = []
+
+        for _ in range(self.workers - 1):
+            process = CONTEXT.Process(target=self.__work)
+            process.daemon = True
+            process.start()
+
+            self.worker_processes.append(process)
+
+    def stop_workers(self):
+        """Terminates the worker processes."""
+        for process in getattr(self, "worker_processes", []):
+            process.terminate()
+            process.join()
+
+    def __work(self):
+        """Serves requests in a worker process."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.serve_forever()
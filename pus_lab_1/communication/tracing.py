@@ -0,0 +1,251 @@
+"""
+Module containing the distributed request tracing of CR and SP entities.
+
+Spans are written to a trace file per process in the Trace Event
+Format, which can be opened with chrome://tracing or Perfetto. The
+trace and span ids are carried in messages, so the spans of a request
+can be followed across entities. Tracing is enabled by setting the
+PUS_TRACE environment variable to the directory of the trace files.
+
+The trace files of several entities can be merged into a single file.
+
+Usage:
+    python3 -m communication.tracing output trace_file [trace_file ...]
+
+Args:
+    output: path of the merged trace file
+    trace_file: path of a trace file written by an entity
+"""
+__author__ = 'Luka Sterbic'
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+
+TRACE_VARIABLE = "PUS_TRACE"
+TRACE_FILE = "%s-%d.json"
+
+
+class Span(object):
+    """
+    A timed operation of a trace.
+
+    Spans are used as context managers, entering a span makes it the
+    parent of the spans entered later by the same thread.
+
+    Attributes:
+        tracer: the tracer recording the span
+        name: the name of the operation
+        trace_id: id of the trace the span belongs to
+        span_id: id of the span
+        parent_id: id of the parent span, None for the root span
+        args: additional values recorded with the span
+        start: timestamp at which the span was entered
+    """
+    def __init__(self, tracer, name, trace_id, parent_id, args):
+        """Inits the span with a new span id."""
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id or new_id()
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        self.tracer.pop(self)
+
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        self.tracer.record(self, end)
+        return False
+
+
+class NullSpan(object):
+    """Span used when tracing is disabled, it records nothing."""
+    trace_id = None
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Records the spans of a process in a trace file.
+
+    Attributes:
+        service: name of the traced entity
+        directory: directory of the trace files, None if disabled
+        local: thread local stack of the entered spans
+        lock: lock guarding the trace file
+        file: the trace file of the current process
+        pid: id of the process owning the trace file
+    """
+    def __init__(self, service=None, directory=None):
+        """Inits the tracer, tracing is disabled without a directory."""
+        self.service = service
+        self.directory = directory
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+
+    @property
+    def enabled(self):
+        """Checks if spans are recorded."""
+        return self.directory is not None
+
+    def span(self, name, parent=None, **args):
+        """
+        Creates a span for the given operation.
+
+        Args:
+            name: the name of the operation
+            parent: span or message carrying the parent ids, defaults
+                to the innermost span entered by the current thread
+            args: additional values recorded with the span
+
+        Returns:
+            the span, to be used as a context manager
+        """
+        if not self.enabled:
+            return NULL_SPAN
+
+        if parent is None:
+            parent = self.current()
+
+        trace_id = getattr(parent, "trace_id", None)
+        parent_id = getattr(parent, "span_id", None)
+
+        return Span(self, name, trace_id, parent_id, args)
+
+    def current(self):
+        """Returns the innermost span entered by the current thread."""
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def inject(self, message, span=None):
+        """Stores the ids of the given or current span in the message."""
+        span = span or self.current()
+
+        if span is not None:
+            message.trace_id = span.trace_id
+            message.span_id = span.span_id
+
+    def push(self, span):
+        """Makes the span the innermost span of the current thread."""
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+
+        self.local.stack.append(span)
+
+    def pop(self, span):
+        """Removes the span from the spans of the current thread."""
+        stack = getattr(self.local, "stack", [])
+
+        if span in stack:
+            stack.remove(span)
+
+    def record(self, span, end):
+        """Writes the given finished span to the trace file."""
+        args = dict(span.args)
+        args.update(trace_id=span.trace_id, span_id=span.span_id,
+                    parent_id=span.parent_id)
+
+        self.__write({
+            "name": span.name,
+            "cat": self.service,
+            "ph": "X",
+            "ts": int(span.start * 1e6),
+            "dur": int((end - span.start) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident() % 2 ** 31,
+            "args": args
+        })
+
+    def __write(self, event):
+        """Appends an event to the trace file of the current process."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.__open()
+
+            self.file.write(json.dumps(event, default=str) + ",\n")
+            self.file.flush()
+
+    def __open(self):
+        """Opens the trace file of the current process."""
+        self.pid = os.getpid()
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            TRACE_FILE % (self.service, self.pid))
+
+        self.file = open(path, "w")
+        self.file.write("[\n")
+        self.file.write(json.dumps({
+            "name": "process_name",
+            "ph": "M",
+            "pid": self.pid,
+            "args": {"name": "%s (%d)" % (self.service, self.pid)}
+        }) + ",\n")
+
+
+tracer = Tracer()
+
+
+def configure(service):
+    """Enables tracing for the named entity if PUS_TRACE is set."""
+    tracer.service = service
+    tracer.directory = os.environ.get(TRACE_VARIABLE)
+
+
+def new_id():
+    """Generates a random 64 bit span or trace id."""
+    return "%016x" % random.getrandbits(64)
+
+
+def load(path):
+    """Loads the events of a trace file, which may not be terminated."""
+    with open(path) as file:
+        data = file.read().strip().rstrip(",")
+
+    if not data.endswith("]"):
+        data += "]"
+
+    return json.loads(data)
+
+
+def merge(output, paths):
+    """Merges the given trace files into a single trace file."""
+    events = []
+
+    for path in paths:
+        events.extend(load(path))
+
+    with open(output, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(1)
+
+    merge(sys.argv[1], sys.argv[2:])
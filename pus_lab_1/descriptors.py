@@ -18,6 +18,8 @@ class FileDescriptor(object):
         file_id: the id of the file
         com_id: the id of the communicator used by the service
             provider to whom the file belongs
+        replicas: com ids of the service providers advertising a
+            verified copy of the file
     """
     HEADER = "%5s %3s %-15s %-10s %-43s" % (
         "F_ID", "SP", "File", "Author", "Description")
@@ -29,6 +31,7 @@ class FileDescriptor(object):
         self.description = description
         self.file_id = -1
         self.com_id = -1
+        self.replicas = []
 
     def __str__(self):
         """Concatenates all the information saved in the descriptor"""
@@ -122,9 +125,14 @@ class SPDescriptor(object):
         com_id: communicator id for the service provider
         name: the name of the service provider
         address: tuple containing the IP address and port for th SP
+        load: the last load reported by the SP, in served file
+            requests per second
+        certificate: certificate of the SP signed by the CR
     """
-    def __init__(self, com_id, name, address):
-        """Inits the object with id, name and address."""
+    def __init__(self, com_id, name, address, certificate=None):
+        """Inits the object with id, name, address and certificate."""
         self.com_id = com_id
         self.name = name
         self.address = address
+        self.certificate = certificate
+        self.load = 0.0
@@ -9,7 +9,7 @@ port of the central registry and the path to the configuration file
 with user information.
 
 Usage:
-    python3 service_provider.py name port cr_ip cr_port config
+    python3 service_provider.py name port cr_ip cr_port config [workers]
 
 Args:
     name: the name of the service provider
@@ -18,15 +18,23 @@ Args:
     cr_ip: the ip address of the central registry
     cr_port: the port of the central registry
     config: path to the configuration file
+    workers: number of processes serving requests of other providers,
+        defaults to 1
 """
 __author__ = 'Luka Sterbic'
 
+import os
 import sys
 import getpass
 import signal
 
 from descriptors import FileDescriptor, FileBuffer
+import profiler
+from profiler import Profiler
 from communication.communicator import Communicator
+from communication.keystore import KeyStore
+from communication import gossip
+from communication import tracing
 
 
 class User(object):
@@ -71,12 +79,16 @@ class ServiceProvider(object):
         files: a list of files
         files_by_id: file id indexed dictionary of all files
         files_by_user: username indexed dictionary of all files
+        file_stamps: file id indexed dictionary with the modification
+            time and size of each file when its digest was computed
         active_user: the currently active user
         remote_files: file_id indexed dictionary of remote files
+        profiler: sampling profiler started by SIGUSR1, PROFILE requests
+            or the profile command
         communicator: object used to communicate with other providers
     """
 
-    def __init__(self, name, address, cr_address, config):
+    def __init__(self, name, address, cr_address, config, workers=1):
         """Inits the object with name, address and CR address."""
         print("Initializing service provider %s..." % name)
         print("\t%-15s: %s:%d" % ("Address", address[0], address[1]))
@@ -89,17 +101,24 @@ class ServiceProvider(object):
         self.files = []
         self.files_by_id = {}
         self.files_by_user = {}
+        self.file_stamps = {}
 
         self.active_user = None
 
         self.init(config)
 
         self.remote_files = {}
+        self.profiler = Profiler(name)
         self.communicator = Communicator(
             name,
             address,
             cr_address,
-            self.load_buffer
+            self.load_buffer,
+            KeyStore.for_entity(name, pool_size=1),
+            hedge=True,
+            workers=workers,
+            gossip=gossip.is_enabled(),
+            profiler=self.profiler
         )
 
     def init(self, config):
@@ -154,10 +173,46 @@ class ServiceProvider(object):
         return buffer
 
     def load_buffer(self, buffer):
-        """Load the content of a file into the given buffer."""
-        directory = self.users[buffer.descriptor.author].home_dir
+        """
+        Load the content of a file into the given buffer.
+
+        The manifest entry of the file is updated only if the file was
+        modified since its digest was last computed.
+
+        Args:
+            buffer: the buffer to load
+        """
+        descriptor = buffer.descriptor
+        directory = self.users[descriptor.author].home_dir
+        stamp = self.file_stamp(directory, descriptor)
+
         buffer.load(directory)
 
+        if self.file_stamps.get(descriptor.file_id) != stamp:
+            self.communicator.update_manifest(descriptor.file_id,
+                                              buffer.lines)
+            self.file_stamps[descriptor.file_id] = stamp
+
+    def build_manifest(self):
+        """Computes the digests of all files and signs the manifest."""
+        for file_descriptor in self.files:
+            directory = self.users[file_descriptor.author].home_dir
+            stamp = self.file_stamp(directory, file_descriptor)
+
+            with open(os.path.join(directory, file_descriptor.name)) as file:
+                self.communicator.update_manifest(file_descriptor.file_id,
+                                                  file.readlines())
+
+            self.file_stamps[file_descriptor.file_id] = stamp
+
+        self.communicator.signed_manifest()
+
+    @staticmethod
+    def file_stamp(directory, descriptor):
+        """Returns the modification time and size of a file."""
+        stat = os.stat(os.path.join(directory, descriptor.name))
+        return stat.st_mtime, stat.st_size
+
     def run(self):
         """Starts the service provider."""
         print("Publishing files on central registry %s..."
@@ -169,8 +224,13 @@ class ServiceProvider(object):
         self.build_indexes()
         print("File descriptor indexes ready\n")
 
+        print("Building file manifest...")
+        self.build_manifest()
+        print("Manifest signed for %d files\n" % len(self.files))
+
         signal_blocker = lambda s, f: print("Blocking the signal")
         signal.signal(signal.SIGINT, signal_blocker)
+        self.profiler.install()
         self.communicator.start()
         signal.signal(signal.SIGINT, self.signal_handler)
 
@@ -196,11 +256,26 @@ class ServiceProvider(object):
             elif tokens[0] == "ls" and len(tokens) == 2:
                 self.do_ls(tokens)
             elif tokens[0] == "fetch" and len(tokens) == 2:
-                self.do_fetch(tokens)
+                try:
+                    self.do_fetch(tokens)
+                except OSError as error:
+                    print("The request failed: %s" % error)
             elif tokens[0] == "clear":
                 self.do_clear(tokens)
             elif tokens[0] == "save" and len(tokens) == 3:
                 self.do_save(tokens)
+            elif tokens[0] == "rotate":
+                self.do_rotate()
+            elif tokens[0] == "stats":
+                try:
+                    self.do_stats(tokens)
+                except OSError as error:
+                    print("The request failed: %s" % error)
+            elif tokens[0] == "profile":
+                try:
+                    self.do_profile(tokens)
+                except (OSError, ValueError) as error:
+                    print("The request failed: %s" % error)
             else:
                 print("Unknown command")
 
@@ -285,6 +360,10 @@ class ServiceProvider(object):
                         self.active_user.name
                     )
 
+                    if buffer is None:
+                        print("The file could not be fetched")
+                        return
+
                     self.active_user.buffers[buffer.buffer_id] = buffer
 
                     if not buffer.lines:
@@ -334,6 +413,73 @@ class ServiceProvider(object):
         except IOError:
             print("An error has occurred while writing to file")
 
+    def do_rotate(self):
+        """Executes the rotate command."""
+        print("Rotating communicator key...")
+        if self.communicator.rotate_key():
+            print("Key rotated, global id %d kept"
+                  % self.communicator.certificate.com_id)
+        else:
+            print("Key rotation failed, the current key is kept")
+
+    def do_stats(self, tokens):
+        """Executes the stats command."""
+        if len(tokens) == 2 and tokens[1] == "cr":
+            self.print_usage(self.communicator.fetch_stats())
+        elif len(tokens) == 1:
+            if not self.communicator.stats:
+                print("No stats recorded")
+
+            for name, value in sorted(self.communicator.stats.items()):
+                print("%-15s %d" % (name, value))
+
+            self.print_usage(self.communicator.admission.stats())
+        else:
+            print("Unknown stats command")
+
+    def do_profile(self, tokens):
+        """Executes the profile command."""
+        remote = len(tokens) > 1 and tokens[1] == "cr"
+        arguments = tokens[2:] if remote else tokens[1:]
+
+        if len(arguments) > 1:
+            print("Unknown profile command")
+            return
+
+        try:
+            seconds = float(arguments[0]) if arguments else None
+        except ValueError:
+            seconds = float("nan")
+
+        if not profiler.is_duration(seconds):
+            print("Invalid profile duration")
+            return
+
+        if remote:
+            path = self.communicator.request_profile(seconds)
+            host = "central registry"
+        else:
+            path = self.profiler.start(seconds)
+            host = "service provider"
+
+        if path is None:
+            print("The %s refused the profile or is already profiling"
+                  % host)
+        else:
+            print("Profiling the %s into %s" % (host, path))
+
+    @staticmethod
+    def print_usage(usage):
+        """Prints the per-peer usage counters of a server."""
+        if not usage:
+            print("No peer usage recorded")
+
+        for peer in sorted(usage, key=str):
+            print("Peer %s:" % peer)
+
+            for name, value in sorted(usage[peer].items()):
+                print("\t%-25s %d" % (name, value))
+
     def shutdown(self):
         """Shutdown this service provider."""
         print("-" * 80)
@@ -359,7 +505,7 @@ class ServiceProvider(object):
         sys.exit(0)
 
 
-def main(name, ip, port, cr_ip, cr_port, config):
+def main(name, ip, port, cr_ip, cr_port, config, workers=1):
     """
     Main function of this script.
 
@@ -373,16 +519,18 @@ def main(name, ip, port, cr_ip, cr_port, config):
         cr_ip: the ip address of the central registry
         cr_port: the port of the central registry
         config: path to the configuration file
+        workers: number of processes serving requests
     """
     address = (ip, int(port))
     cr_address = (cr_ip, int(cr_port))
+    tracing.configure(name)
 
-    sp = ServiceProvider(name, address, cr_address, config)
+    sp = ServiceProvider(name, address, cr_address, config, int(workers))
     sp.run()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 7:
+    if len(sys.argv) not in (7, 8):
         print(__doc__)
         exit(1)
 
@@ -45,6 +45,8 @@ LOGIN_URL = reverse_lazy('login')
 LOGOUT_URL = reverse_lazy('logout')
 
 MIDDLEWARE_CLASSES = (
+    'picshr.media.MediaMiddleware',
+    'picshr.instrumentation.InstrumentationMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -68,6 +70,18 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'picshare',
+    }
+}
+
+PICSHR_PAGE_SIZE = 20
+PICSHR_FEED_FANOUT_LIMIT = 500
+PICSHR_INSTRUMENTATION = DEBUG
+PICSHR_SLOW_REQUEST = 0.5
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -88,4 +102,10 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
-MEDIA_URL = '/media/'
\ No newline at end of file
+MEDIA_URL = '/media/'
+
+# Set to 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx, with
+# an internal location at PICSHR_SENDFILE_PREFIX) to let the web server
+# send media files
+PICSHR_SENDFILE = None
+PICSHR_SENDFILE_PREFIX = '/protected/'
\ No newline at end of file
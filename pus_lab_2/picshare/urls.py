@@ -1,19 +1,20 @@
 from django.conf.urls import patterns, include, url
 from django.contrib import admin
-from django.conf import settings
-from django.conf.urls.static import static
 from registration.backends.simple.views import RegistrationView
 
 from picshr.views import user_details_view, picture_details_view,\
     UserPictureListView, FriendsPictureListView, PublicPictureListView,\
     UserControlPanelView, submit_comment, like_picture, redirect_home,\
     resolve_friend_request, delete_friend, delete_picture, delete_comment,\
-    delete_tag, upload_picture, send_friend_request, add_tag, search_users
+    delete_tag, upload_picture, send_friend_request, add_tag, search_users,\
+    upload_pictures, add_tags, like_pictures
+from picshr.instrumentation import stats_view
 
 
 admin.autodiscover()
 
 urlpatterns = patterns('',
+    url(r'^admin/stats/$', stats_view, name='request_stats'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^$', redirect_home, name='home'),
     url(r'^login/$', 'django.contrib.auth.views.login',
@@ -29,6 +30,7 @@ urlpatterns = patterns('',
         name='submit_comment'),
     url(r'^like/(?P<picture_id>\d+)/(?P<user_id>\d+)/$', like_picture,
         name='like_picture'),
+    url(r'^like/batch/$', like_pictures, name='like_pictures'),
     url(r'^pictures/my/$', UserPictureListView.as_view(), name='my_pictures'),
     url(r'^pictures/friends/$', FriendsPictureListView.as_view(),
         name='friends_pictures'),
@@ -43,8 +45,11 @@ urlpatterns = patterns('',
     url(r'^ctrl/comment/delete/$', delete_comment, name='delete_comment'),
     url(r'^ctrl/tag/delete/$', delete_tag, name='delete_tag'),
     url(r'^ctrl/picture/upload/$', upload_picture, name='upload_picture'),
+    url(r'^ctrl/picture/upload/batch/$', upload_pictures,
+        name='upload_pictures'),
     url(r'^ctrl/friend/request/$', send_friend_request,
         name='send_friend_req'),
     url(r'^ctrl/tag/add/$', add_tag, name='add_tag'),
-    url(r'^search/users/$', search_users, name='search_users')
-) + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    url(r'^ctrl/tag/add/batch/$', add_tags, name='add_tags'),
+    url(r'^search/users/$', search_users, name='search_users'),
+)
@@ -1,8 +1,9 @@
 from django.contrib import admin
 
-from picshr.models import Picture, Friend, FriendRequest, Comment
+from picshr.models import Picture, Friend, FriendRequest, Comment, ImageJob
 
 admin.site.register(FriendRequest)
 admin.site.register(Friend)
 admin.site.register(Picture)
-admin.site.register(Comment)
\ No newline at end of file
+admin.site.register(Comment)
+admin.site.register(ImageJob)
\ No newline at end of file
@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from picshr import friends
+from picshr.models import Friend, Picture, FeedEntry
+from picshr.pagination import keyset
+
+
+FANOUT_LIMIT = getattr(settings, 'PICSHR_FEED_FANOUT_LIMIT', 500)
+HIGH_DEGREE_KEY = 'picshr:feed:high-degree:%d'
+HIGH_DEGREE_TIMEOUT = 5 * 60
+
+
+def is_high_degree(user):
+    return len(friends.friend_ids(user)) > FANOUT_LIMIT
+
+
+def high_degree_friends(user):
+    key = HIGH_DEGREE_KEY % user.pk
+    ids = cache.get(key)
+
+    if ids is None:
+        ids = frozenset(
+            Friend.objects
+            .filter(is_friend__in=Friend.objects.filter(is_friend=user)
+                    .values('friend_to'))
+            .values('is_friend').annotate(degree=Count('id'))
+            .filter(degree__gt=FANOUT_LIMIT)
+            .values_list('is_friend', flat=True))
+        cache.set(key, ids, HIGH_DEGREE_TIMEOUT)
+
+    return ids
+
+
+def publish(*pictures):
+    FeedEntry.objects.bulk_create([
+        FeedEntry(owner_id=owner_id, picture=picture,
+                  author_id=picture.author_id,
+                  submitted_on=picture.submitted_on)
+        for picture in pictures if not is_high_degree(picture.author)
+        for owner_id in friends.friend_ids(picture.author)])
+
+
+def backfill(owner, author):
+    FeedEntry.objects.filter(owner=owner, author=author).delete()
+
+    if is_high_degree(author):
+        return
+
+    FeedEntry.objects.bulk_create([
+        FeedEntry(owner=owner, picture_id=picture_id, author=author,
+                  submitted_on=submitted_on)
+        for picture_id, submitted_on in Picture.objects.filter(
+            author=author).values_list('pk', 'submitted_on')])
+
+
+def invalidate(*user_ids):
+    cache.delete_many([HIGH_DEGREE_KEY % user_id for user_id in user_ids])
+
+
+def fan_out(author):
+    readers = friends.friend_ids(author)
+    FeedEntry.objects.filter(author=author).delete()
+
+    if not is_high_degree(author):
+        FeedEntry.objects.bulk_create([
+            FeedEntry(owner_id=owner_id, picture_id=picture_id,
+                      author=author, submitted_on=submitted_on)
+            for picture_id, submitted_on in Picture.objects.filter(
+                author=author).values_list('pk', 'submitted_on')
+            for owner_id in readers])
+
+    invalidate(*readers)
+
+
+def connect(user, other):
+    for author, reader in ((user, other), (other, user)):
+        if len(friends.friend_ids(author)) == FANOUT_LIMIT + 1:
+            fan_out(author)
+        else:
+            backfill(reader, author)
+
+    invalidate(user.pk, other.pk)
+
+
+def disconnect(user, other):
+    FeedEntry.objects.filter(Q(owner=user, author=other) |
+                             Q(owner=other, author=user)).delete()
+
+    for author in (user, other):
+        if len(friends.friend_ids(author)) == FANOUT_LIMIT:
+            fan_out(author)
+
+    invalidate(user.pk, other.pk)
+
+
+def rebuild(user):
+    FeedEntry.objects.filter(owner=user).delete()
+
+    for friend in user.is_friend_set.select_related('friend_to'):
+        backfill(user, friend.friend_to)
+
+
+def page(user, cursor, size):
+    if not user.is_authenticated():
+        return []
+
+    entries = FeedEntry.objects.filter(owner=user).select_related('picture')
+    pictures = [entry.picture for entry in keyset(entries, cursor,
+                                                  id_field='picture')[:size]]
+
+    high_degree = high_degree_friends(user)
+
+    if high_degree:
+        pictures.extend(keyset(Picture.objects.filter(author__in=high_degree),
+                               cursor)[:size])
+        pictures = sorted(dict((picture.pk, picture)
+                               for picture in pictures).values(),
+                          key=lambda picture: (picture.submitted_on,
+                                               picture.pk),
+                          reverse=True)
+
+    return pictures[:size]
@@ -0,0 +1,57 @@
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from picshr.models import Picture, Comment
+
+
+VERSION_KEY = 'picshr:picture:%d:version'
+FRAGMENT_TIMEOUT = 60 * 60
+
+
+def version(picture_id):
+    key = VERSION_KEY % picture_id
+    value = cache.get(key)
+
+    if value is None:
+        value = int(time.time() * 1000)
+
+        if not cache.add(key, value, None):
+            value = cache.get(key, value)
+
+    return value
+
+
+def bump(picture_id):
+    key = VERSION_KEY % picture_id
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), None)
+
+
+@receiver(post_save, sender=Picture)
+def bump_picture(sender, instance, **kwargs):
+    bump(instance.pk)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def bump_comment(sender, instance, **kwargs):
+    bump(instance.on_picture_id)
+
+
+@receiver(m2m_changed, sender=Picture.likes.through)
+@receiver(m2m_changed, sender=Picture.tags.through)
+def bump_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    if reverse:
+        for picture_id in pk_set or ():
+            bump(picture_id)
+    else:
+        bump(instance.pk)
@@ -0,0 +1,54 @@
+from django.core.cache import cache
+
+from picshr.models import Friend
+
+
+CACHE_KEY = 'picshr:friends:%d'
+CACHE_TIMEOUT = 60 * 60
+
+
+def _cached_friend_ids(user):
+    ids = getattr(user, '_friend_ids', None)
+
+    if ids is None:
+        ids = cache.get(CACHE_KEY % user.pk)
+
+        if ids is not None:
+            user._friend_ids = ids
+
+    return ids
+
+
+def friend_ids(user):
+    if not user.is_authenticated():
+        return frozenset()
+
+    ids = _cached_friend_ids(user)
+
+    if ids is None:
+        ids = frozenset(Friend.objects.filter(is_friend=user)
+                        .values_list('friend_to_id', flat=True))
+        cache.set(CACHE_KEY % user.pk, ids, CACHE_TIMEOUT)
+        user._friend_ids = ids
+
+    return ids
+
+
+def are_friends(user, other):
+    if not user.is_authenticated():
+        return False
+
+    ids = _cached_friend_ids(user)
+
+    if ids is not None:
+        return other.pk in ids
+
+    return Friend.objects.filter(is_friend=user, friend_to=other).exists()
+
+
+def invalidate(*users):
+    cache.delete_many([CACHE_KEY % user.pk for user in users])
+
+    for user in users:
+        if hasattr(user, '_friend_ids'):
+            del user._friend_ids
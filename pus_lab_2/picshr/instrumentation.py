@@ -0,0 +1,173 @@
+import json
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends import BaseDatabaseWrapper
+from django.db.backends.util import CursorDebugWrapper
+from django.http import HttpResponse
+from django.template.base import Template
+
+
+ENABLED = getattr(settings, 'PICSHR_INSTRUMENTATION', False)
+SLOW_REQUEST = getattr(settings, 'PICSHR_SLOW_REQUEST', 0.5)
+UNRESOLVED = '<unresolved>'
+
+logger = logging.getLogger('picshr.requests')
+
+_local = threading.local()
+_template_render = Template.render
+
+
+def _timed_render(self, context):
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start = time.time()
+
+    try:
+        return _template_render(self, context)
+    finally:
+        _local.depth = depth
+
+        if depth == 0 and getattr(_local, 'render_time', None) is not None:
+            _local.render_time += time.time() - start
+
+
+class TimedCursorWrapper(CursorDebugWrapper):
+    def execute(self, sql, params=None):
+        start = time.time()
+
+        try:
+            return super(TimedCursorWrapper, self).execute(sql, params)
+        finally:
+            _record_query(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+
+        try:
+            return super(TimedCursorWrapper, self).executemany(sql,
+                                                               param_list)
+        finally:
+            _record_query(time.time() - start)
+
+
+def _record_query(duration):
+    if getattr(_local, 'queries', None) is not None:
+        _local.queries += 1
+        _local.sql_time += duration
+
+
+def _make_debug_cursor(self, cursor):
+    return TimedCursorWrapper(cursor, self)
+
+
+if ENABLED:
+    Template.render = _timed_render
+    BaseDatabaseWrapper.make_debug_cursor = _make_debug_cursor
+
+
+class RequestStats(object):
+    FIELDS = ('time', 'queries', 'sql_time', 'render_time', 'bytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, name, sample):
+        with self.lock:
+            stats = self.views.setdefault(name, dict(
+                [('requests', 0)] +
+                [('total_' + field, 0) for field in self.FIELDS] +
+                [('max_' + field, 0) for field in self.FIELDS]))
+
+            stats['requests'] += 1
+
+            for field in self.FIELDS:
+                stats['total_' + field] += sample[field]
+                stats['max_' + field] = max(stats['max_' + field],
+                                            sample[field])
+
+    def snapshot(self):
+        with self.lock:
+            views = dict((name, dict(stats))
+                         for name, stats in self.views.items())
+
+        for stats in views.values():
+            for field in self.FIELDS:
+                stats['mean_' + field] = \
+                    stats['total_' + field] / float(stats['requests'])
+
+        return views
+
+    def reset(self):
+        with self.lock:
+            self.views.clear()
+
+
+request_stats = RequestStats()
+
+
+def response_size(response):
+    if getattr(response, 'streaming', False):
+        return int(response.get('Content-Length', 0))
+
+    return len(response.content)
+
+
+class InstrumentationMiddleware(object):
+    def __init__(self):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        for connection in connections.all():
+            connection.use_debug_cursor = True
+
+        request._instrumentation_start = time.time()
+        _local.queries = 0
+        _local.sql_time = 0.0
+        _local.render_time = 0.0
+
+    def process_response(self, request, response):
+        start = getattr(request, '_instrumentation_start', None)
+
+        if start is None or _local.queries is None:
+            return response
+
+        match = getattr(request, 'resolver_match', None)
+        name = match.url_name if match and match.url_name else UNRESOLVED
+
+        sample = {
+            'time': time.time() - start,
+            'queries': _local.queries,
+            'sql_time': _local.sql_time,
+            'render_time': _local.render_time,
+            'bytes': response_size(response),
+        }
+
+        _local.queries = _local.sql_time = _local.render_time = None
+        request_stats.record(name, sample)
+
+        if sample['time'] > SLOW_REQUEST:
+            logger.warning(
+                'Slow request %s %s (%s): %.3f s, %d queries in %.3f s, '
+                'rendered in %.3f s, %d bytes', request.method,
+                request.path, name, sample['time'], sample['queries'],
+                sample['sql_time'], sample['render_time'], sample['bytes'])
+
+        return response
+
+
+@staff_member_required
+def stats_view(request):
+    if request.method == 'POST':
+        request_stats.reset()
+
+    return HttpResponse(json.dumps(request_stats.snapshot(), indent=2,
+                                   sort_keys=True),
+                        content_type='application/json')
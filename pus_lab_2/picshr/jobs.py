@@ -0,0 +1,80 @@
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from picshr import fragments
+from picshr.models import Picture, ImageJob
+
+
+MAX_ATTEMPTS = 3
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def enqueue(picture):
+    Picture.objects.filter(pk=picture.pk).update(status=Picture.PENDING)
+    picture.status = Picture.PENDING
+
+    return ImageJob.objects.create(picture=picture)
+
+
+def enqueue_many(pictures):
+    ImageJob.objects.bulk_create([ImageJob(picture=picture)
+                                  for picture in pictures])
+
+
+def enqueue_missing():
+    queued = ImageJob.objects.filter(
+        status__in=(ImageJob.PENDING, ImageJob.RUNNING))
+    pictures = list(Picture.objects.filter(
+        status=Picture.READY, has_renditions=False).exclude(
+        pk__in=queued.values('picture')).only('pk'))
+
+    enqueue_many(pictures)
+    return len(pictures)
+
+
+def claim(limit):
+    claimed = []
+    pending = ImageJob.objects.filter(status=ImageJob.PENDING)\
+        .order_by('created_on').values_list('pk', flat=True)[:limit]
+
+    for pk in pending:
+        if ImageJob.objects.filter(pk=pk, status=ImageJob.PENDING).update(
+                status=ImageJob.RUNNING, claimed_on=timezone.now(),
+                attempts=F('attempts') + 1):
+            claimed.append(pk)
+
+    return list(ImageJob.objects.filter(pk__in=claimed)
+                .select_related('picture').order_by('created_on'))
+
+
+def complete(job):
+    ImageJob.objects.filter(pk=job.pk).update(status=ImageJob.DONE,
+                                              error='')
+    Picture.objects.filter(pk=job.picture_id).update(status=Picture.READY,
+                                                     has_renditions=True)
+    fragments.bump(job.picture_id)
+
+
+def fail(job, error):
+    if job.attempts < MAX_ATTEMPTS:
+        status = ImageJob.PENDING
+    else:
+        status = ImageJob.FAILED
+        Picture.objects.filter(pk=job.picture_id)\
+            .update(status=Picture.FAILED)
+
+    ImageJob.objects.filter(pk=job.pk).update(status=status, error=error)
+
+
+def requeue_stale():
+    stale = ImageJob.objects.filter(
+        status=ImageJob.RUNNING,
+        claimed_on__lt=timezone.now() - CLAIM_TIMEOUT
+    )
+
+    for job in stale.filter(attempts__gte=MAX_ATTEMPTS):
+        fail(job, 'Worker did not finish the job')
+
+    return stale.update(status=ImageJob.PENDING)
@@ -0,0 +1,77 @@
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import RequestFactory
+from django.views.static import serve
+
+from picshr.media import serve_media
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = 'Compares the media view with django.views.static.serve.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=500,
+                    help='Number of requests per measurement.'),
+    )
+
+    def handle(self, *args, **options):
+        path = args[0] if args else self.largest_file()
+        factory = RequestFactory()
+        url = settings.MEDIA_URL + path
+
+        tag = serve_media(factory.get(url), path)['ETag']
+        scenarios = (
+            ('full', {}),
+            ('if-none-match', {'HTTP_IF_NONE_MATCH': tag}),
+            ('range 64 KiB', {'HTTP_RANGE': 'bytes=0-65535'}),
+        )
+
+        self.stdout.write('%s (%d bytes), %d requests' % (
+            path, os.path.getsize(os.path.join(settings.MEDIA_ROOT, path)),
+            options['requests']))
+        self.stdout.write('%-16s %12s %12s %10s' % (
+            'Request', 'static req/s', 'media req/s', 'bytes'))
+
+        for name, headers in scenarios:
+            request = factory.get(url, **headers)
+            old_rate, _ = self.measure(
+                lambda: serve(request, path, settings.MEDIA_ROOT),
+                options['requests'])
+            new_rate, size = self.measure(
+                lambda: serve_media(request, path), options['requests'])
+
+            self.stdout.write('%-16s %12.1f %12.1f %10d' % (
+                name, old_rate, new_rate, size))
+
+    def measure(self, view, requests):
+        size = 0
+        start = time.time()
+
+        for _ in range(requests):
+            response = view()
+
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+
+        return requests / (time.time() - start), size
+
+    def largest_file(self):
+        files = []
+
+        for root, _, names in os.walk(settings.MEDIA_ROOT):
+            for name in names:
+                full_path = os.path.join(root, name)
+                files.append((os.path.getsize(full_path), full_path))
+
+        if not files:
+            raise CommandError('There are no media files.')
+
+        return os.path.relpath(max(files)[1], settings.MEDIA_ROOT)\
+            .replace(os.sep, '/')
@@ -0,0 +1,244 @@
+import random
+from io import BytesIO
+from optparse import make_option
+
+from PIL import Image
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from picshr import feed, renditions, search
+from picshr.models import Picture, Comment, Friend, FriendRequest, MediaBlob
+from picshr.storage import media_storage
+from picshr.testing import PASSWORD
+
+
+WORDS = ('sunset', 'beach', 'city', 'mountain', 'forest', 'party', 'dog',
+         'cat', 'lake', 'snow', 'road', 'trip', 'friends', 'dinner', 'old',
+         'new', 'great', 'nice', 'shot', 'view', 'wow', 'love', 'this',
+         'summer', 'winter', 'morning', 'night', 'river', 'bridge', 'sky')
+IMAGE_SIZES = ((1600, 1200), (1200, 1600), (2048, 1536), (1024, 768))
+
+
+class Command(BaseCommand):
+    help = 'Generates synthetic users, friendships, pictures, likes, ' \
+           'tags and comments.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+                    help='Number of users.'),
+        make_option('--friends', type='int', default=10,
+                    help='Mean number of friends per user.'),
+        make_option('--pictures', type='int', default=10,
+                    help='Mean number of pictures per user.'),
+        make_option('--likes', type='int', default=5,
+                    help='Mean number of likes per picture.'),
+        make_option('--comments', type='int', default=2,
+                    help='Mean number of comments per picture.'),
+        make_option('--tags', type='int', default=1,
+                    help='Mean number of tags per picture.'),
+        make_option('--images', type='int', default=50,
+                    help='Number of distinct image files.'),
+        make_option('--prefix', default='synth',
+                    help='Prefix of the generated usernames.'),
+        make_option('--seed', type='int', default=None,
+                    help='Seed of the random generator.'),
+        make_option('--clear', action='store_true', default=False,
+                    help='Delete the users generated with the same prefix '
+                         'first.'),
+    )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        prefix = options['prefix']
+        existing = User.objects.filter(username__startswith=prefix)
+
+        if existing.exists():
+            if not options['clear']:
+                raise CommandError('Users starting with "%s" already exist, '
+                                   'use --clear to replace them.' % prefix)
+
+            for user in existing:
+                user.delete()
+
+            media_storage.collect(renditions.names)
+
+        with transaction.atomic():
+            users = self.create_users(prefix, options['users'])
+            adjacency = self.create_friends(users, options['friends'])
+            pictures = self.create_pictures(users)
+            self.create_likes_tags_comments(users, adjacency, pictures)
+            self.retain_images(pictures)
+
+            for user in User.objects.filter(username__startswith=prefix):
+                feed.rebuild(user)
+
+        search.rebuild()
+
+        self.stdout.write('Generated %d users, %d friendships, %d pictures '
+                          'and %d image files, the password is "%s"' % (
+                              len(users), sum(map(len, adjacency.values()))
+                              // 2, len(pictures), len(self.images),
+                              PASSWORD))
+
+    def create_users(self, prefix, count):
+        password = make_password(PASSWORD)
+        width = len(str(count - 1))
+
+        User.objects.bulk_create([
+            User(username='%s%0*d' % (prefix, width, i), password=password,
+                 email='%s%d@example.com' % (prefix, i))
+            for i in range(count)])
+
+        return list(User.objects.filter(username__startswith=prefix)
+                    .order_by('pk').values_list('pk', flat=True))
+
+    def create_friends(self, users, mean_degree):
+        attach = max(mean_degree // 2, 1)
+        adjacency = dict((user, set()) for user in users)
+        endpoints = []
+
+        for i, user in enumerate(users):
+            if i <= attach:
+                targets = set(users[:i])
+            else:
+                targets = set()
+
+                while len(targets) < attach:
+                    targets.add(self.rng.choice(endpoints))
+
+            for target in targets:
+                adjacency[user].add(target)
+                adjacency[target].add(user)
+                endpoints.extend((user, target))
+
+        Friend.objects.bulk_create([
+            Friend(is_friend_id=user, friend_to_id=other)
+            for user, others in adjacency.items() for other in others])
+
+        requests = []
+
+        for user in users:
+            other = self.rng.choice(users)
+
+            if other != user and other not in adjacency[user]:
+                requests.append(FriendRequest(req_from_id=other,
+                                              req_to_id=user))
+
+        FriendRequest.objects.bulk_create(requests)
+
+        return adjacency
+
+    def create_pictures(self, users):
+        mean = self.options['pictures']
+        self.images = {}
+        planned = []
+
+        for user in users:
+            count = int(self.rng.expovariate(1.0 / mean)) if mean else 0
+
+            for _ in range(count):
+                planned.append(Picture(
+                    title=self.sentence(1, 3)[:30], author_id=user,
+                    image=self.image_name(),
+                    is_public=self.rng.random() < 0.7, status=Picture.READY,
+                    has_renditions=True,
+                    like_count=self.popularity(self.options['likes'],
+                                               len(users) - 1),
+                    comment_count=self.popularity(self.options['comments'],
+                                                  len(users))))
+
+        Picture.objects.bulk_create(planned)
+
+        ids = Picture.objects.filter(author_id__gte=users[0]).order_by(
+            'pk').values_list('pk', flat=True)[:len(planned)]
+
+        for picture, pk in zip(planned, ids):
+            picture.pk = pk
+
+        return planned
+
+    def create_likes_tags_comments(self, users, adjacency, pictures):
+        likes = []
+        tags = []
+        comments = []
+
+        for picture in pictures:
+            author = picture.author_id
+            friends = list(adjacency[author])
+            others = [user for user in self.rng.sample(
+                users, min(picture.like_count + 1, len(users)))
+                if user != author][:picture.like_count]
+
+            likes.extend(Picture.likes.through(picture_id=picture.pk,
+                                               user_id=user)
+                         for user in others)
+
+            tagged = self.rng.sample(friends, min(
+                self.popularity(self.options['tags'], len(friends)),
+                len(friends)))
+            tags.extend(Picture.tags.through(picture_id=picture.pk,
+                                             user_id=user)
+                        for user in tagged)
+
+            commenters = friends + [author]
+
+            comments.extend(Comment(
+                author_id=self.rng.choice(commenters),
+                on_picture_id=picture.pk, content=self.sentence(2, 12))
+                for _ in range(picture.comment_count))
+
+        Picture.likes.through.objects.bulk_create(likes)
+        Picture.tags.through.objects.bulk_create(tags)
+        Comment.objects.bulk_create(comments)
+
+    def retain_images(self, pictures):
+        uses = {}
+
+        for picture in pictures:
+            uses[picture.image.name] = uses.get(picture.image.name, 0) + 1
+
+        for name, count in uses.items():
+            MediaBlob.objects.filter(name=name).update(
+                refcount=F('refcount') + count - 1)
+
+    def popularity(self, mean, limit):
+        if not mean or limit <= 0:
+            return 0
+
+        alpha = 1.5
+        value = (self.rng.paretovariate(alpha) - 1) * mean * (alpha - 1)
+        return min(int(value), limit)
+
+    def sentence(self, shortest, longest):
+        words = [self.rng.choice(WORDS)
+                 for _ in range(self.rng.randint(shortest, longest))]
+        return ' '.join(words).capitalize()
+
+    def image_name(self):
+        index = self.rng.randrange(self.options['images'])
+
+        if index not in self.images:
+            self.images[index] = media_storage.save_upload(
+                'synthetic.jpg', ContentFile(self.image_data(index)))
+            renditions.generate_file(media_storage, self.images[index])
+
+        return self.images[index]
+
+    def image_data(self, index):
+        size = IMAGE_SIZES[index % len(IMAGE_SIZES)]
+        gradient = Image.linear_gradient('L').resize(size)
+        noise = Image.effect_noise(size, self.rng.randint(10, 60))
+        image = Image.merge('RGB', (gradient, noise,
+                                    gradient.rotate(self.rng.randint(0, 359))
+                                    .resize(size)))
+        tint = Image.new('RGB', size, tuple(self.rng.randrange(256)
+                                            for _ in range(3)))
+
+        data = BytesIO()
+        Image.blend(image, tint, 0.5).save(data, 'JPEG', quality=90)
+        return data.getvalue()
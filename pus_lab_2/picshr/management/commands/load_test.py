@@ -0,0 +1,234 @@
+import json
+import time
+import random
+import threading
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from picshr import instrumentation
+from picshr.instrumentation import request_stats
+from picshr.models import Picture
+from picshr.testing import PASSWORD
+
+
+SCENARIOS = (
+    ('user_detail', 15),
+    ('picture_detail', 30),
+    ('my_pictures', 10),
+    ('friends_pictures', 15),
+    ('public_pictures', 15),
+    ('search_users', 10),
+    ('like_picture', 5),
+)
+PERCENTILES = (50, 90, 99)
+SAMPLE_SIZE = 500
+
+
+def percentile(latencies, percent):
+    index = int(round(percent / 100.0 * len(latencies) + 0.5)) - 1
+    return latencies[min(max(index, 0), len(latencies) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Runs a scripted load test against the picshr views.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', type='int', default=1000,
+                    help='Number of measured requests.'),
+        make_option('--warmup', type='int', default=100,
+                    help='Number of requests before measuring.'),
+        make_option('--concurrency', type='int', default=4,
+                    help='Number of simulated clients.'),
+        make_option('--prefix', default='synth',
+                    help='Prefix of the usernames to log in as.'),
+        make_option('--seed', type='int', default=0,
+                    help='Seed of the random generators.'),
+        make_option('--output', default=None,
+                    help='Writes the results as JSON to this file.'),
+        make_option('--compare', default=None,
+                    help='Compares the results with a JSON file written '
+                         'by --output.'),
+    )
+
+    def handle(self, *args, **options):
+        users = list(User.objects.filter(
+            username__startswith=options['prefix'])
+            .values_list('pk', 'username')[:SAMPLE_SIZE])
+
+        if not users:
+            raise CommandError('There are no users starting with "%s", run '
+                               'generate_data first.' % options['prefix'])
+
+        if not instrumentation.ENABLED:
+            self.stderr.write('PICSHR_INSTRUMENTATION is off, the query '
+                              'counts will not be recorded.')
+
+        self.users = users
+        self.pictures = list(Picture.objects.filter(is_public=True)
+                             .order_by('?')
+                             .values_list('pk', 'title')[:SAMPLE_SIZE])
+
+        if not self.pictures:
+            raise CommandError('There are no public pictures.')
+
+        self.words = sorted(set(word for _, title in self.pictures
+                                for word in title.lower().split()
+                                if len(word) >= 3))
+
+        self.run(options['warmup'], options['concurrency'], options['seed'])
+        request_stats.reset()
+
+        results = self.report(*self.run(
+            options['requests'], options['concurrency'],
+            options['seed'] + options['concurrency']))
+        results['options'] = dict(
+            (name, options[name])
+            for name in ('requests', 'warmup', 'concurrency', 'prefix',
+                         'seed'))
+
+        if options['compare']:
+            with open(options['compare']) as previous:
+                self.compare(json.load(previous), results)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+    def run(self, requests, concurrency, seed):
+        samples = []
+        lock = threading.Lock()
+        counts = [requests // concurrency + (i < requests % concurrency)
+                  for i in range(concurrency)]
+
+        workers = [threading.Thread(target=self.work,
+                                    args=(count, seed + i, samples, lock))
+                   for i, count in enumerate(counts)]
+
+        start = time.time()
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        return samples, time.time() - start
+
+    def work(self, requests, seed, samples, lock):
+        rng = random.Random(seed)
+        user_id, username = rng.choice(self.users)
+        client = Client()
+        client.login(username=username, password=PASSWORD)
+        names = [name for name, weight in SCENARIOS for _ in range(weight)]
+
+        try:
+            for _ in range(requests):
+                name = rng.choice(names)
+                method, url, data = self.request(rng, name, user_id)
+                start = time.time()
+
+                try:
+                    status = getattr(client, method)(url, data).status_code
+                except Exception:
+                    status = None
+
+                elapsed = time.time() - start
+
+                with lock:
+                    samples.append((name, elapsed, status))
+        finally:
+            connection.close()
+
+    def request(self, rng, name, user_id):
+        username = rng.choice(self.users)[1]
+        picture_id = rng.choice(self.pictures)[0]
+
+        if name == 'user_detail':
+            return 'get', reverse(name, args=(username,)), {}
+        elif name == 'picture_detail':
+            return 'get', reverse(name, args=(picture_id,)), {}
+        elif name == 'search_users':
+            return 'get', reverse(name), {
+                'query': rng.choice(self.words) if self.words else username}
+        elif name == 'like_picture':
+            return 'post', reverse(name, args=(picture_id, user_id)), {}
+        else:
+            return 'get', reverse(name), {}
+
+    def report(self, samples, elapsed):
+        stats = request_stats.snapshot()
+        results = {'elapsed': elapsed, 'requests': len(samples),
+                   'throughput': len(samples) / elapsed, 'scenarios': {}}
+
+        self.stdout.write('%d requests in %.2f s, %.1f req/s' % (
+            len(samples), elapsed, results['throughput']))
+        self.stdout.write('%-17s %8s %6s %8s %8s %8s %8s %8s %7s' % (
+            'Scenario', 'requests', 'errors', 'mean ms', 'p50 ms', 'p90 ms',
+            'p99 ms', 'max ms', 'queries'))
+
+        for name, _ in SCENARIOS:
+            latencies = sorted(elapsed for sample_name, elapsed, _ in samples
+                               if sample_name == name)
+
+            if not latencies:
+                continue
+
+            errors = sum(1 for sample_name, _, status in samples
+                         if sample_name == name and
+                         (status is None or status >= 400))
+            scenario = {
+                'requests': len(latencies),
+                'errors': errors,
+                'mean': sum(latencies) / len(latencies),
+                'max': latencies[-1],
+                'queries': stats.get(name, {}).get('mean_queries', 0),
+            }
+
+            for percent in PERCENTILES:
+                scenario['p%d' % percent] = percentile(latencies, percent)
+
+            results['scenarios'][name] = scenario
+
+            self.stdout.write(
+                '%-17s %8d %6d %8.1f %8.1f %8.1f %8.1f %8.1f %7.1f' % (
+                    name, len(latencies), errors, scenario['mean'] * 1000,
+                    scenario['p50'] * 1000, scenario['p90'] * 1000,
+                    scenario['p99'] * 1000, scenario['max'] * 1000,
+                    scenario['queries']))
+
+        return results
+
+    def compare(self, previous, current):
+        self.stdout.write('')
+        self.stdout.write('Compared with the previous run: throughput '
+                          '%.1f -> %.1f req/s (%+.1f%%)' % (
+                              previous['throughput'], current['throughput'],
+                              self.change(previous['throughput'],
+                                          current['throughput'])))
+        self.stdout.write('%-17s %16s %16s %16s' % (
+            'Scenario', 'p50 ms', 'p99 ms', 'queries'))
+
+        for name, _ in SCENARIOS:
+            old = previous['scenarios'].get(name)
+            new = current['scenarios'].get(name)
+
+            if old is None or new is None:
+                continue
+
+            self.stdout.write('%-17s %7.1f %+7.1f%% %7.1f %+7.1f%% '
+                              '%7.1f %+7.1f%%' % (
+                                  name, new['p50'] * 1000,
+                                  self.change(old['p50'], new['p50']),
+                                  new['p99'] * 1000,
+                                  self.change(old['p99'], new['p99']),
+                                  new['queries'],
+                                  self.change(old['queries'],
+                                              new['queries'])))
+
+    def change(self, old, new):
+        return (new - old) * 100.0 / old if old else 0.0
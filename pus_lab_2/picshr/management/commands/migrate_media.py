@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from picshr import jobs, renditions
+from picshr.models import Picture
+from picshr.storage import media_storage, PREFIX
+
+
+class Command(BaseCommand):
+    help = 'Moves picture originals into the content addressed storage.'
+
+    def handle(self, *args, **options):
+        migrated = {}
+
+        for picture in Picture.objects.exclude(image__startswith=PREFIX):
+            old = picture.image.name
+
+            if old not in migrated:
+                if not media_storage.exists(old):
+                    self.stderr.write('Missing file %s of picture %d' % (
+                        old, picture.pk))
+                    continue
+
+                with media_storage.open(old) as original:
+                    migrated[old] = media_storage.save_upload(old, original)
+            else:
+                media_storage.retain(migrated[old])
+
+            Picture.objects.filter(pk=picture.pk).update(
+                image=migrated[old], has_renditions=False)
+            jobs.enqueue(picture)
+            self.stdout.write('%s -> %s' % (old, migrated[old]))
+
+        for old in migrated:
+            for path in [old] + [renditions.rendition_name(old, width)
+                                 for width in renditions.WIDTHS]:
+                media_storage.delete(path)
+
+        self.stdout.write('Migrated %d files, %d unique' % (
+            len(migrated), len(set(migrated.values()))))
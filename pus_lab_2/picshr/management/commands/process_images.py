@@ -0,0 +1,68 @@
+import time
+import multiprocessing
+import traceback
+from optparse import make_option
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from picshr import jobs, renditions
+from picshr.storage import media_storage
+
+
+class Command(BaseCommand):
+    help = 'Processes uploaded pictures queued in the database.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=None,
+                    help='Number of image processing processes.'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds to wait when the queue is empty.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit when the queue is empty.'),
+        make_option('--missing', action='store_true', default=False,
+                    help='First queue the pictures without renditions.'),
+    )
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or multiprocessing.cpu_count()
+
+        if options['missing']:
+            self.stdout.write('Queued %d pictures without renditions' %
+                              jobs.enqueue_missing())
+
+        connection.close()
+
+        with ProcessPoolExecutor(workers) as pool:
+            while True:
+                jobs.requeue_stale()
+                claimed = jobs.claim(workers * 2)
+
+                if not claimed:
+                    media_storage.collect(renditions.names)
+
+                    if options['once']:
+                        break
+
+                    time.sleep(options['interval'])
+                    continue
+
+                futures = dict((pool.submit(renditions.process,
+                                            job.picture), job)
+                               for job in claimed)
+
+                for future in as_completed(futures):
+                    self.finish(futures[future], future)
+
+    def finish(self, job, future):
+        try:
+            future.result()
+        except Exception as error:
+            jobs.fail(job, ''.join(traceback.format_exception_only(
+                type(error), error)).strip())
+            self.stderr.write('Picture %d failed: %s' % (job.picture_id,
+                                                         error))
+        else:
+            jobs.complete(job)
+            self.stdout.write('Picture %d processed' % job.picture_id)
@@ -0,0 +1,22 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from picshr import feed
+
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Rebuilds the materialized friends feeds of the given users.'
+
+    def handle(self, *usernames, **options):
+        users = User.objects.all()
+
+        if usernames:
+            users = users.filter(username__in=usernames)
+
+        for user in users:
+            with transaction.atomic():
+                feed.rebuild(user)
+
+            self.stdout.write('Rebuilt the feed of %s' % user.username)
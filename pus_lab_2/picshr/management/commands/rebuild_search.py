@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from picshr import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full text search index of users, pictures and ' \
+           'comments.'
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            raise CommandError('Full text search needs the SQLite backend.')
+
+        with transaction.atomic():
+            search.rebuild()
+
+        self.stdout.write('Rebuilt the search index')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from picshr.models import Picture, Comment
+
+
+REPAIR_SQL = """
+UPDATE {picture} SET
+    like_count = (SELECT COUNT(*) FROM {likes}
+                  WHERE {likes}.picture_id = {picture}.id),
+    comment_count = (SELECT COUNT(*) FROM {comment}
+                     WHERE {comment}.on_picture_id = {picture}.id)
+"""
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the like and comment counters of all pictures.'
+
+    def handle(self, *args, **options):
+        qn = connection.ops.quote_name
+        sql = REPAIR_SQL.format(
+            picture=qn(Picture._meta.db_table),
+            likes=qn(Picture.likes.through._meta.db_table),
+            comment=qn(Comment._meta.db_table))
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(sql)
+
+        self.stdout.write('Repaired the counters of %d pictures' %
+                          cursor.rowcount)
@@ -0,0 +1,226 @@
+import os
+import re
+import stat
+import hashlib
+import posixpath
+import mimetypes
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse, HttpResponseNotModified,\
+    StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.six.moves.urllib.parse import unquote
+
+from picshr import renditions
+from picshr.models import Picture
+
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+MUTABLE_MAX_AGE = 60 * 60
+PRIVATE_KEY = 'picshr:media:%s:private'
+PRIVATE_TIMEOUT = 60
+
+IMMUTABLE_PATHS = [re.compile(pattern) for pattern in getattr(
+    settings, 'PICSHR_IMMUTABLE_MEDIA', (r'\.w\d+\.\w+$', r'^originals/'))]
+SENDFILE = getattr(settings, 'PICSHR_SENDFILE', None)
+SENDFILE_PREFIX = getattr(settings, 'PICSHR_SENDFILE_PREFIX', '/protected/')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def resolve(path):
+    path = posixpath.normpath(unquote(path)).lstrip('/')
+
+    if not path or path.startswith('..') or '\\' in path or '\0' in path:
+        raise Http404
+
+    return path, os.path.join(settings.MEDIA_ROOT, *path.split('/'))
+
+
+def etag(stats):
+    return '"%x-%x"' % (int(stats.st_mtime * 1000000), stats.st_size)
+
+
+def is_immutable(path):
+    return any(pattern.search(path) for pattern in IMMUTABLE_PATHS)
+
+
+def private_key(name):
+    return PRIVATE_KEY % hashlib.md5(name.encode('utf-8')).hexdigest()
+
+
+def is_private(path):
+    name = renditions.original_name(path)
+    key = private_key(name)
+    private = cache.get(key)
+
+    if private is None:
+        private = Picture.objects.filter(image=name, is_public=False).exists()
+        cache.set(key, private, PRIVATE_TIMEOUT)
+
+    return private
+
+
+def forget_private(*names):
+    cache.delete_many([private_key(name) for name in names])
+
+
+@receiver(post_save, sender=Picture)
+@receiver(post_delete, sender=Picture)
+def forget_picture(sender, instance, **kwargs):
+    forget_private(instance.image.name)
+
+
+def not_modified(request, tag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+
+    if if_none_match is not None:
+        tags = [value.strip() for value in if_none_match.split(',')]
+        return '*' in tags or tag in tags
+
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+
+    return if_modified_since is not None and int(mtime) <= if_modified_since
+
+
+def byte_range(request, tag, mtime, size):
+    header = request.META.get('HTTP_RANGE')
+
+    if header is None or request.method not in ('GET', 'HEAD'):
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if if_range is not None and if_range != tag and \
+            if_range != http_date(mtime):
+        return None
+
+    match = RANGE_RE.match(header.strip())
+
+    if match is None:
+        return None
+
+    first, last = match.groups()
+
+    if not first and not last:
+        return None
+
+    if not first:
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+
+    if first > last or first >= size:
+        return False
+
+    return first, last
+
+
+def read_file(path, first, length):
+    with open(path, 'rb') as media_file:
+        media_file.seek(first)
+
+        while length > 0:
+            chunk = media_file.read(min(CHUNK_SIZE, length))
+
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, path):
+    path, full_path = resolve(path)
+
+    try:
+        stats = os.stat(full_path)
+    except OSError:
+        raise Http404
+
+    if not stat.S_ISREG(stats.st_mode):
+        raise Http404
+
+    tag = etag(stats)
+    mtime = stats.st_mtime
+    size = stats.st_size
+
+    if is_immutable(path):
+        cache_control = 'max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    else:
+        cache_control = 'max-age=%d' % MUTABLE_MAX_AGE
+
+    if is_private(path):
+        cache_control = 'private, ' + cache_control
+    else:
+        cache_control = 'public, ' + cache_control
+
+    if not_modified(request, tag, mtime):
+        response = HttpResponseNotModified()
+    elif SENDFILE is not None:
+        response = sendfile_response(path, full_path)
+    else:
+        response = file_response(request, full_path, tag, mtime, size)
+
+    response['ETag'] = tag
+    response['Last-Modified'] = http_date(mtime)
+    response['Cache-Control'] = cache_control
+    response['X-Content-Type-Options'] = 'nosniff'
+
+    return response
+
+
+def sendfile_response(path, full_path):
+    response = HttpResponse()
+    response['Content-Type'] = guess_type(full_path)
+
+    if SENDFILE == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = SENDFILE_PREFIX + path
+    else:
+        response['X-Sendfile'] = full_path
+
+    return response
+
+
+def file_response(request, full_path, tag, mtime, size):
+    requested = byte_range(request, tag, mtime, size)
+
+    if requested is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    first, last = requested or (0, size - 1)
+    length = last - first + 1
+
+    if request.method == 'HEAD':
+        response = HttpResponse()
+    else:
+        response = StreamingHttpResponse(read_file(full_path, first, length))
+
+    if requested:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+
+    response['Content-Type'] = guess_type(full_path)
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+
+    return response
+
+
+def guess_type(full_path):
+    content_type, encoding = mimetypes.guess_type(full_path)
+    return content_type or 'application/octet-stream'
+
+
+class MediaMiddleware(object):
+    def process_request(self, request):
+        if request.path.startswith(settings.MEDIA_URL):
+            return serve_media(request, request.path[len(settings.MEDIA_URL):])
@@ -1,6 +1,11 @@
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
+from picshr import renditions
+from picshr.storage import media_storage
+
 
 def upload_where(instance, filename):
     return '%s/%s' % (instance.author.username, filename)
@@ -19,19 +24,47 @@ class Friend(models.Model):
     is_friend = models.ForeignKey(User, related_name="is_friend_set")
     friend_to = models.ForeignKey(User, related_name="friend_to_set")
 
+    class Meta:
+        index_together = (("is_friend", "friend_to"),)
+
     def __str__(self):
         return "%s is friend to %s" % (self.is_friend.username,
                                        self.friend_to.username)
 
 
 class Picture(models.Model):
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Processing'), (READY, 'Ready'),
+                      (FAILED, 'Failed'))
+
     title = models.CharField(max_length=30)
-    image = models.ImageField(upload_to=upload_where)
+    image = models.ImageField(upload_to=upload_where, storage=media_storage,
+                              db_index=True)
     author = models.ForeignKey(User)
     is_public = models.BooleanField()
     likes = models.ManyToManyField(User, related_name="likes", blank=True)
     tags = models.ManyToManyField(User, related_name="tags", blank=True)
     submitted_on = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=READY)
+    has_renditions = models.BooleanField(default=False)
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        index_together = (("submitted_on", "id"),
+                          ("author", "submitted_on", "id"))
+
+    def thumbnail_url(self):
+        return renditions.url(self, renditions.LIST_WIDTH)
+
+    def detail_url(self):
+        return renditions.url(self, renditions.DETAIL_WIDTH)
+
+    def srcset(self):
+        return renditions.srcset(self)
 
     def __str__(self):
         return "%s (%s)" % (self.title, self.author.username)
@@ -44,4 +77,58 @@ class Comment(models.Model):
     content = models.TextField(max_length=140)
 
     def __str__(self):
-        return "%s (%s)" % (self.content, self.author.username)
\ No newline at end of file
+        return "%s (%s)" % (self.content, self.author.username)
+
+
+@receiver(post_delete, sender=Picture)
+def release_image(sender, instance, **kwargs):
+    media_storage.release(instance.image.name)
+
+
+class MediaBlob(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "%s (%d)" % (self.name, self.refcount)
+
+
+class FeedEntry(models.Model):
+    owner = models.ForeignKey(User, related_name="feed_entries")
+    picture = models.ForeignKey(Picture)
+    author = models.ForeignKey(User, related_name="+")
+    submitted_on = models.DateTimeField()
+
+    class Meta:
+        index_together = (("owner", "submitted_on", "picture"),
+                          ("owner", "author"))
+
+    def __str__(self):
+        return "%s in the feed of %s" % (self.picture.title,
+                                         self.owner.username)
+
+
+class ImageJob(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'),
+                      (DONE, 'Done'), (FAILED, 'Failed'))
+
+    picture = models.ForeignKey(Picture)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    claimed_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (("status", "created_on"),)
+
+    def __str__(self):
+        return "%s job for %s" % (self.status, self.picture.title)
+
+
+from picshr import fragments, search
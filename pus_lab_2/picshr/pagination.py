@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+PAGE_SIZE = getattr(settings, 'PICSHR_PAGE_SIZE', 20)
+
+
+def encode_cursor(picture):
+    submitted_on = picture.submitted_on
+
+    if timezone.is_aware(submitted_on):
+        submitted_on = timezone.make_naive(submitted_on, timezone.utc)
+
+    return '%s-%d' % (submitted_on.strftime(CURSOR_FORMAT), picture.pk)
+
+
+def decode_cursor(cursor):
+    try:
+        submitted_on, pk = cursor.split('-')
+        submitted_on = datetime.strptime(submitted_on, CURSOR_FORMAT)
+        pk = int(pk)
+    except ValueError:
+        raise Http404
+
+    if settings.USE_TZ:
+        submitted_on = timezone.make_aware(submitted_on, timezone.utc)
+
+    return submitted_on, pk
+
+
+def keyset(queryset, cursor, time_field='submitted_on', id_field='id'):
+    queryset = queryset.order_by('-' + time_field, '-' + id_field)
+
+    if cursor:
+        submitted_on, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{time_field + '__lt': submitted_on}) |
+            Q(**{time_field: submitted_on, id_field + '__lt': pk}))
+
+    return queryset
+
+
+class KeysetPaginationMixin(object):
+    page_size = PAGE_SIZE
+    cursor_kwarg = 'after'
+
+    def get_page(self, queryset, cursor, size):
+        return list(keyset(queryset, cursor)[:size])
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+
+        object_list = self.get_page(queryset, cursor, page_size + 1)
+        has_next = len(object_list) > page_size
+        object_list = object_list[:page_size]
+
+        self.next_cursor = encode_cursor(object_list[-1]) \
+            if has_next else None
+
+        return None, None, object_list, has_next
+
+    def get_paginate_by(self, queryset):
+        return self.page_size
+
+    def get_context_data(self, **kwargs):
+        context = super(KeysetPaginationMixin, self).get_context_data(**kwargs)
+
+        context['next_cursor'] = self.next_cursor
+        context['cursor_kwarg'] = self.cursor_kwarg
+        context['is_first_page'] = \
+            self.cursor_kwarg not in self.request.GET
+
+        return context
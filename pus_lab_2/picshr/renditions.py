@@ -0,0 +1,118 @@
+import os
+import re
+from io import BytesIO
+
+from PIL import Image
+from django.core.files.base import ContentFile
+
+
+LIST_WIDTH = 480
+DETAIL_WIDTH = 1280
+WIDTHS = (240, LIST_WIDTH, 960, DETAIL_WIDTH)
+JPEG_QUALITY = 85
+RENDITION_RE = re.compile(r'\.w\d+(\.\w+)$')
+
+EXIF_ORIENTATION = 274
+ORIENTATION_TRANSPOSE = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.ROTATE_270, Image.FLIP_LEFT_RIGHT),
+    6: (Image.ROTATE_270,),
+    7: (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT),
+    8: (Image.ROTATE_90,),
+}
+
+
+def rendition_name(name, width):
+    root, ext = os.path.splitext(name)
+    return '%s.w%d%s' % (root, width, ext)
+
+
+def names(name, widths=WIDTHS):
+    return [rendition_name(name, width) for width in widths]
+
+
+def original_name(name):
+    return RENDITION_RE.sub(r'\1', name)
+
+
+def fix_orientation(image):
+    try:
+        exif = image._getexif() or {}
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        exif = {}
+
+    image_format = image.format
+
+    for method in ORIENTATION_TRANSPOSE.get(exif.get(EXIF_ORIENTATION), ()):
+        image = image.transpose(method)
+
+    image.format = image_format
+    return image
+
+
+def load(storage, name):
+    with storage.open(name) as original:
+        Image.open(original).verify()
+
+    with storage.open(name) as original:
+        image = Image.open(original)
+        image.load()
+
+    return fix_orientation(image)
+
+
+def generate_file(storage, name, widths=WIDTHS):
+    # Renditions of a blob never change, so existing ones are kept and a
+    # rendition saved meanwhile by a job for the same blob is not doubled
+    widths = [width for width in widths
+              if not storage.exists(rendition_name(name, width))]
+
+    if not widths:
+        return
+
+    image = load(storage, name)
+    image_format = image.format
+
+    for width in widths:
+        rendition = image.copy()
+        rendition.thumbnail((width, width * 4), Image.LANCZOS)
+
+        options = {}
+
+        if image_format == 'JPEG':
+            options['quality'] = JPEG_QUALITY
+            options['optimize'] = True
+
+            if rendition.mode not in ('RGB', 'L'):
+                rendition = rendition.convert('RGB')
+
+        data = BytesIO()
+        rendition.save(data, image_format, **options)
+
+        storage.store(rendition_name(name, width),
+                      ContentFile(data.getvalue()))
+
+
+def process(picture):
+    generate_file(picture.image.storage, picture.image.name)
+
+
+def url(picture, width):
+    if not picture.has_renditions:
+        return picture.image.url
+
+    return picture.image.storage.url(
+        rendition_name(picture.image.name, width))
+
+
+def srcset(picture, widths=WIDTHS):
+    if not picture.has_renditions:
+        return ''
+
+    storage = picture.image.storage
+
+    return ', '.join('%s %dw' % (
+        storage.url(rendition_name(picture.image.name, width)), width)
+        for width in widths)
@@ -0,0 +1,231 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.backends.sqlite3.base import Database
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, post_syncdb
+from django.dispatch import receiver
+
+from picshr.models import Picture, Comment, Friend
+from picshr.pagination import PAGE_SIZE
+
+
+TABLE = 'picshr_search'
+MIN_QUERY_LENGTH = 3
+MIN_SQLITE_VERSION = (3, 34, 0)
+
+USER = 0
+PICTURE = 1
+COMMENT = 2
+KINDS = 3
+
+CREATE_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS %s " \
+             "USING fts5(body, tokenize='trigram')" % TABLE
+
+
+_indexed = set()
+
+
+def supported():
+    if connection.vendor != 'sqlite' or \
+            Database.sqlite_version_info < MIN_SQLITE_VERSION:
+        return False
+
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("SELECT 1 FROM pragma_module_list WHERE name = 'fts5'")
+    except Database.DatabaseError:
+        return False
+
+    return cursor.fetchone() is not None
+
+
+def enabled():
+    if connection.vendor != 'sqlite':
+        return False
+
+    name = connection.settings_dict['NAME']
+
+    if name not in _indexed and supported() and \
+            TABLE in connection.introspection.table_names():
+        _indexed.add(name)
+
+    return name in _indexed
+
+
+def create_index():
+    if supported():
+        connection.cursor().execute(CREATE_SQL)
+        _indexed.add(connection.settings_dict['NAME'])
+
+
+def document_id(kind, pk):
+    return pk * KINDS + kind
+
+
+def index(kind, pk, body):
+    index_many(kind, [(pk, body)])
+
+
+def index_many(kind, documents):
+    if not enabled() or not documents:
+        return
+
+    cursor = connection.cursor()
+    rows = [(document_id(kind, pk), body) for pk, body in documents]
+
+    cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % TABLE,
+                       [(rowid,) for rowid, _ in rows])
+    cursor.executemany(
+        'INSERT INTO %s (rowid, body) VALUES (%%s, %%s)' % TABLE, rows)
+
+
+def unindex(kind, pk):
+    if enabled():
+        connection.cursor().execute(
+            'DELETE FROM %s WHERE rowid = %%s' % TABLE,
+            [document_id(kind, pk)])
+
+
+def rebuild():
+    create_index()
+
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s' % TABLE)
+
+    for kind, queryset, field in ((USER, User.objects, 'username'),
+                                  (PICTURE, Picture.objects, 'title'),
+                                  (COMMENT, Comment.objects, 'content')):
+        cursor.executemany(
+            'INSERT INTO %s (rowid, body) VALUES (%%s, %%s)' % TABLE,
+            [(document_id(kind, pk), body)
+             for pk, body in queryset.values_list('pk', field).iterator()])
+
+
+def visible_sql(user, picture):
+    if not user.is_authenticated():
+        return '%s.is_public' % picture, []
+
+    return '(%s.is_public OR %s.author_id = %%s OR EXISTS (' \
+           'SELECT 1 FROM %s f WHERE f.is_friend_id = %s.author_id ' \
+           'AND f.friend_to_id = %%s))' % (
+               picture, picture, Friend._meta.db_table, picture), \
+        [user.pk, user.pk]
+
+
+def match(kind, query, offset, limit, user=None):
+    if len(query) < MIN_QUERY_LENGTH:
+        return None
+
+    joins = ''
+    where, params = '1', []
+    pictures = Picture._meta.db_table
+
+    if kind == PICTURE:
+        joins = 'JOIN %s p ON p.id = %s.rowid / %d' % (pictures, TABLE,
+                                                      KINDS)
+        where, params = visible_sql(user, 'p')
+    elif kind == COMMENT:
+        joins = 'JOIN %s c ON c.id = %s.rowid / %d ' \
+                'JOIN %s p ON p.id = c.on_picture_id' % (
+                    Comment._meta.db_table, TABLE, KINDS, pictures)
+        where, params = visible_sql(user, 'p')
+
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT %s.rowid FROM %s %s WHERE %s MATCH %%s '
+        'AND %s.rowid %%%% %%s = %%s AND %s '
+        'ORDER BY %s.rank LIMIT %%s OFFSET %%s' % (
+            TABLE, TABLE, joins, TABLE, TABLE, where, TABLE),
+        ['"%s"' % query.replace('"', '""'), KINDS, kind] + params +
+        [limit, offset])
+
+    return [rowid // KINDS for rowid, in cursor.fetchall()]
+
+
+def ranked(queryset, ids):
+    objects = queryset.in_bulk(ids)
+    return [objects[pk] for pk in ids if pk in objects]
+
+
+def visible_pictures(user, prefix=''):
+    visible = Q(**{prefix + 'is_public': True})
+
+    if user.is_authenticated():
+        visible |= Q(**{prefix + 'author': user})
+        visible |= Q(**{prefix + 'author__is_friend_set__friend_to': user})
+
+    return visible
+
+
+def search(user, query, page=1, size=PAGE_SIZE):
+    query = query.strip()
+    offset = (page - 1) * size
+    results = {'users': [], 'pictures': [], 'comments': []}
+
+    if not query:
+        return results, False
+
+    sources = (
+        ('users', USER, User.objects.all(), 'username__icontains'),
+        ('pictures', PICTURE,
+         Picture.objects.filter(visible_pictures(user)).distinct()
+         .select_related('author'), 'title__icontains'),
+        ('comments', COMMENT,
+         Comment.objects.filter(visible_pictures(user, 'on_picture__'))
+         .distinct().select_related('author', 'on_picture'),
+         'content__icontains'),
+    )
+
+    has_next = False
+
+    for name, kind, queryset, lookup in sources:
+        ids = match(kind, query, offset, size + 1, user) \
+            if enabled() else None
+
+        if ids is None:
+            found = list(queryset.filter(**{lookup: query})
+                         .order_by('pk')[offset:offset + size + 1])
+            results[name] = found[:size]
+        else:
+            found = ids
+            results[name] = ranked(queryset, ids[:size])
+
+        has_next = has_next or len(found) > size
+
+    return results, has_next
+
+
+@receiver(post_syncdb)
+def create_index_on_syncdb(sender, **kwargs):
+    create_index()
+
+
+@receiver(post_save, sender=User)
+def index_user(sender, instance, **kwargs):
+    index(USER, instance.pk, instance.username)
+
+
+@receiver(post_save, sender=Picture)
+def index_picture(sender, instance, **kwargs):
+    index(PICTURE, instance.pk, instance.title)
+
+
+@receiver(post_save, sender=Comment)
+def index_comment(sender, instance, **kwargs):
+    index(COMMENT, instance.pk, instance.content)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    unindex(USER, instance.pk)
+
+
+@receiver(post_delete, sender=Picture)
+def unindex_picture(sender, instance, **kwargs):
+    unindex(PICTURE, instance.pk)
+
+
+@receiver(post_delete, sender=Comment)
+def unindex_comment(sender, instance, **kwargs):
+    unindex(COMMENT, instance.pk)
@@ -0,0 +1,133 @@
+import os
+import hashlib
+from collections import Counter
+
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, transaction
+from django.db.models import F, get_model
+
+
+PREFIX = 'originals/'
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+HASH_CHUNK = 64 * 1024
+
+
+def content_name(digest, ext):
+    return '%s%s/%s/%s%s' % (PREFIX, digest[:2], digest[2:4], digest,
+                             ext.lower())
+
+
+def is_picture_name(name):
+    return os.path.splitext(name)[1].lower() in EXTENSIONS
+
+
+def content_digest(content):
+    sha256 = hashlib.sha256()
+
+    for chunk in content.chunks(HASH_CHUNK):
+        sha256.update(chunk)
+
+    content.seek(0)
+    return sha256.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def save_upload(self, name, content):
+        return self.save_many([(name, content)])[0]
+
+    def save_many(self, files, written=None):
+        files = [(content_name(content_digest(content),
+                               os.path.splitext(name)[1]), content)
+                 for name, content in files]
+        names = [name for name, _ in files]
+        self.retain_many(names)
+
+        try:
+            for name, content in files:
+                if self.store(name, content) and written is not None:
+                    written.append(name)
+        except Exception:
+            self.release_many(names)
+            raise
+
+        return names
+
+    def store(self, name, content):
+        if self.exists(name):
+            return False
+
+        saved = super(ContentAddressedStorage, self)._save(name, content)
+
+        if saved != name:
+            self.delete(saved)
+            return False
+
+        return True
+
+    def retain(self, name):
+        self.retain_many([name])
+
+    def retain_many(self, names):
+        blob_model = get_model('picshr', 'MediaBlob')
+        counts = Counter(names)
+
+        with transaction.atomic():
+            existing = set(blob_model.objects.filter(name__in=counts)
+                           .values_list('name', flat=True))
+
+            for name in existing:
+                blob_model.objects.filter(name=name).update(
+                    refcount=F('refcount') + counts[name])
+
+            blob_model.objects.bulk_create([
+                blob_model(name=name, refcount=count)
+                for name, count in counts.items() if name not in existing])
+
+    def release(self, name):
+        self.release_many([name])
+
+    def release_many(self, names):
+        blob_model = get_model('picshr', 'MediaBlob')
+
+        for name, count in Counter(names).items():
+            blob_model.objects.filter(name=name).update(
+                refcount=F('refcount') - count)
+
+    def collect(self, derived=lambda name: ()):
+        blob_model = get_model('picshr', 'MediaBlob')
+        cursor = connection.cursor()
+        collected = []
+
+        for name in list(blob_model.objects.filter(refcount__lte=0)
+                         .values_list('name', flat=True)):
+            cursor.execute('DELETE FROM %s WHERE name = %%s AND refcount <= 0'
+                           % blob_model._meta.db_table, [name])
+
+            if cursor.rowcount and self.purge(name, derived(name)):
+                collected.append(name)
+
+        return collected
+
+    def purge(self, name, derived=()):
+        blob_model = get_model('picshr', 'MediaBlob')
+        path = self.path(name)
+        tombstone = '%s.%d.deleted' % (path, os.getpid())
+
+        try:
+            os.rename(path, tombstone)
+        except OSError:
+            return False
+
+        if blob_model.objects.filter(name=name).exists():
+            os.rename(tombstone, path)
+            return False
+
+        os.remove(tombstone)
+
+        for path in derived:
+            self.delete(path)
+
+        return True
+
+
+media_storage = ContentAddressedStorage()
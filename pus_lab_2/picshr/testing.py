@@ -0,0 +1,71 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from picshr.models import Picture, Comment, Friend, FriendRequest
+
+
+PASSWORD = 'picshare'
+
+
+def seed(users=10, friends=3, pictures=5, comments=2, likes=2, tags=1):
+    created = [User.objects.create_user('user%d' % i, '', PASSWORD)
+               for i in range(users)]
+
+    for i, user in enumerate(created):
+        for offset in range(1, friends + 1):
+            other = created[(i + offset) % users]
+
+            if other != user and not Friend.objects.filter(
+                    is_friend=user, friend_to=other).exists():
+                Friend.objects.create(is_friend=user, friend_to=other)
+                Friend.objects.create(is_friend=other, friend_to=user)
+
+        FriendRequest.objects.create(req_from=created[(i - 1) % users],
+                                     req_to=user)
+
+        for j in range(pictures):
+            picture = Picture.objects.create(
+                title='%s picture %d' % (user.username, j), image='x.jpg',
+                author=user, is_public=j % 2 == 0)
+
+            for k in range(1, comments + 1):
+                Comment.objects.create(
+                    author=created[(i + k) % users], on_picture=picture,
+                    content='comment %d' % k)
+
+            picture.likes.add(*[created[(i + k) % users]
+                                for k in range(1, likes + 1)])
+            picture.tags.add(*[created[(i + k) % users]
+                               for k in range(1, tags + 1)])
+
+            Picture.objects.filter(pk=picture.pk).update(
+                like_count=picture.likes.count(),
+                comment_count=picture.comment_set.count())
+
+    return created
+
+
+class QueryBudgetMixin(object):
+    def assertQueryBudget(self, budget, url, method='get', status_code=200,
+                          **params):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, params)
+
+            if getattr(response, 'streaming', False):
+                b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, status_code,
+                         '%s %s returned %d instead of %d'
+                         % (method.upper(), url, response.status_code,
+                            status_code))
+
+        executed = len(context)
+
+        if executed > budget:
+            self.fail('%s %s executed %d queries, over its budget of %d:\n%s'
+                      % (method.upper(), url, executed, budget,
+                         '\n'.join(query['sql']
+                                   for query in context.captured_queries)))
+
+        return response
@@ -1,3 +1,290 @@
+import shutil
+import hashlib
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.utils.six import StringIO
+
+from picshr import feed, views
+from picshr.instrumentation import request_stats, UNRESOLVED
+from picshr.models import Picture, Comment, Friend, FriendRequest, FeedEntry, \
+    ImageJob
+from picshr.storage import media_storage, content_name
+from picshr.testing import seed, QueryBudgetMixin, PASSWORD
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        seed()
+        self.client.login(username='user0', password=PASSWORD)
+
+    def test_picture_lists(self):
+        self.assertQueryBudget(3, reverse('my_pictures'))
+        self.assertQueryBudget(4, reverse('friends_pictures'))
+        self.assertQueryBudget(3, reverse('public_pictures'))
+
+    def test_picture_detail(self):
+        picture = Picture.objects.filter(author__username='user1')[0]
+        url = reverse('picture_detail', args=(picture.pk,))
+
+        self.assertQueryBudget(9, url)
+        self.assertQueryBudget(5, url)
+
+    def test_user_pages(self):
+        self.assertQueryBudget(13, reverse('user_detail', args=('user1',)))
+        self.assertQueryBudget(13, reverse('control_panel', args=('user0',)))
+
+    def test_search(self):
+        self.assertQueryBudget(6, reverse('search_users'), query='picture')
+
+    def test_unresolved_requests_share_a_key(self):
+        request_stats.reset()
+
+        for path in ('/missing/1/', '/missing/2/'):
+            self.client.get(path)
+
+        stats = request_stats.snapshot()
+
+        self.assertEqual(list(stats), [UNRESOLVED])
+        self.assertEqual(stats[UNRESOLVED]['requests'], 2)
+
+
+class FeedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fanout_limit = feed.FANOUT_LIMIT
+        feed.FANOUT_LIMIT = 2
+
+        self.hub, self.first, self.second, self.third = [
+            User.objects.create_user(username, '', PASSWORD)
+            for username in ('hub', 'first', 'second', 'third')]
+
+    def tearDown(self):
+        feed.FANOUT_LIMIT = self.fanout_limit
+
+    def befriend(self, user, other):
+        friend_req = FriendRequest.objects.create(req_from=other, req_to=user)
+
+        self.client.login(username=user.username, password=PASSWORD)
+        self.client.post(reverse('resolve_friend_req'),
+                         {'req_id': friend_req.pk, 'response': 'accept'})
+
+    def unfriend(self, user, other):
+        friend = Friend.objects.get(is_friend=user, friend_to=other)
+
+        self.client.login(username=user.username, password=PASSWORD)
+        self.client.post(reverse('delete_friend'), {'friend_id': friend.pk})
+
+    def publish(self, author, count=2):
+        author = User.objects.get(pk=author.pk)
+
+        for i in range(count):
+            feed.publish(Picture.objects.create(
+                title='%s picture %d' % (author.username, i), image='x.jpg',
+                author=author, is_public=False))
+
+    def assertFeed(self, user):
+        user = User.objects.get(pk=user.pk)
+        expected = list(Picture.objects.filter(
+            author__in=Friend.objects.filter(is_friend=user)
+            .values('friend_to')).order_by('-submitted_on', '-pk')
+            .values_list('pk', flat=True))
+
+        self.assertEqual([picture.pk for picture in feed.page(user, None, 50)],
+                         expected)
+
+    def assertFeeds(self):
+        for user in (self.hub, self.first, self.second, self.third):
+            self.assertFeed(user)
+
+    def test_authors_under_the_limit_are_fanned_out(self):
+        self.publish(self.hub)
+        self.publish(self.first, 1)
+        self.befriend(self.hub, self.first)
+        self.befriend(self.hub, self.second)
+        self.publish(self.hub, 1)
+
+        self.assertEqual(FeedEntry.objects.filter(author=self.hub).count(), 6)
+        self.assertFeeds()
+
+    def test_high_degree_authors_are_merged_on_read(self):
+        self.publish(self.hub)
+        self.befriend(self.hub, self.first)
+        self.befriend(self.hub, self.second)
+        self.assertFeeds()
+
+        self.befriend(self.hub, self.third)
+        self.publish(self.hub, 1)
+
+        self.assertFalse(FeedEntry.objects.filter(author=self.hub).exists())
+        self.assertFeeds()
+
+    def test_authors_dropping_under_the_limit_are_fanned_out_again(self):
+        self.publish(self.hub)
+        self.befriend(self.hub, self.first)
+        self.befriend(self.hub, self.second)
+        self.befriend(self.hub, self.third)
+        self.assertFeeds()
+
+        self.unfriend(self.third, self.hub)
+
+        self.assertEqual(FeedEntry.objects.filter(author=self.hub).count(), 4)
+        self.assertFeeds()
+
+
+class CounterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = seed(users=3, pictures=1, comments=0, likes=0, tags=0)[0]
+        self.picture = Picture.objects.filter(author=self.user)[0]
+        self.client.login(username='user0', password=PASSWORD)
+
+    def counts(self):
+        picture = Picture.objects.get(pk=self.picture.pk)
+        return picture.like_count, picture.comment_count
+
+    def comment(self, content):
+        self.client.post(reverse('submit_comment',
+                                 args=(self.picture.pk, self.user.pk)),
+                         {'content': content})
+
+    def assertDetail(self, text):
+        self.assertContains(self.client.get(
+            reverse('picture_detail', args=(self.picture.pk,))), text)
+
+    def test_likes_toggle_the_like_count(self):
+        url = reverse('like_picture', args=(self.picture.pk, self.user.pk))
+
+        self.client.post(url)
+        self.assertEqual(self.counts(), (1, 0))
+        self.assertDetail('Likes (1)')
+
+        self.client.post(url)
+        self.assertEqual(self.counts(), (0, 0))
+        self.assertDetail('Likes (0)')
+
+    def test_comments_update_the_comment_count(self):
+        self.comment('first')
+        self.comment('second')
+        self.comment('')
+        self.assertEqual(self.counts(), (0, 2))
+        self.assertDetail('Comments (2)')
+
+        self.client.post(reverse('delete_comment'), {
+            'comment_id': Comment.objects.get(content='first').pk})
+        self.assertEqual(self.counts(), (0, 1))
+        self.assertDetail('Comments (1)')
+
+    def test_repair_counters(self):
+        self.picture.likes.add(self.user)
+        self.comment('first')
+        Picture.objects.update(like_count=7, comment_count=-3)
+
+        call_command('repair_counters', stdout=StringIO())
+
+        self.assertEqual(self.counts(), (1, 1))
+        self.assertFalse(Picture.objects.exclude(pk=self.picture.pk)
+                         .exclude(like_count=0, comment_count=0).exists())
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.location = media_storage.base_location, media_storage.location
+        self.max_batch = views.MAX_BATCH
+        media_storage.base_location = media_storage.location = \
+            tempfile.mkdtemp()
+
+        self.users = seed(users=4, friends=1, pictures=1, comments=0,
+                          likes=0, tags=0)
+        self.user = self.users[0]
+        self.client.login(username='user0', password=PASSWORD)
+
+    def tearDown(self):
+        shutil.rmtree(media_storage.location)
+        media_storage.base_location, media_storage.location = self.location
+        views.MAX_BATCH = self.max_batch
+
+    def upload(self, **files):
+        return self.client.post(reverse('upload_pictures'), {
+            'files': [SimpleUploadedFile(name, content)
+                      for name, content in sorted(files.items())],
+            'tag_username': ['user1', 'user2'],
+            'visibility': 'public'})
+
+    def test_uploads_map_to_their_pictures(self):
+        existing = Picture.objects.create(
+            title='existing', author=self.user, is_public=False,
+            image=media_storage.save_upload('x.jpg', SimpleUploadedFile(
+                'x.jpg', b'first')))
+
+        self.upload(**{'a.jpg': b'first', 'b.jpg': b'second',
+                       'c.jpg': b'first'})
+
+        contents = {'a': b'first', 'b': b'second', 'c': b'first'}
+        pictures = Picture.objects.filter(title__in=contents)
+
+        self.assertEqual(len(pictures), 3)
+
+        for picture in pictures:
+            self.assertEqual(picture.image.name, content_name(
+                hashlib.sha256(contents[picture.title]).hexdigest(), '.jpg'))
+            self.assertEqual(picture.status, Picture.PENDING)
+            self.assertEqual(ImageJob.objects.filter(picture=picture).count(),
+                             1)
+            self.assertEqual([tag.username for tag in picture.tags.all()],
+                             ['user1'])
+
+        existing = Picture.objects.get(pk=existing.pk)
+        self.assertEqual(existing.title, 'existing')
+        self.assertFalse(existing.tags.exists())
+        self.assertFalse(ImageJob.objects.filter(picture=existing).exists())
+
+    def test_oversize_batches_are_rejected(self):
+        views.MAX_BATCH = 2
+        pictures = list(Picture.objects.values_list('pk', flat=True)[:3])
+        count = Picture.objects.count()
+
+        response = self.upload(**{'a.jpg': b'a', 'b.jpg': b'b',
+                                  'c.jpg': b'c'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Picture.objects.count(), count)
+
+        for name in ('like_pictures', 'add_tags'):
+            response = self.client.post(reverse(name), {
+                'picture_id': pictures, 'tag_username': 'user1'})
+            self.assertEqual(response.status_code, 400)
+
+        self.assertFalse(Picture.likes.through.objects.exists())
+        self.assertFalse(Picture.tags.through.objects.exists())
+
+    def test_batch_likes_count_each_picture_once(self):
+        first, second = Picture.objects.exclude(author=self.user)[:2]
+        first.likes.add(self.user)
+        Picture.objects.filter(pk=first.pk).update(like_count=1)
+
+        self.client.post(reverse('like_pictures'), {
+            'picture_id': [first.pk, second.pk, second.pk, 'x']})
+
+        self.assertEqual(
+            [Picture.objects.get(pk=pk).like_count
+             for pk in (first.pk, second.pk)], [1, 1])
+        self.assertEqual(Picture.likes.through.objects.count(), 2)
+
+    def test_batch_tags_only_own_pictures_and_friends(self):
+        own = Picture.objects.get(author=self.user)
+        other = Picture.objects.get(author=self.users[1])
+
+        self.client.post(reverse('add_tags'), {
+            'picture_id': [own.pk, other.pk],
+            'tag_username': ['user1', 'user2']})
+        self.client.post(reverse('add_tags'), {
+            'picture_id': [own.pk], 'tag_username': ['user1']})
 
-# Create your tests here.
+        self.assertEqual([tag.username for tag in own.tags.all()], ['user1'])
+        self.assertFalse(other.tags.exists())
@@ -1,10 +1,26 @@
+import os
+
+from django.conf import settings
 from django.shortcuts import get_object_or_404, render
 from django.views.generic import ListView, DetailView
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponseBadRequest
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.utils.http import is_safe_url
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from picshr.models import Picture, Comment, Friend, FriendRequest, \
+    upload_where
+from picshr import feed, fragments, friends, jobs, media, renditions, search
+from picshr.pagination import KeysetPaginationMixin, PAGE_SIZE
+from picshr.storage import media_storage, is_picture_name, EXTENSIONS
+
 
-from picshr.models import Picture, Comment, Friend, FriendRequest
+MAX_BATCH = getattr(settings, 'PICSHR_MAX_BATCH', 500)
 
 
 def user_details_view(request, username):
@@ -12,15 +28,8 @@ def user_details_view(request, username):
     public_pics = other_user.picture_set.filter(is_public=True)
     private_pics = None
 
-    private_access = False
-
-    if request.user.username == username:
-        private_access = True
-    else:
-        for friend in request.user.is_friend_set.all():
-            if username == friend.friend_to.username:
-                private_access = True
-                break
+    private_access = request.user.username == username or \
+        friends.are_friends(request.user, other_user)
 
     if private_access:
         private_pics = other_user.picture_set.filter(is_public=False)
@@ -34,21 +43,74 @@ class UserControlPanelView(DetailView):
     model = User
     slug_field = "username"
     template_name = "picshr/control_panel.html"
+    page_size = PAGE_SIZE
 
+    def get_context_data(self, **kwargs):
+        context = super(UserControlPanelView, self).get_context_data(**kwargs)
+        user = self.object
 
-def picture_details_view(request, picture_id):
-    picture = Picture.objects.get(pk=picture_id)
-    liked_picture = request.user in picture.likes.all()
+        sections = {
+            "friend_requests": user.req_to_set.select_related("req_from")
+            .order_by("-pk"),
+            "friends": user.is_friend_set.select_related("friend_to")
+            .order_by("friend_to__username"),
+            "pictures": user.picture_set.order_by("-submitted_on", "-id"),
+            "comments": user.comment_set.select_related("on_picture")
+            .order_by("-submitted_on", "-id"),
+            "tags": user.tags.order_by("-submitted_on", "-id"),
+        }
+
+        for name, queryset in sections.items():
+            context[name] = self.paginate_section(name, queryset)
+
+        return context
+
+    def paginate_section(self, name, queryset):
+        parameter = name + "_page"
+        paginator = Paginator(queryset, self.page_size)
+
+        try:
+            page = paginator.page(self.request.GET.get(parameter, 1))
+        except PageNotAnInteger:
+            page = paginator.page(1)
+        except EmptyPage:
+            page = paginator.page(paginator.num_pages)
+
+        query = self.request.GET.copy()
+
+        if page.has_previous():
+            query[parameter] = page.previous_page_number()
+            page.previous_query = query.urlencode()
 
-    friends_sel = [request.user.username]
-    for friend in request.user.is_friend_set.all():
-        friends_sel.append(friend.friend_to)
+        if page.has_next():
+            query[parameter] = page.next_page_number()
+            page.next_query = query.urlencode()
+
+        return page
+
+
+def tag_choices(user):
+    choices = [user.username]
+    choices.extend(User.objects.filter(pk__in=friends.friend_ids(user))
+                   .values_list('username', flat=True))
+
+    return choices
+
+
+def picture_details_view(request, picture_id):
+    picture = Picture.objects.select_related('author').get(pk=picture_id)
+    liked_picture = request.user.is_authenticated() and \
+        Picture.likes.through.objects.filter(picture=picture,
+                                             user=request.user).exists()
 
     return render(request, "picshr/picture_detail.html",
                   {"picture": picture, "liked_picture": liked_picture,
-                   "friends_sel": friends_sel})
+                   "friends_sel": tag_choices(request.user),
+                   "comments": picture.comment_set.select_related('author'),
+                   "version": fragments.version(picture.pk),
+                   "fragment_timeout": fragments.FRAGMENT_TIMEOUT})
 
-class UserPictureListView(ListView):
+class UserPictureListView(KeysetPaginationMixin, ListView):
     model = Picture
     template_name = 'picshr/picture_list.html'
 
@@ -56,17 +118,15 @@ class UserPictureListView(ListView):
         return Picture.objects.filter(author=self.request.user)
 
 
-class FriendsPictureListView(ListView):
+class FriendsPictureListView(KeysetPaginationMixin, ListView):
     model = Picture
     template_name = 'picshr/picture_list.html'
 
-    def get_queryset(self):
-        friends = [friend.friend_to for friend
-                   in self.request.user.is_friend_set.all()]
-        return Picture.objects.filter(author__in=friends)
+    def get_page(self, queryset, cursor, size):
+        return feed.page(self.request.user, cursor, size)
 
 
-class PublicPictureListView(ListView):
+class PublicPictureListView(KeysetPaginationMixin, ListView):
     model = Picture
     template_name = 'picshr/picture_list.html'
 
@@ -83,7 +143,12 @@ def submit_comment(request, picture_id, user_id):
         comment = Comment(content=content, author=user, on_picture=picture)
 
         if content:
-            comment.save()
+            with transaction.atomic():
+                comment.save()
+                Picture.objects.filter(pk=picture.pk).update(
+                    comment_count=F('comment_count') + 1)
+
+            fragments.bump(picture.pk)
     except KeyError:
         pass
 
@@ -93,12 +158,23 @@ def like_picture(request, picture_id, user_id):
     user = get_object_or_404(User, pk=user_id)
     picture = get_object_or_404(Picture, pk=picture_id)
 
-    if user in picture.likes.all():
-        picture.likes.remove(user)
-    else:
-        picture.likes.add(user)
+    likes = Picture.likes.through.objects.filter(picture=picture, user=user)
 
-    picture.save()
+    try:
+        with transaction.atomic():
+            if likes.exists():
+                picture.likes.remove(user)
+                delta = -1
+            else:
+                picture.likes.add(user)
+                delta = 1
+
+            Picture.objects.filter(pk=picture.pk).update(
+                like_count=F('like_count') + delta)
+    except IntegrityError:
+        pass
+
+    fragments.bump(picture.pk)
 
     return HttpResponseRedirect(reverse('picture_detail', args=(picture_id,)))
 
@@ -118,11 +194,13 @@ def resolve_friend_request(request):
         friend_req = FriendRequest.objects.get(pk=request.POST['req_id'])
 
         if request.POST['response'] == 'accept':
-            first = Friend(is_friend=user, friend_to=friend_req.req_from)
-            second = Friend(is_friend=friend_req.req_from, friend_to=user)
+            Friend.objects.get_or_create(is_friend=user,
+                                         friend_to=friend_req.req_from)
+            Friend.objects.get_or_create(is_friend=friend_req.req_from,
+                                         friend_to=user)
 
-            first.save()
-            second.save()
+            friends.invalidate(user, friend_req.req_from)
+            feed.connect(user, friend_req.req_from)
 
         friend_req.delete()
     except (KeyError, FriendRequest.DoesNotExist):
@@ -144,6 +222,9 @@ def delete_friend(request):
 
         friend.delete()
         friend_other.delete()
+
+        friends.invalidate(user, friend.friend_to)
+        feed.disconnect(user, friend.friend_to)
     except (KeyError, Friend.DoesNotExist):
         pass
 
@@ -155,6 +236,7 @@ def delete_picture(request):
     try:
         picture = Picture.objects.get(pk=request.POST['picture_id'])
         picture.delete()
+        media_storage.collect(renditions.names)
     except (KeyError, Picture.DoesNotExist):
         pass
 
@@ -165,7 +247,13 @@ def delete_picture(request):
 def delete_comment(request):
     try:
         comment = Comment.objects.get(pk=request.POST['comment_id'])
-        comment.delete()
+
+        with transaction.atomic():
+            comment.delete()
+            Picture.objects.filter(pk=comment.on_picture_id).update(
+                comment_count=F('comment_count') - 1)
+
+        fragments.bump(comment.on_picture_id)
     except (KeyError, Comment.DoesNotExist):
         pass
 
@@ -185,19 +273,225 @@ def delete_tag(request):
                                         args=(request.user.username,)))
 
 
+def upload_error(request, error):
+    return render(request, 'picshr/picture_upload.html',
+                  {'friends_sel': tag_choices(request.user), 'error': error},
+                  status=400)
+
+
+def extension_error(request):
+    return upload_error(request, 'Only %s files can be uploaded.' %
+                        ', '.join(EXTENSIONS))
+
+
 def upload_picture(request):
     if request.method == 'POST':
+        if not is_picture_name(getattr(request.FILES.get('file'), 'name',
+                                       '')):
+            return extension_error(request)
+
         picture = Picture()
+        upload = request.FILES['file']
 
         picture.title = request.POST['title']
         picture.is_public = request.POST['visibility'] == 'public'
         picture.author = request.user
-        picture.image = request.FILES['file']
+        picture.image = media_storage.save_upload(
+            upload_where(picture, upload.name), upload)
+        picture.status = Picture.PENDING
 
         picture.save()
+        jobs.enqueue(picture)
+        feed.publish(picture)
+
         return HttpResponseRedirect(reverse('home'))
     else:
-        return render(request, 'picshr/picture_upload.html')
+        return render(request, 'picshr/picture_upload.html',
+                      {'friends_sel': tag_choices(request.user)})
+
+
+@csrf_exempt
+def upload_pictures(request):
+    request.upload_handlers = [TemporaryFileUploadHandler()]
+    return _upload_pictures(request)
+
+
+@csrf_protect
+def _upload_pictures(request):
+    if request.method != 'POST':
+        return render(request, 'picshr/picture_upload.html',
+                      {'friends_sel': tag_choices(request.user)})
+
+    oversize = oversize_field(request, 'tag_username', 'files')
+
+    if oversize is not None:
+        return upload_error(request, 'At most %d %s can be sent at once.' %
+                            (MAX_BATCH, oversize))
+
+    user = request.user
+    is_public = request.POST.get('visibility') == 'public'
+    tagged = list(tag_candidates(user, request.POST.getlist('tag_username')))
+    uploads = request.FILES.getlist('files')
+
+    if not all(is_picture_name(upload.name) for upload in uploads):
+        return extension_error(request)
+
+    pictures = [Picture(title=os.path.splitext(upload.name)[0][:30],
+                        author=user, is_public=is_public,
+                        status=Picture.PENDING) for upload in uploads]
+    written = []
+
+    try:
+        with transaction.atomic():
+            create_pictures(user, pictures, uploads, tagged, written)
+    except Exception:
+        for name in written:
+            media_storage.purge(name)
+
+        raise
+
+    return HttpResponseRedirect(reverse('my_pictures'))
+
+
+def create_pictures(user, pictures, uploads, tagged, written):
+    names = media_storage.save_many(
+        ((upload_where(picture, upload.name), upload)
+         for picture, upload in zip(pictures, uploads)), written)
+    existing = set(Picture.objects.filter(author=user, image__in=names)
+                   .values_list('pk', flat=True))
+
+    for picture, name in zip(pictures, names):
+        picture.image = name
+
+    Picture.objects.bulk_create(pictures)
+    media.forget_private(*names)
+
+    created = {}
+
+    for pk, name in Picture.objects.filter(author=user, image__in=names)\
+            .exclude(pk__in=existing).order_by('pk')\
+            .values_list('pk', 'image'):
+        created.setdefault(name, []).append(pk)
+
+    for picture in pictures:
+        picture.pk = picture.id = created[picture.image.name].pop(0)
+
+    jobs.enqueue_many(pictures)
+    feed.publish(*pictures)
+    search.index_many(search.PICTURE, [(picture.pk, picture.title)
+                                       for picture in pictures])
+    Picture.tags.through.objects.bulk_create([
+        Picture.tags.through(picture_id=picture.pk, user_id=tag.pk)
+        for picture in pictures for tag in tagged])
+
+
+def redirect_back(request):
+    next_url = request.POST.get('next')
+
+    if not is_safe_url(next_url, request.get_host()):
+        next_url = reverse('my_pictures')
+
+    return HttpResponseRedirect(next_url)
+
+
+def oversize_field(request, *names):
+    for name in names:
+        values = request.FILES.getlist(name) if name in request.FILES \
+            else request.POST.getlist(name)
+
+        if len(values) > MAX_BATCH:
+            return name
+
+    return None
+
+
+def oversize_error(request, *names):
+    oversize = oversize_field(request, *names)
+
+    if oversize is None:
+        return None
+
+    return HttpResponseBadRequest('At most %d %s values can be sent at once.'
+                                  % (MAX_BATCH, oversize))
+
+
+def posted_ids(request, name):
+    ids = []
+
+    for value in request.POST.getlist(name):
+        try:
+            ids.append(int(value))
+        except ValueError:
+            pass
+
+    return ids
+
+
+def tag_candidates(user, usernames):
+    allowed = friends.friend_ids(user) | frozenset([user.pk])
+    return [tag for tag in User.objects.filter(
+        username__in=usernames) if tag.pk in allowed]
+
+
+def add_tags(request):
+    error = oversize_error(request, 'tag_username', 'picture_id')
+
+    if error is not None:
+        return error
+
+    user = request.user
+    tagged = tag_candidates(user, request.POST.getlist('tag_username'))
+    picture_ids = list(Picture.objects.filter(
+        pk__in=posted_ids(request, 'picture_id'), author=user)
+        .values_list('pk', flat=True))
+
+    through = Picture.tags.through
+    existing = set(through.objects.filter(picture__in=picture_ids,
+                                          user__in=tagged)
+                   .values_list('picture_id', 'user_id'))
+    new_tags = [through(picture_id=picture_id, user_id=tag.pk)
+                for picture_id in picture_ids for tag in tagged
+                if (picture_id, tag.pk) not in existing]
+
+    try:
+        through.objects.bulk_create(new_tags)
+    except IntegrityError:
+        new_tags = []
+
+    for picture_id in set(tag.picture_id for tag in new_tags):
+        fragments.bump(picture_id)
+
+    return redirect_back(request)
+
+
+def like_pictures(request):
+    error = oversize_error(request, 'picture_id')
+
+    if error is not None:
+        return error
+
+    user = request.user
+    picture_ids = set(Picture.objects.filter(
+        pk__in=posted_ids(request, 'picture_id'))
+        .values_list('pk', flat=True))
+    picture_ids -= set(Picture.likes.through.objects.filter(
+        picture__in=picture_ids, user=user).values_list('picture_id',
+                                                        flat=True))
+
+    try:
+        with transaction.atomic():
+            Picture.likes.through.objects.bulk_create([
+                Picture.likes.through(picture_id=picture_id, user_id=user.pk)
+                for picture_id in picture_ids])
+            Picture.objects.filter(pk__in=picture_ids).update(
+                like_count=F('like_count') + 1)
+    except IntegrityError:
+        picture_ids = ()
+
+    for picture_id in picture_ids:
+        fragments.bump(picture_id)
+
+    return redirect_back(request)
 
 
 def send_friend_request(request):
@@ -225,15 +519,17 @@ def add_tag(request):
 
 
 def search_users(request):
-    matched = []
+    query = request.GET.get('query', request.POST.get('query', ''))
 
     try:
-        query = request.POST['query']
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
 
-        for user in User.objects.all():
-            if query in user.username:
-                matched.append(user.username)
-    except KeyError:
-        pass
+    results, has_next = search.search(request.user, query, page)
 
-    return render(request, 'picshr/search_results.html', {'matched': matched})
\ No newline at end of file
+    return render(request, 'picshr/search_results.html',
+                  {'query': query, 'page': page, 'has_next': has_next,
+                   'users': results['users'],
+                   'pictures': results['pictures'],
+                   'comments': results['comments']})